@@ -1,9 +1,10 @@
 import os
+import hmac
 import logging
 import asyncio
 from flask import Flask, request, jsonify
 from telegram import Update
-from Zapis2 import setup_bot
+from Zapis2 import setup_bot, run_tick, TICK_SECRET
 
 # Configure logging
 logging.basicConfig(
@@ -15,8 +16,12 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 
 # Initialize the bot application
-# This starts background threads (Google Sheets, Reminders) defined in Zapis2.py
-bot_app = setup_bot()
+# By default the webhook runs in "web" mode: no background threads and no Google Sheets
+# connection, so cold starts stay fast. Reminders and the Sheets sync run in a separate
+# process (`python Zapis2.py worker`) against the same events.db. Set BOT_RUN_MODE=all
+# to run everything here; with several gunicorn workers only the process holding the
+# SQLite lease then runs reminders and the masters sheet sync.
+bot_app = setup_bot(mode=os.getenv("BOT_RUN_MODE", "web"))
 
 if bot_app is None:
     logger.error("Failed to initialize bot application! Check environment variables and configuration.")
@@ -46,6 +51,11 @@ async def webhook():
             # Process the update
             await bot_app.process_update(update)
 
+            # Save user_data and conversation states before replying: the next update of this
+            # user may be delivered to another worker, which reads them from events.db
+            await bot_app.update_persistence()
+            await bot_app.persistence.flush()
+
             return jsonify({'status': 'ok'}), 200
         except Exception as e:
             logger.error(f"Error processing webhook: {e}", exc_info=True)
@@ -53,6 +63,28 @@ async def webhook():
     else:
         return jsonify({'status': 'error', 'message': 'Method not allowed'}), 405
 
+@app.route('/tick', methods=['GET', 'POST'])
+def tick():
+    """
+    Runs one pass of reminders, admin reminders and the Google Sheets outbox.
+    Meant to be called by an external scheduler (or cron) in serverless deployments
+    where no background threads survive between requests. Concurrent calls are safe:
+    only one of them does the work, the others report "busy".
+    """
+    if not TICK_SECRET:
+        return jsonify({'status': 'error', 'message': 'Tick endpoint is disabled (TICK_SECRET is not set)'}), 404
+
+    token = request.headers.get('X-Tick-Token') or request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not hmac.compare_digest(token.encode(), TICK_SECRET.encode()):
+        return jsonify({'status': 'error', 'message': 'Unauthorized'}), 401
+
+    if not bot_app:
+        return jsonify({'status': 'error', 'message': 'Bot failed to initialize'}), 500
+
+    # Runs synchronously in the request thread: reminders are sent through their own event loop
+    stats = run_tick(bot_app)
+    return jsonify(stats), (500 if stats['status'] == 'error' else 200)
+
 @app.route('/', methods=['GET'])
 def index():
     status = "running" if bot_app else "failed to initialize"
@@ -7,6 +7,15 @@ import queue
 import warnings
 import traceback
 import asyncio
+import bisect
+import hashlib
+import json
+import inspect
+import socket
+import signal
+import uuid
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, date, timezone, tzinfo
 
 # Moscow timezone (UTC+3)
@@ -22,7 +31,8 @@ class MoscowTimezone(tzinfo):
 
 MOSCOW_TZ = MoscowTimezone()
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
+from telegram import __version__ as TG_VER, Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
+from telegram.error import Forbidden, BadRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -30,6 +40,11 @@ from telegram.ext import (
     CallbackQueryHandler,
     ConversationHandler,
     MessageHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
+    BasePersistence,
+    BaseUpdateProcessor,
+    PersistenceInput,
     filters
 )
 import gspread
@@ -42,6 +57,7 @@ warnings.filterwarnings("ignore", message="If 'per_message=True', 'all entry poi
 from requests.exceptions import ConnectionError, Timeout, RequestException
 import schedule
 import re
+from collections import namedtuple, OrderedDict, UserDict
 
 # === НАСТРОЙКИ И КОНСТАНТЫ ===
 # ID администраторов (через переменную окружения или жестко заданный список)
@@ -67,7 +83,50 @@ RETRY_DELAY = 2  # Задержка между попытками в секун
 # Таймауты для внешних сервисов
 DATABASE_TIMEOUT = 10  # Таймаут подключения к БД (секунды)
 GOOGLE_SHEETS_TIMEOUT = 30  # Таймаут для Google Sheets API (секунды)
+GOOGLE_SHEETS_POOL_SIZE = int(os.getenv("GOOGLE_SHEETS_POOL_SIZE", "4"))  # Размер пула keep-alive соединений с Google API
+GOOGLE_SHEETS_STATS_INTERVAL = 600  # Как часто логировать статистику переиспользования соединений (секунды)
+GOOGLE_SHEETS_QUOTA_PER_MINUTE = int(os.getenv("GOOGLE_SHEETS_QUOTA_PER_MINUTE", "60"))  # Квота запросов к Sheets API в минуту
+SHEETS_PRIORITY_INTERACTIVE = 0  # Действия администраторов и изменения мастер-классов
+SHEETS_PRIORITY_BACKGROUND = 1   # Журнал записей и плановая сверка листа
+SHEETS_INTERACTIVE_MAX_WAIT = GOOGLE_SHEETS_TIMEOUT  # Сколько интерактивный запрос может ждать квоту (секунды)
+SHEETS_BACKGROUND_MAX_WAIT = 300  # Сколько фоновый запрос может ждать квоту (секунды)
+SHEETS_THROTTLE_MAX_RETRIES = 3  # Повторы запроса после ответа 429
+SHEETS_THROTTLE_BACKOFF = 5  # Базовая пауза после 429, если нет Retry-After (секунды, удваивается)
+SHEETS_BREAKER_THRESHOLD = 3  # Сколько ошибок Google Sheets подряд переводят в режим деградации
+SHEETS_BREAKER_COOLDOWN = 60  # Через сколько секунд в режиме деградации делается пробный запрос
 HTTP_REQUEST_TIMEOUT = 15  # Таймаут для HTTP запросов (секунды)
+# Пулы потоков для блокирующих операций обработчиков (SQLite, Google Sheets) и контроль event loop
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "4"))  # Потоки для запросов к базе данных
+SHEETS_EXECUTOR_WORKERS = int(os.getenv("SHEETS_EXECUTOR_WORKERS", "2"))  # Потоки для запросов к Google Sheets
+LOOP_LAG_THRESHOLD_MS = int(os.getenv("LOOP_LAG_THRESHOLD_MS", "200"))  # Блокировка event loop дольше порога пишется в лог (0 - отключить)
+LOOP_LAG_CHECK_INTERVAL = 1  # Как часто проверять отзывчивость event loop (секунды)
+# Режим запуска: "all" - обработчики и фоновые потоки в одном процессе, "web" - только обработчики
+# (без фоновых потоков и Google Sheets), "worker" - только фоновые задачи
+BOT_RUN_MODES = ("all", "web", "worker")
+BOT_RUN_MODE = os.getenv("BOT_RUN_MODE", "all")
+SHEETS_OUTBOX_POLL_INTERVAL = 2  # Как часто фоновый поток забирает задачи из sheets_outbox (секунды)
+SHEETS_OUTBOX_BATCH = 50  # Сколько задач sheets_outbox забирается за раз
+SHEETS_OUTBOX_JOBS = ("bulk_update_registrations_in_sheets",)  # Групповые операции, которые можно передать через sheets_outbox
+# Проход фоновых задач по запросу /tick (бессерверное развертывание без фоновых потоков)
+TICK_SECRET = os.getenv("TICK_SECRET", "")  # Секрет для вызова /tick (пустой - маршрут отключен)
+TICK_TIME_BUDGET = float(os.getenv("TICK_TIME_BUDGET", "20"))  # Время на один проход (секунды)
+TICK_OUTBOX_LIMIT = 20  # Максимум задач sheets_outbox за один проход
+# Выбор ведущего процесса (при нескольких процессах, например воркерах gunicorn)
+BACKGROUND_LEASE_NAME = "background_workers"  # Аренда на напоминания и синхронизацию листа мастер-классов
+LEADER_LEASE_TTL = 30  # Срок аренды: если ведущий не продлил ее, роль забирает другой процесс (секунды)
+LEADER_HEARTBEAT_INTERVAL = 10  # Как часто ведущий продлевает аренду, а остальные пробуют ее получить (секунды)
+# Параллельная обработка обновлений: разные чаты обрабатываются одновременно, обновления одного чата - по очереди
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "16"))  # Сколько обновлений обрабатывается одновременно (1 - по одному)
+# Хранение user_data и состояний диалогов в базе данных (переживают перезапуск, доступны всем процессам)
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "5"))  # Как часто изменения пакетом пишутся в базу (секунды)
+# Ограничение памяти состояния диалогов
+USER_CONVERSATION_TIMEOUT = int(os.getenv("USER_CONVERSATION_TIMEOUT", "1800"))  # Незавершенная запись сбрасывается после стольких секунд бездействия
+ADMIN_CONVERSATION_TIMEOUT = int(os.getenv("ADMIN_CONVERSATION_TIMEOUT", "3600"))  # То же для диалогов админ-панели (секунды)
+USER_DATA_IDLE_TTL = int(os.getenv("USER_DATA_IDLE_TTL", str(24 * 3600)))  # user_data без активного диалога удаляется из базы после стольких секунд бездействия
+STATE_MEMORY_IDLE_TTL = int(os.getenv("STATE_MEMORY_IDLE_TTL", "900"))  # Данные пользователя, не писавшего процессу столько секунд, выгружаются из памяти (остаются в базе)
+STATE_SWEEP_INTERVAL = 300  # Как часто проверять простаивающие диалоги и данные (секунды)
+STATE_GAUGE_SAMPLE_SIZE = 200  # По скольким записям каждого словаря оценивается средний размер записи
+STATE_SWEEP_BATCH_SIZE = 1000  # Сколько пользователей или чатов проверяется за один шаг очистки, не отпуская event loop
 
 # Приоритеты для фоновых задач (меньше число = выше приоритет)
 TASK_PRIORITY_HIGH = 1    # Создание новых записей
@@ -92,15 +151,38 @@ ADMIN_PASSWORD_VALUE = os.getenv("ADMIN_PASSWORD", "RGSUtehnopark")
 # Настройки защиты админ-панели
 MAX_ATTEMPTS = 3  # Максимальное количество неудачных попыток входа
 LOGIN_COOLDOWN = 300  # Кулдаун в секундах (5 минут) после превышения попыток
+ADMIN_SESSION_TTL = int(os.getenv("ADMIN_SESSION_TTL", str(12 * 3600)))  # Срок действия сессии администратора (секунды)
+ADMIN_AUTH_CACHE_SIZE = 256  # Сколько сессий и счетчиков входа держать в кэше процесса
+ADMIN_AUTH_CACHE_TTL = 30  # Сколько секунд запись кэша считается актуальной (изменения из других процессов)
+ADMIN_AUTH_PURGE_INTERVAL = 600  # Как часто удалять истекшие сессии и счетчики из базы данных (секунды)
 # Интервал проверки напоминаний (в секундах)
 REMINDER_CHECK_INTERVAL = 60  # 60 секунд для быстрой проверки напоминаний
+# Хранение отметок об отправке относительных напоминаний
+RELATIVE_REMINDER_SENDS_TTL_DAYS = 7  # Сколько дней хранить отметки для прошедших дат мастер-классов
+RELATIVE_REMINDER_CLEANUP_INTERVAL = 3600  # Интервал очистки устаревших отметок (секунды)
+LEGACY_RELATIVE_REMINDERS_FILE = "relative_reminders_sent.txt"  # Старый файл отметок (импортируется один раз)
+# Пользователи бота и рассылки
+BOT_USER_TOUCH_INTERVAL = 300  # Как часто обновлять last_active пользователя в базе данных (секунды)
+CALLBACK_DEDUP_TTL = 3  # Повторное нажатие той же кнопки того же сообщения в течение стольких секунд после обработки игнорируется
+MESSAGE_RENDER_CACHE_SIZE = 1000  # Для скольких сообщений помнить отпечаток последнего редактирования
+CALLBACK_DEDUP_MAX_PROCESSING = 60  # Обработка нажатия дольше этого считается прерванной, повтор пропускается (секунды)
+CALLBACK_FIELD_SEPARATORS = ("|", ":")  # Разделители действия и полей в callback_data
+RECIPIENTS_PAGE_SIZE = 500  # Размер страницы получателей при рассылке
+ADMIN_REMINDER_GRACE_PERIOD = 300  # Сколько секунд после запланированного времени админ-напоминание еще можно отправить
+# Мастер-классы: база данных - основное хранилище, лист "Мастер-классы" - зеркало
+MASTERS_SHEET_HEADERS = ["ID", "Название", "Свободных мест", "Всего мест", "Записано", "Дата начала", "Дата окончания", "Время начала", "Время окончания", "Доступен для записи", "Исключить выходные", "Описание"]
+MASTERS_MIRROR_INTERVAL = 180  # Как часто сверять лист мастер-классов с базой данных, если изменений нет (секунды)
 
 # === ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ===
+bot_run_mode = BOT_RUN_MODE  # Режим, в котором запущен процесс (устанавливается в setup_bot)
+
 # Глобальные переменные для Google Sheets
 google_sheet = None
 masters_sheet = None  # Лист для мастер-классов
 google_sheets_enabled = False
 google_sheets_initialized = False
+sheets_http_adapter = None  # HTTP-адаптер авторизованной сессии gspread (пул соединений)
+sheets_http_stats_last_log = 0  # Время последнего вывода статистики соединений
 sheets_queue = queue.PriorityQueue(maxsize=100)  # Приоритетная очередь для фоновых операций с Google Sheets
 sheets_worker_running = True  # Флаг для завершения фонового потока
 masters_data = {}  # Кэш данных о мастер-классах
@@ -115,15 +197,72 @@ application_event_loop = None  # Глобальная ссылка на event lo
 # Очередь для задач, которые нужно выполнить в основном потоке
 reminder_task_queue = queue.Queue()
 
-# Список авторизованных администраторов (ID пользователей)
-authorized_admins = set()
-
-# Словарь для отслеживания попыток входа в админ-панель (user_id: (timestamp, attempts))
-login_attempts = {}
-
 # Глобальный лок для синхронизации доступа к данным о мастер-классах
 masters_data_lock = threading.Lock()
 
+# Синхронизация таблицы master_classes с листом "Мастер-классы" (выполняется в sheets_worker)
+masters_mirror_requested = threading.Event()  # Есть изменения, которые нужно выгрузить на лист
+masters_mirror_last_run = 0  # Время последней синхронизации
+masters_sheet_fingerprint = None  # Отпечаток содержимого листа после последней синхронизации
+masters_mirror_stats = {"checks": 0, "skipped": 0, "pulled": 0, "pushed": 0}  # Счетчики синхронизации листа
+masters_sync_lock = threading.RLock()  # Синхронизацию запускают sheets_worker и админ-панель
+
+# Отложенные групповые операции с Google Sheets (функция, аргументы), выполняются в sheets_worker
+sheets_jobs_queue = queue.Queue()
+
+# Кэш отправленных относительных напоминаний: множество (reminder_id, class_id, class_date)
+relative_reminder_sends_cache = set()
+relative_reminder_sends_cache_loaded = False
+relative_reminder_sends_lock = threading.Lock()
+relative_reminder_last_cleanup = 0  # Время последней очистки устаревших отметок
+
+# Индекс занятий мастер-классов: отсортированный список (start_ts, class_id, date, time)
+class_occurrence_index = []
+class_occurrence_index_keys = []  # Только start_ts для bisect
+class_occurrence_index_signature = None  # Подпись расписания, по которой построен индекс
+class_occurrence_index_lock = threading.Lock()
+
+# Время последнего обновления last_active для пользователей (user_id: timestamp)
+bot_users_last_touch = {}
+
+# Защита от повторных нажатий: (chat_id, message_id, callback_data) -> [начало обработки, конец обработки или None]
+callback_guard = OrderedDict()
+callback_guard_stats = {"dropped": 0, "saved_seconds": 0.0}  # Отброшенные повторы и сэкономленное время обработки
+
+# Отпечатки сообщений после редактирования: (chat_id, message_id) -> (отпечаток, id нажатия)
+message_render_cache = OrderedDict()
+message_edit_stats = {"sent": 0, "skipped": 0, "not_modified": 0}  # Отправленные и пропущенные редактирования
+
+# Недоступные чаты (пользователь заблокировал бота, удален или чат не найден)
+unreachable_chats = set()
+unreachable_chats_loaded = False
+unreachable_chats_lock = threading.Lock()  # Замена и изменение набора недоступных чатов
+chat_delivery_stats = {"skipped": 0, "marked": 0, "cleared": 0}  # Счетчики пропущенных отправок
+
+# Планирование администраторских напоминаний по next_fire_at
+admin_reminders_next_wakeup = 0  # Ближайший next_fire_at (0 - неизвестен, inf - нечего отправлять)
+admin_reminders_wakeup_refreshed = 0  # Когда admin_reminders_next_wakeup последний раз читался из базы
+admin_reminders_schedule_signature = None  # Подпись расписания, по которой рассчитаны относительные напоминания
+masters_schedule_version = 0  # Увеличивается при каждом изменении расписания в masters_data
+masters_schedule_signature_cache = (None, None)  # (версия расписания, подпись)
+reminder_worker_wakeup = threading.Event()  # Будит фоновый поток при изменении напоминаний
+
+# Выбор ведущего процесса: идентификатор этого процесса и срок удерживаемой аренды
+process_instance_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+background_leader_until = 0  # До этого момента процесс считается ведущим (0 - не ведущий)
+leader_election_running = True
+tick_lock = threading.Lock()  # Проход /tick в этом процессе
+background_takeover_pending = threading.Event()  # Процесс стал ведущим, состояние нужно перечитать из базы
+
+# Хранилище user_data и состояний диалогов (создается в setup_bot)
+bot_persistence = None
+
+# Монитор задержек event loop: (loop, id потока) под наблюдением и счетчики блокировок
+loop_lag_monitor_target = None
+loop_lag_monitor_thread = None
+loop_lag_monitor_lock = threading.Lock()
+loop_lag_stats = {"checks": 0, "stalls": 0, "max_ms": 0}
+
 # Класс для безопасного форматирования логов с Unicode
 class SafeFormatter(logging.Formatter):
     """Форматтер, который безопасно обрабатывает Unicode символы"""
@@ -188,17 +327,57 @@ audit_handler.setFormatter(audit_formatter)
 audit_logger.addHandler(audit_handler)
 audit_logger.setLevel(logging.INFO)
 
+# Отпечаток содержимого сообщения: текст и inline-клавиатура
+def get_message_render_hash(text, reply_markup):
+    # Кнопки собираются напрямую: reply_markup.to_dict() для календаря на ~50 кнопок стоит ~0.5 мс
+    markup = repr([[(button.text, button.callback_data, button.url) for button in row] for row in reply_markup.inline_keyboard]) if reply_markup else ""
+    # Telegram обрезает пробелы по краям текста, поэтому они не считаются изменением
+    return hashlib.sha1(f"{(text or '').strip()}\x00{markup}".encode("utf-8")).hexdigest()
+
+# Подтверждение callback, который мог быть уже подтвержден обработчиком
+async def answer_query_quietly(query):
+    try:
+        await query.answer()
+    except BadRequest:
+        pass
+
 # Функция для безопасного редактирования сообщений
 async def safe_edit_message(query, text, reply_markup=None):
-    """Безопасно редактирует сообщение, обрабатывая ошибку 'message not modified'"""
+    """
+    Безопасно редактирует сообщение, обрабатывая ошибку 'message not modified'.
+    Если сообщение уже выглядит так же, запрос к Telegram не отправляется. Текущее содержимое берется
+    из кэша, если это сообщение уже редактировалось при обработке этого же нажатия, иначе - из самого
+    нажатия (Telegram присылает сообщение в его текущем виде).
+    """
+    new_hash = get_message_render_hash(text, reply_markup)
+    message = query.message
+    cache_key = (message.chat.id, message.message_id) if message else query.inline_message_id
+    cached = message_render_cache.get(cache_key)
+    if cached and cached[1] == query.id:
+        current_hash = cached[0]
+    elif message and getattr(message, "text", None) is not None and not message.entities:
+        # Сообщения с форматированием не сравниваются: без parse_mode редактирование его снимает
+        current_hash = get_message_render_hash(message.text, message.reply_markup)
+    else:
+        current_hash = None
+    if new_hash == current_hash:
+        message_edit_stats["skipped"] += 1
+        logger.debug("Сообщение не изменилось, редактирование не отправляется")
+        await answer_query_quietly(query)
+        return
+
     try:
         await query.edit_message_text(text, reply_markup=reply_markup)
+        message_edit_stats["sent"] += 1
+        remember_message_render(cache_key, new_hash, query.id)
     except Exception as e:
         error_msg = str(e).lower()
         if "message is not modified" in error_msg or "message not modified" in error_msg:
             # Игнорируем ошибку, если сообщение не изменилось
             logger.debug("Сообщение не изменилось, пропускаем редактирование")
-            await query.answer()  # Просто подтверждаем callback
+            message_edit_stats["not_modified"] += 1
+            remember_message_render(cache_key, new_hash, query.id)
+            await answer_query_quietly(query)  # Просто подтверждаем callback
         else:
             # Для других ошибок логируем и пробуем отправить новое сообщение
             logger.warning(f"⚠️ Ошибка при редактировании сообщения: {e}")
@@ -237,6 +416,95 @@ def schedule_coroutine(application, coroutine):
 # Алиас для обратной совместимости
 safe_edit_message_text = safe_edit_message
 
+# Запоминание отпечатка сообщения после редактирования (LRU на MESSAGE_RENDER_CACHE_SIZE сообщений)
+def remember_message_render(cache_key, render_hash, query_id):
+    message_render_cache[cache_key] = (render_hash, query_id)
+    message_render_cache.move_to_end(cache_key)
+    while len(message_render_cache) > MESSAGE_RENDER_CACHE_SIZE:
+        message_render_cache.popitem(last=False)
+
+# === ВЫПОЛНЕНИЕ БЛОКИРУЮЩИХ ОПЕРАЦИЙ ВНЕ EVENT LOOP ===
+# Отдельные пулы: долгий запрос к Google Sheets не занимает потоки, нужные для запросов к базе данных
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="DatabaseIO")
+sheets_executor = ThreadPoolExecutor(max_workers=SHEETS_EXECUTOR_WORKERS, thread_name_prefix="SheetsIO")
+
+# Выполнение синхронной функции работы с базой данных из обработчика
+async def run_db(func, *args, **kwargs):
+    """Выполняет func в пуле потоков базы данных, не блокируя event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, lambda: func(*args, **kwargs))
+
+# Выполнение синхронной функции работы с Google Sheets из обработчика
+async def run_sheets(func, *args, **kwargs):
+    """Выполняет func в пуле потоков Google Sheets, не блокируя event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(sheets_executor, lambda: func(*args, **kwargs))
+
+# Постановка текущего event loop под наблюдение монитора задержек
+def watch_event_loop():
+    """Вызывается из обработчика: запоминает работающий event loop и его поток, при необходимости запускает монитор"""
+    global loop_lag_monitor_target, loop_lag_monitor_thread
+    # В режиме web процесс не запускает собственных потоков
+    if LOOP_LAG_THRESHOLD_MS <= 0 or bot_run_mode == "web":
+        return
+    loop = asyncio.get_running_loop()
+    target = loop_lag_monitor_target
+    if target and target[0] is loop:
+        return
+    with loop_lag_monitor_lock:
+        loop_lag_monitor_target = (loop, threading.get_ident())
+        if loop_lag_monitor_thread is None or not loop_lag_monitor_thread.is_alive():
+            loop_lag_monitor_thread = threading.Thread(target=loop_lag_monitor, daemon=True, name="LoopLagMonitor")
+            loop_lag_monitor_thread.start()
+
+# Описание места, где event loop заблокирован
+def describe_blocking_frame(frame):
+    """По стеку потока event loop находит обработчик бота и вызов, который его блокирует"""
+    if frame is None:
+        return "стек недоступен"
+    blocked_at = f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})"
+    while frame is not None:
+        code = frame.f_code
+        if code.co_flags & inspect.CO_COROUTINE and code.co_filename == __file__:
+            return f"обработчик {code.co_name} (строка {frame.f_lineno}), блокирующий вызов {blocked_at}"
+        frame = frame.f_back
+    return f"блокирующий вызов {blocked_at}"
+
+# Фоновый поток монитора задержек event loop
+def loop_lag_monitor():
+    """
+    Периодически ставит в event loop пустой callback. Если он не выполнился за LOOP_LAG_THRESHOLD_MS,
+    снимает стек потока event loop (в нем виден заблокировавший обработчик) и после разблокировки
+    пишет в лог, на сколько был заблокирован event loop.
+    """
+    threshold = LOOP_LAG_THRESHOLD_MS / 1000
+    while True:
+        time.sleep(LOOP_LAG_CHECK_INTERVAL)
+        target = loop_lag_monitor_target
+        if not target or not target[0].is_running():
+            continue
+        loop, thread_id = target
+        responded = threading.Event()
+        started = time.monotonic()
+        try:
+            loop.call_soon_threadsafe(responded.set)
+        except RuntimeError:
+            # Event loop уже закрыт
+            continue
+        loop_lag_stats["checks"] += 1
+        if responded.wait(threshold):
+            continue
+        culprit = describe_blocking_frame(sys._current_frames().get(thread_id))
+        responded.wait(HTTP_REQUEST_TIMEOUT)
+        if not responded.is_set() and not loop.is_running():
+            # Event loop остановился, пока ждали ответа - это не блокировка
+            continue
+        lag_ms = (time.monotonic() - started) * 1000
+        loop_lag_stats["stalls"] += 1
+        loop_lag_stats["max_ms"] = max(loop_lag_stats["max_ms"], round(lag_ms))
+        suffix = "" if responded.is_set() else " и все еще заблокирован"
+        logger.warning(f"🐢 Event loop заблокирован на {lag_ms:.0f} мс{suffix} (порог {LOOP_LAG_THRESHOLD_MS} мс): {culprit}")
+
 # Определение данных по умолчанию для мастер-классов
 POSITIONS = {
     "MC001": {
@@ -328,107 +596,492 @@ def validate_time(time_str):
     except ValueError:
         return False, "Неверный формат времени! Пожалуйста, введите время в формате ЧЧ:ММ"
 
-# Вспомогательная функция для получения следующего ID для нового мастер-класса
+# Числовая часть ID мастер-класса (MC007 -> 7)
+def parse_master_id_number(master_id):
+    master_id = str(master_id or "").strip()
+    if master_id.startswith("MC") and master_id[2:].isdigit():
+        return int(master_id[2:])
+    return None
+
+# Получение следующего ID для нового мастер-класса из таблицы id_sequences
 def get_next_master_id():
-    """Генерирует ID для нового мастер-класса на основе существующих с проверкой Google Sheets"""
+    """
+    Выдает ID для нового мастер-класса из счетчика 'master_class' в базе данных.
+    Счетчик согласуется с листом при каждой загрузке мастер-классов (reconcile_master_id_sequence),
+    поэтому выдача не обращается к Google Sheets и не держит masters_data_lock во время запросов.
+    """
+    # Снимок ID из кэша берем под коротким локом, без операций ввода-вывода
     with masters_data_lock:
-        # Собираем все существующие ID из кэша
-        existing_ids = set()
-        if masters_data:
-            existing_ids.update(master_id for master_id in masters_data.keys() if master_id.startswith("MC"))
+        cached_ids = list(masters_data.keys())
+    cached_max = max((number for number in map(parse_master_id_number, cached_ids) if number is not None), default=0)
 
-        # Также проверяем Google Sheets для обеспечения一致ности
-        if masters_sheet and google_sheets_enabled:
-            try:
-                all_records = masters_sheet.get_all_records()
-                for record in all_records:
-                    master_id = record.get("ID", "").strip()
-                    if master_id.startswith("MC"):
-                        existing_ids.add(master_id)
-            except Exception as e:
-                logger.warning(f"Не удалось проверить существующие ID в Google Sheets: {e}")
-
-        if not existing_ids:
-            return "MC001"
+    conn = get_connection()
+    if not conn:
+        logger.warning("⚠️ База данных недоступна, ID мастер-класса выдается по кэшу")
+        return f"MC{cached_max + 1:03d}"
 
-        # Получаем числовые части существующих ID
-        numeric_ids = []
-        for master_id in existing_ids:
-            try:
-                if master_id.startswith("MC") and len(master_id) >= 5:  # MC + 3 digits minimum
-                    numeric_part = int(master_id[2:])
-                    numeric_ids.append(numeric_part)
-            except ValueError:
-                continue
+    conn.isolation_level = None  # Транзакцией управляем явно
+    try:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT value FROM id_sequences WHERE name = 'master_class'")
+        row = cursor.fetchone()
+        next_id = max(row[0] if row else 0, cached_max) + 1
+        cursor.execute('''
+            INSERT INTO id_sequences (name, value) VALUES ('master_class', ?)
+            ON CONFLICT(name) DO UPDATE SET value = excluded.value
+        ''', (next_id,))
+        cursor.execute("COMMIT")
+        return f"MC{next_id:03d}"
+    except sqlite3.Error as e:
+        if conn.in_transaction:
+            conn.rollback()
+        logger.error(f"❌ Ошибка выдачи ID мастер-класса: {e}")
+        return f"MC{cached_max + 1:03d}"
+    finally:
+        conn.close()
 
-        if not numeric_ids:
-            return "MC001"
+# Согласование счетчика ID мастер-классов с листом
+def reconcile_master_id_sequence(master_ids, reset=False):
+    """
+    Поднимает счетчик 'master_class' до максимального ID на листе.
+    При reset=True (после перенумерации) счетчик выставляется ровно в максимальный ID.
+    """
+    max_id = max((number for number in map(parse_master_id_number, master_ids) if number is not None), default=0)
 
-        # Находим следующий доступный ID (заполняем пробелы или продолжаем после максимального)
-        max_id = max(numeric_ids)
-        next_id = max_id + 1
+    conn = get_connection()
+    if not conn:
+        return False
 
-        # Альтернативно: можно заполнять пробелы, но для простоты используем следующий после максимального
-        return f"MC{next_id:03d}"
+    try:
+        cursor = conn.cursor()
+        if reset:
+            cursor.execute('''
+                INSERT INTO id_sequences (name, value) VALUES ('master_class', ?)
+                ON CONFLICT(name) DO UPDATE SET value = excluded.value
+            ''', (max_id,))
+        else:
+            cursor.execute('''
+                INSERT INTO id_sequences (name, value) VALUES ('master_class', ?)
+                ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)
+            ''', (max_id,))
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка согласования счетчика ID мастер-классов: {e}")
+        return False
+    finally:
+        conn.close()
 
 # Функция для перенумерации мастер-классов после удаления
 def renumber_master_classes():
-    """Перенумеровывает мастер-классы после удаления, чтобы сохранить порядок"""
-    if not masters_sheet or not google_sheets_enabled:
+    """
+    Перенумеровывает мастер-классы после удаления, чтобы сохранить порядок.
+    ID меняются в таблице master_classes и во всех ссылающихся таблицах (записи,
+    админ-напоминания, отметки напоминаний) в одной транзакции; лист обновляется в фоне.
+    """
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Невозможно перенумеровать мастер-классы: база данных недоступна")
         return False
-    
+
+    conn.isolation_level = None  # Транзакцией управляем явно
     try:
-        # Получаем все записи из листа мастер-классов
-        all_records = masters_sheet.get_all_records()
-        
-        # Фильтруем только активные мастер-классы и сортируем по текущему ID
-        active_classes = [record for record in all_records if record.get("ID") and record.get("ID").startswith("MC")]
-        active_classes.sort(key=lambda x: int(x["ID"][2:]))
-        
-        # Создаем новые записи с переупорядоченными ID
-        new_records = []
-        for idx, record in enumerate(active_classes):
-            new_id = f"MC{idx+1:03d}"
-            new_record = record.copy()
-            new_record["ID"] = new_id
-            new_records.append(new_record)
-        
-        # Очищаем лист и перезаписываем с новыми ID
-        masters_sheet.clear()
-        # Добавляем заголовки
-        masters_headers = ["ID", "Название", "Свободных мест", "Всего мест", "Записано", "Дата начала", "Дата окончания", "Время начала", "Время окончания", "Доступен для записи", "Описание"]
-        masters_sheet.insert_row(masters_headers, 1)
-        
-        # Добавляем записи с новыми ID
-        for record in new_records:
-            masters_sheet.append_row([
-                record["ID"],
-                record.get("Название", ""),
-                str(record.get("Свободных мест", 20)),
-                str(record.get("Всего мест", 20)),
-                str(record.get("Записано", 0)),
-                record.get("Дата начала", "2025-12-01"),
-                record.get("Дата окончания", "2026-01-31"),
-                record.get("Время начала", "10:00"),
-                record.get("Время окончания", "12:00"),
-                record.get("Доступен для записи", "да"),
-                record.get("Описание", "")
-            ])
-        
-        # Обновляем кэш
-        load_masters_data()
-        logger.info(f"✅ Мастер-классы успешно перенумерованы. Всего: {len(new_records)}")
-        return True
-    
-    except Exception as e:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        # Сортируем активные мастер-классы по текущему ID
+        cursor.execute("SELECT id FROM master_classes WHERE deleted = 0")
+        master_ids = [row[0] for row in cursor.fetchall()]
+        master_ids.sort(key=lambda master_id: parse_master_id_number(master_id) or 0)
+
+        # Таблица соответствия старых ID новым
+        new_ids = [f"MC{idx+1:03d}" for idx in range(len(master_ids))]
+        id_mapping = {old_id: new_id for old_id, new_id in zip(master_ids, new_ids) if old_id != new_id}
+
+        if id_mapping:
+            now = time.time()
+            old_ids = list(id_mapping.keys())
+            placeholders = ", ".join("?" for _ in old_ids)
+            # Удаленные мастер-классы, чьи ID займут перенумерованные, больше не нужны
+            cursor.execute(f"DELETE FROM master_classes WHERE deleted = 1 AND id IN ({', '.join('?' for _ in new_ids)})", new_ids)
+            # Переименовываем в два шага, чтобы сдвиг ID (MC003 → MC002) не упирался в первичный ключ
+            cursor.execute(f"UPDATE master_classes SET id = '~' || id WHERE id IN ({placeholders})", old_ids)
+            for old_id, new_id in id_mapping.items():
+                cursor.execute('''
+                    UPDATE master_classes SET id = ?, dirty = 1, synced_hash = NULL, updated_at = ?
+                    WHERE id = ?
+                ''', (new_id, now, "~" + old_id))
+            # Старые ID, которые больше никому не принадлежат, нужно убрать с листа
+            for old_id in set(old_ids) - set(new_ids):
+                cursor.execute('''
+                    INSERT OR IGNORE INTO master_classes (id, name, deleted, dirty, updated_at)
+                    VALUES (?, '', 1, 1, ?)
+                ''', (old_id, now))
+
+            # Один CASE-запрос на таблицу, чтобы сдвиг ID (MC003 → MC002) не задел уже измененные строки
+            case_sql = " ".join("WHEN ? THEN ?" for _ in id_mapping)
+            case_params = [value for pair in id_mapping.items() for value in pair]
+            for table, column in (("registrations", "position"),
+                                  ("admin_reminders", "master_class_id"),
+                                  ("relative_reminder_sends", "class_id")):
+                cursor.execute(
+                    f"UPDATE {table} SET {column} = CASE {column} {case_sql} END WHERE {column} IN ({placeholders})",
+                    case_params + old_ids
+                )
+        cursor.execute("COMMIT")
+    except sqlite3.Error as e:
+        if conn.in_transaction:
+            conn.rollback()
         logger.error(f"❌ Ошибка при перенумерации мастер-классов: {e}")
         return False
+    finally:
+        conn.close()
+
+    masters_mirror_requested.set()
+    # Обновляем кэш; после перенумерации следующий ID идет сразу за последним
+    load_masters_data()
+    reconcile_master_id_sequence(new_ids, reset=True)
+    if id_mapping:
+        logger.info(f"🔄 ID мастер-классов изменены: {id_mapping}")
+        load_relative_reminder_sends_cache()
+        reschedule_all_admin_reminders()
+    logger.info(f"✅ Мастер-классы успешно перенумерованы. Всего: {len(master_ids)}")
+    return True
+
+# === ШЛЮЗ GOOGLE SHEETS API ===
+class SheetsQuotaExceeded(Exception):
+    """Запрос к Google Sheets не дождался свободной квоты"""
+
+class SheetsUnavailable(Exception):
+    """Google Sheets в режиме деградации (автомат разомкнут), запрос не отправлялся"""
+
+class SheetsGateway:
+    """
+    Общий для всех потоков бюджет запросов к Google Sheets API: token bucket под минутную квоту,
+    приоритеты (интерактивные запросы раньше фоновых), объединение одинаковых одновременных чтений
+    и общая пауза после ответа 429.
+    Автомат (circuit breaker): после SHEETS_BREAKER_THRESHOLD ошибок подряд запросы сразу отклоняются
+    с SheetsUnavailable; через SHEETS_BREAKER_COOLDOWN секунд пропускается один пробный запрос.
+    """
+    def __init__(self, per_minute):
+        self.capacity = max(1, per_minute)
+        self.rate = self.capacity / 60.0  # Токенов в секунду
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0  # До этого момента запросы не отправляются (после 429)
+        self.condition = threading.Condition()
+        self.waiting = [0, 0]  # Количество ожидающих по приоритетам
+        self.inflight = {}  # Ключ чтения -> {"done": Event, "result": ответ, "error": ошибка}
+        self.stats = {"calls": 0, "waits": 0, "wait_seconds": 0.0, "rejected": 0, "throttled": 0, "coalesced": 0,
+                      "failures": 0, "short_circuited": 0, "breaker_opened": 0}
+        self.breaker_state = "closed"  # "closed" - работает, "open" - деградация, "half_open" - идет пробный запрос
+        self.consecutive_failures = 0
+        self.opened_until = 0.0  # До этого момента запросы отклоняются без обращения к Google
+        self.last_error = None
+
+    def state(self):
+        """Состояние автомата; "open" с истекшей паузой показывается как "half_open" (ждет пробный запрос)"""
+        with self.condition:
+            if self.breaker_state == "open" and time.monotonic() >= self.opened_until:
+                return "half_open"
+            return self.breaker_state
+
+    def is_available(self):
+        return self.state() != "open"
+
+    def seconds_until_probe(self):
+        return max(0.0, self.opened_until - time.monotonic())
+
+    def _before_call(self):
+        with self.condition:
+            if self.breaker_state == "closed":
+                return
+            if self.breaker_state == "open" and time.monotonic() >= self.opened_until:
+                # Пропускаем один пробный запрос
+                self.breaker_state = "half_open"
+                return
+            self.stats["short_circuited"] += 1
+            raise SheetsUnavailable(f"Google Sheets недоступен: {self.last_error}")
+
+    def _record_result(self, error=None):
+        with self.condition:
+            if error is None:
+                if self.breaker_state != "closed":
+                    logger.info("✅ Google Sheets снова доступен, режим деградации выключен")
+                self.breaker_state = "closed"
+                self.consecutive_failures = 0
+                return
+            self.stats["failures"] += 1
+            self.consecutive_failures += 1
+            self.last_error = error
+            if self.breaker_state == "half_open" or self.consecutive_failures >= SHEETS_BREAKER_THRESHOLD:
+                if self.breaker_state == "closed":
+                    self.stats["breaker_opened"] += 1
+                    logger.warning(f"⚠️ Google Sheets недоступен ({self.consecutive_failures} ошибок подряд), включен режим деградации: {error}")
+                self.breaker_state = "open"
+                self.opened_until = time.monotonic() + SHEETS_BREAKER_COOLDOWN
+
+    def acquire(self, priority):
+        """Ждет свободный токен; при превышении времени ожидания выбрасывает SheetsQuotaExceeded"""
+        max_wait = SHEETS_INTERACTIVE_MAX_WAIT if priority == SHEETS_PRIORITY_INTERACTIVE else SHEETS_BACKGROUND_MAX_WAIT
+        started = time.monotonic()
+        waited = False
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    # Фоновые запросы уступают, пока ждут интерактивные
+                    higher_waiting = any(self.waiting[:priority])
+                    if now >= self.blocked_until and self.tokens >= 1 and not higher_waiting:
+                        self.tokens -= 1
+                        self.stats["calls"] += 1
+                        if waited:
+                            self.stats["waits"] += 1
+                            self.stats["wait_seconds"] += now - started
+                        return
+                    if now - started >= max_wait:
+                        self.stats["rejected"] += 1
+                        raise SheetsQuotaExceeded(f"нет свободной квоты Google Sheets в течение {max_wait} с")
+                    waited = True
+                    delay = max(self.blocked_until - now, (1 - self.tokens) / self.rate, 0.05)
+                    self.condition.wait(min(delay, max_wait - (now - started)))
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    def throttle(self, retry_after):
+        """Останавливает все запросы на retry_after секунд после ответа 429"""
+        with self.condition:
+            self.stats["throttled"] += 1
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            self.tokens = 0.0
+
+    def call(self, func, key=None):
+        """Выполняет запрос через бюджет; одинаковые одновременные чтения (key) выполняются один раз"""
+        if key is not None:
+            owner = False
+            with self.condition:
+                entry = self.inflight.get(key)
+                if entry:
+                    self.stats["coalesced"] += 1
+                else:
+                    entry = self.inflight[key] = {"done": threading.Event(), "result": None, "error": None}
+                    owner = True
+            if not owner:
+                entry["done"].wait()
+                if entry["error"] is not None:
+                    raise entry["error"]
+                return entry["result"]
+            try:
+                entry["result"] = self._call_with_backoff(func)
+                return entry["result"]
+            except Exception as e:
+                entry["error"] = e
+                raise
+            finally:
+                with self.condition:
+                    self.inflight.pop(key, None)
+                entry["done"].set()
+        return self._call_with_backoff(func)
+
+    def _call_with_backoff(self, func):
+        self._before_call()
+        priority = get_sheets_priority()
+        for attempt in range(SHEETS_THROTTLE_MAX_RETRIES + 1):
+            try:
+                self.acquire(priority)
+            except SheetsQuotaExceeded:
+                # Запрос не отправлялся; пробный запрос нужно будет повторить
+                self._release_probe()
+                raise
+            try:
+                result = func()
+                self._record_result()
+                return result
+            except gspread.exceptions.APIError as e:
+                response = getattr(e, "response", None)
+                status_code = response.status_code if response is not None else None
+                if status_code is not None and status_code < 500 and status_code != 429:
+                    # Ошибка запроса (404, 400...) - сервис доступен
+                    self._record_result()
+                    raise
+                if status_code != 429 or attempt == SHEETS_THROTTLE_MAX_RETRIES:
+                    self._record_result(e)
+                    raise
+                try:
+                    retry_after = float(response.headers.get("Retry-After", ""))
+                except ValueError:
+                    retry_after = SHEETS_THROTTLE_BACKOFF * (2 ** attempt)
+                logger.warning(f"⚠️ Квота Google Sheets исчерпана (429), пауза {retry_after:.0f} с (попытка {attempt + 1}/{SHEETS_THROTTLE_MAX_RETRIES})")
+                self.throttle(retry_after)
+            except (TransportError, ConnectionError, Timeout, RequestException) as e:
+                self._record_result(e)
+                raise
+            except Exception as e:
+                # Любая другая ошибка (RefreshError, некорректный ответ...) тоже считается сбоем,
+                # иначе пробный запрос навсегда оставил бы выключатель в состоянии half_open
+                self._record_result(e)
+                raise
+
+    def _release_probe(self):
+        with self.condition:
+            if self.breaker_state == "half_open":
+                self.breaker_state = "open"
+
+# Клиент gspread, все запросы которого проходят через шлюз
+class QuotaAwareClient(gspread.Client):
+    def request(self, method, endpoint, params=None, data=None, json=None, files=None, headers=None):
+        key = f"{endpoint}?{params!r}" if method == "get" else None
+        return sheets_gateway.call(
+            lambda: gspread.Client.request(self, method, endpoint, params=params, data=data, json=json, files=files, headers=headers),
+            key=key
+        )
+
+sheets_gateway = SheetsGateway(GOOGLE_SHEETS_QUOTA_PER_MINUTE)
+sheets_gateway_context = threading.local()  # Приоритет запросов к Google Sheets в текущем потоке
+
+# Приоритет запросов к Google Sheets в текущем потоке (по умолчанию - интерактивный)
+def get_sheets_priority():
+    return getattr(sheets_gateway_context, "priority", SHEETS_PRIORITY_INTERACTIVE)
+
+def set_sheets_priority(priority):
+    sheets_gateway_context.priority = priority
+
+# === ВЫБОР ВЕДУЩЕГО ПРОЦЕССА ===
+# Получение или продление аренды роли
+def acquire_worker_lease(name, ttl=LEADER_LEASE_TTL):
+    """
+    Одним запросом получает свободную или просроченную аренду либо продлевает свою.
+    Возвращает время окончания аренды, 0, если ее удерживает другой процесс,
+    или None, если база данных недоступна (аренда при этом не теряется).
+    """
+    conn = get_connection()
+    if not conn:
+        logger.error(f"❌ Невозможно продлить аренду {name}: база данных недоступна")
+        return None
+    now = time.time()
+    expires_at = now + ttl
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO worker_leases (name, holder, acquired_at, expires_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                holder = excluded.holder,
+                acquired_at = CASE WHEN worker_leases.holder = excluded.holder
+                                   THEN worker_leases.acquired_at ELSE excluded.acquired_at END,
+                expires_at = excluded.expires_at
+            WHERE worker_leases.holder = excluded.holder OR worker_leases.expires_at < ?
+        ''', (name, process_instance_id, now, expires_at, now))
+        conn.commit()
+        return expires_at if cursor.rowcount > 0 else 0
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка продления аренды {name}: {e}")
+        return None
+    finally:
+        conn.close()
+
+# Освобождение аренды при завершении работы
+def release_worker_lease(name):
+    """Снимает свою аренду, чтобы другой процесс забрал роль без ожидания LEADER_LEASE_TTL"""
+    conn = get_connection()
+    if not conn:
+        return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM worker_leases WHERE name = ? AND holder = ?", (name, process_instance_id))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка освобождения аренды {name}: {e}")
+        return False
+    finally:
+        conn.close()
+
+# Является ли процесс ведущим (выполняет напоминания и синхронизацию листа мастер-классов)
+def is_background_leader():
+    return time.time() < background_leader_until
+
+# Фоновый поток выбора ведущего процесса
+def leader_election_worker():
+    """
+    Каждые LEADER_HEARTBEAT_INTERVAL секунд пробует получить или продлить аренду BACKGROUND_LEASE_NAME.
+    Ведущим процесс считает себя на LEADER_HEARTBEAT_INTERVAL меньше срока аренды в базе,
+    поэтому перестает работать раньше, чем роль сможет забрать другой процесс.
+    Временная ошибка базы данных роль не снимает: она истечет сама, если аренду не удастся продлить.
+    """
+    global background_leader_until
+    while leader_election_running:
+        was_leader = is_background_leader()
+        expires_at = acquire_worker_lease(BACKGROUND_LEASE_NAME)
+        if expires_at is None:
+            if was_leader:
+                logger.warning(f"⚠️ Не удалось продлить аренду ведущего процесса {process_instance_id}, повтор через {LEADER_HEARTBEAT_INTERVAL} с")
+        elif expires_at:
+            background_leader_until = expires_at - LEADER_HEARTBEAT_INTERVAL
+            if not was_leader:
+                logger.info(f"👑 Процесс {process_instance_id} стал ведущим: напоминания и синхронизация Google Sheets выполняются здесь")
+                background_takeover_pending.set()
+                reminder_worker_wakeup.set()
+        else:
+            background_leader_until = 0
+            if was_leader:
+                logger.warning(f"⚠️ Процесс {process_instance_id} больше не ведущий: аренда перешла другому процессу")
+        time.sleep(LEADER_HEARTBEAT_INTERVAL)
+
+# Есть ли в базе изменения мастер-классов, не выгруженные на лист (в том числе сделанные другими процессами)
+def has_unsynced_master_classes():
+    conn = get_connection()
+    if not conn:
+        return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM master_classes WHERE dirty = 1 OR deleted = 1 LIMIT 1")
+        return cursor.fetchone() is not None
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка проверки невыгруженных мастер-классов: {e}")
+        return False
+    finally:
+        conn.close()
 
 # Фоновый поток для работы с Google Sheets
 def sheets_worker():
     """Фоновый поток для асинхронной работы с Google Sheets"""
+    last_unsynced_check = 0
+    last_outbox_poll = 0
     while sheets_worker_running:
         try:
+            if time.time() - sheets_http_stats_last_log > GOOGLE_SHEETS_STATS_INTERVAL:
+                log_sheets_connection_stats()
+            # В режиме деградации задачи остаются в очередях до пробного запроса
+            breaker_state = sheets_gateway.state()
+            if breaker_state == "open":
+                time.sleep(1)
+                continue
+            # Синхронизируем мастер-классы с листом (по запросу, раз в MASTERS_MIRROR_INTERVAL
+            # или как пробный запрос после деградации) - только в ведущем процессе.
+            # Изменения, сделанные в других процессах, видны по флагу dirty в базе
+            local_changes = masters_mirror_requested.is_set()
+            leader = is_background_leader()
+            if leader and not local_changes and time.time() - last_unsynced_check > LEADER_HEARTBEAT_INTERVAL:
+                last_unsynced_check = time.time()
+                local_changes = has_unsynced_master_classes()
+            if leader and (local_changes or breaker_state == "half_open" or time.time() - masters_mirror_last_run > MASTERS_MIRROR_INTERVAL):
+                masters_mirror_requested.clear()
+                # Изменения из бота выгружаются в первую очередь, плановая сверка - в фоне
+                set_sheets_priority(SHEETS_PRIORITY_INTERACTIVE if local_changes else SHEETS_PRIORITY_BACKGROUND)
+                sync_master_classes_with_sheets(local_changes=local_changes)
+                if not sheets_gateway.is_available():
+                    continue
+            # Задачи, оставленные процессами без фонового потока
+            if time.time() - last_outbox_poll > SHEETS_OUTBOX_POLL_INTERVAL:
+                last_outbox_poll = time.time()
+                drain_sheets_outbox()
+            # Журнал записей и групповые операции - фоновые запросы
+            set_sheets_priority(SHEETS_PRIORITY_BACKGROUND)
+            run_pending_sheets_jobs()
             # Ждем задачу из очереди с таймаутом
             priority_task = sheets_queue.get(timeout=1.0)
             # Извлекаем данные задачи (приоритет, данные)
@@ -441,141 +1094,25 @@ def sheets_worker():
                 logger.error(f"❌ Неверный формат задачи в очереди: {task}")
                 sheets_queue.task_done()
                 continue
-            reg_id, full_name, position_id, event_date, event_time, action, status = task
-            # Пытаемся выполнить операцию с повторными попытками
-            for attempt in range(MAX_RETRY_ATTEMPTS):
+            # Автомат разомкнулся, пока задача ждала в очереди - возвращаем ее обратно
+            if not sheets_gateway.is_available():
+                sheets_queue.task_done()
                 try:
-                    if google_sheet is None or not google_sheets_enabled:
-                        logger.warning("Google Sheets недоступен при попытке сохранения")
-                        break
-                    position_name = masters_data.get(position_id, {}).get("name", position_id)
-                    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    # Обновляем статус записи
-                    update_registration_status_in_sheets(reg_id, status)
-                    # Получаем дополнительные данные о регистрации
-                    conn = get_connection()
-                    reg_details = None
-                    if conn:
-                        try:
-                            cursor = conn.cursor()
-                            cursor.execute('''
-                                SELECT user_id, telegram_verified, family_member, family_account_holder_id
-                                FROM registrations WHERE id = ?
-                            ''', (reg_id,))
-                            reg_details = cursor.fetchone()
-                        except Exception as e:
-                            logger.error(f"❌ Ошибка получения данных регистрации для Google Sheets: {e}")
-                        finally:
-                            conn.close()
-
-                    # Маскируем чувствительные данные для Google Sheets
-                    masked_name = mask_full_name(full_name)
-                    masked_telegram_id = mask_telegram_id(reg_details[0] if reg_details else 0)
-                    telegram_verified_status = "✅" if (reg_details and reg_details[1]) else "❌"
-                    family_member_status = "Да" if (reg_details and reg_details[2]) else "Нет"
-                    family_holder_id = str(reg_details[3]) if (reg_details and reg_details[3]) else ""
-
-                    # Для каждого участника поддерживаем ТОЛЬКО ОДНУ текущую строку
-                    # Ищем существующую строку по имени участника
-                    existing_row = None
-                    participant_key = masked_name  # Используем маскированное имя как ключ
-
-                    try:
-                        # Ищем все строки с таким именем участника
-                        name_cells = google_sheet.findall(masked_name, in_column=2)  # Колонка "ФИО (защищено)"
-                        if name_cells:
-                            # Берем самую последнюю строку для этого участника
-                            existing_row = max(cell.row for cell in name_cells)
-                            logger.debug(f"📝 Найдена существующая строка участника {masked_name}: строка {existing_row}")
-                    except Exception as search_error:
-                        logger.warning(f"⚠️ Не удалось найти существующую строку участника: {search_error}")
-
-                    if existing_row and existing_row > 1:  # Убеждаемся, что это не заголовок
-                        # Обновляем существующую строку участника
-                        try:
-                            google_sheet.update_cell(existing_row, 1, str(reg_id))     # ID (последняя регистрация)
-                            google_sheet.update_cell(existing_row, 3, masked_telegram_id)  # Telegram ID (на случай изменений)
-                            google_sheet.update_cell(existing_row, 4, telegram_verified_status)  # Верификация
-                            google_sheet.update_cell(existing_row, 5, position_name)  # Мастер-класс
-                            google_sheet.update_cell(existing_row, 6, event_date)    # Дата
-                            google_sheet.update_cell(existing_row, 7, event_time)    # Время
-                            google_sheet.update_cell(existing_row, 8, family_member_status)  # Семейный участник
-                            google_sheet.update_cell(existing_row, 9, family_holder_id)  # ID владельца семьи
-                            google_sheet.update_cell(existing_row, 10, action)       # Действие
-                            google_sheet.update_cell(existing_row, 11, status)       # Статус
-                            google_sheet.update_cell(existing_row, 12, timestamp)    # Время изменения
-                            logger.info(f"✅ Участник {masked_name} обновлен в Google Sheets ({action}, {status})")
-                        except Exception as update_error:
-                            logger.error(f"❌ Ошибка обновления строки участника: {update_error}")
-                            # Если обновление не удалось, создаем новую строку
-                            existing_row = None
-
-                    if not existing_row:
-                        # Находим следующую пустую строку для добавления нового участника
-                        try:
-                            # Получаем все значения в колонке A (ID) для поиска последней заполненной строки
-                            col_a_values = google_sheet.col_values(1)  # Колонка A (ID)
-                            # Находим первую пустую строку после заголовка
-                            next_row = len(col_a_values) + 1
-                            # Убеждаемся, что начинаем минимум со строки 2 (после заголовка)
-                            next_row = max(next_row, 2)
-
-                            # Проверяем, что строка действительно пустая
-                            while next_row <= len(col_a_values) + 10:  # Проверяем следующие 10 строк
-                                try:
-                                    cell_value = google_sheet.cell(next_row, 1).value
-                                    if not cell_value or str(cell_value).strip() == "":
-                                        break  # Нашли пустую строку
-                                    next_row += 1
-                                except:
-                                    break  # Если ошибка чтения, используем эту строку
-
-                            # Записываем данные в найденную строку
-                            google_sheet.update_cell(next_row, 1, str(reg_id))
-                            google_sheet.update_cell(next_row, 2, masked_name)
-                            google_sheet.update_cell(next_row, 3, masked_telegram_id)
-                            google_sheet.update_cell(next_row, 4, telegram_verified_status)
-                            google_sheet.update_cell(next_row, 5, position_name)
-                            google_sheet.update_cell(next_row, 6, event_date)
-                            google_sheet.update_cell(next_row, 7, event_time)
-                            google_sheet.update_cell(next_row, 8, family_member_status)
-                            google_sheet.update_cell(next_row, 9, family_holder_id)
-                            google_sheet.update_cell(next_row, 10, action)
-                            google_sheet.update_cell(next_row, 11, status)
-                            google_sheet.update_cell(next_row, 12, timestamp)
-
-                            logger.info(f"✅ Новый участник {masked_name} добавлен в Google Sheets (строка {next_row}, {action}, {status})")
-                        except Exception as insert_error:
-                            logger.error(f"❌ Ошибка при вставке новой строки: {insert_error}")
-                            # Fallback: используем append_row как резервный вариант
-                            try:
-                                google_sheet.append_row([
-                        str(reg_id),
-                        masked_name,
-                        masked_telegram_id,
-                        telegram_verified_status,
-                        position_name,
-                        event_date,
-                        event_time,
-                        family_member_status,
-                        family_holder_id,
-                        action,
-                        status,
-                        timestamp
-                    ])
-                                logger.info(f"✅ Новый участник {masked_name} добавлен в Google Sheets (append_row fallback, {action}, {status})")
-                            except Exception as fallback_error:
-                                logger.error(f"❌ Ошибка и в резервном методе добавления: {fallback_error}")
-                    break  # Успешное выполнение - выходим из цикла попыток
-                except (TransportError, ConnectionError, Timeout) as e:
-                    logger.warning(f"⚠️ Попытка {attempt + 1}/{MAX_RETRY_ATTEMPTS} не удалась: {e}")
-                    if attempt < MAX_RETRY_ATTEMPTS - 1:
-                        time.sleep(RETRY_DELAY * (attempt + 1))  # Экспоненциальная задержка
-                except Exception as e:
-                    logger.error(f"❌ Ошибка при сохранении в Google Sheets: {e}")
-                    break
+                    sheets_queue.put_nowait(priority_task)
+                except queue.Full:
+                    logger.warning(f"⚠️ Очередь Google Sheets переполнена, задача для записи {task[0]} пропущена")
+                continue
+            reg_id = task[0]
+            process_sheets_registration_task(task)
             # Подтверждаем выполнение задачи
             sheets_queue.task_done()
+            # Если во время задачи включился режим деградации, повторим ее после восстановления
+            # (строка участника ищется по имени, поэтому повтор не создает дубликатов)
+            if not sheets_gateway.is_available():
+                try:
+                    sheets_queue.put_nowait(priority_task)
+                except queue.Full:
+                    logger.warning(f"⚠️ Очередь Google Sheets переполнена, задача для записи {reg_id} пропущена")
         except queue.Empty:
             # Нет задач в очереди - продолжаем ожидание
             continue  
@@ -588,6 +1125,149 @@ def sheets_worker():
             # Вместо завершения потока, ждем немного и продолжаем
             time.sleep(5)  # Пауза перед продолжением работы
 
+# Запись строки участника в журнал записей Google Sheets (одна строка на участника)
+def write_registration_to_sheets(reg_id, full_name, position_id, event_date, event_time, action, status):
+    position_name = masters_data.get(position_id, {}).get("name", position_id)
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # Обновляем статус записи
+    update_registration_status_in_sheets(reg_id, status)
+    # Получаем дополнительные данные о регистрации
+    conn = get_connection()
+    reg_details = None
+    if conn:
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT user_id, telegram_verified, family_member, family_account_holder_id
+                FROM registrations WHERE id = ?
+            ''', (reg_id,))
+            reg_details = cursor.fetchone()
+        except Exception as e:
+            logger.error(f"❌ Ошибка получения данных регистрации для Google Sheets: {e}")
+        finally:
+            conn.close()
+
+    # Маскируем чувствительные данные для Google Sheets
+    masked_name = mask_full_name(full_name)
+    masked_telegram_id = mask_telegram_id(reg_details[0] if reg_details else 0)
+    telegram_verified_status = "✅" if (reg_details and reg_details[1]) else "❌"
+    family_member_status = "Да" if (reg_details and reg_details[2]) else "Нет"
+    family_holder_id = str(reg_details[3]) if (reg_details and reg_details[3]) else ""
+
+    # Для каждого участника поддерживаем ТОЛЬКО ОДНУ текущую строку
+    # Ищем существующую строку по имени участника
+    existing_row = None
+    participant_key = masked_name  # Используем маскированное имя как ключ
+
+    try:
+        # Ищем все строки с таким именем участника
+        name_cells = google_sheet.findall(masked_name, in_column=2)  # Колонка "ФИО (защищено)"
+        if name_cells:
+            # Берем самую последнюю строку для этого участника
+            existing_row = max(cell.row for cell in name_cells)
+            logger.debug(f"📝 Найдена существующая строка участника {masked_name}: строка {existing_row}")
+    except Exception as search_error:
+        logger.warning(f"⚠️ Не удалось найти существующую строку участника: {search_error}")
+
+    if existing_row and existing_row > 1:  # Убеждаемся, что это не заголовок
+        # Обновляем существующую строку участника
+        try:
+            google_sheet.update_cell(existing_row, 1, str(reg_id))     # ID (последняя регистрация)
+            google_sheet.update_cell(existing_row, 3, masked_telegram_id)  # Telegram ID (на случай изменений)
+            google_sheet.update_cell(existing_row, 4, telegram_verified_status)  # Верификация
+            google_sheet.update_cell(existing_row, 5, position_name)  # Мастер-класс
+            google_sheet.update_cell(existing_row, 6, event_date)    # Дата
+            google_sheet.update_cell(existing_row, 7, event_time)    # Время
+            google_sheet.update_cell(existing_row, 8, family_member_status)  # Семейный участник
+            google_sheet.update_cell(existing_row, 9, family_holder_id)  # ID владельца семьи
+            google_sheet.update_cell(existing_row, 10, action)       # Действие
+            google_sheet.update_cell(existing_row, 11, status)       # Статус
+            google_sheet.update_cell(existing_row, 12, timestamp)    # Время изменения
+            logger.info(f"✅ Участник {masked_name} обновлен в Google Sheets ({action}, {status})")
+        except Exception as update_error:
+            logger.error(f"❌ Ошибка обновления строки участника: {update_error}")
+            # Если обновление не удалось, создаем новую строку
+            existing_row = None
+
+    if not existing_row:
+        # Находим следующую пустую строку для добавления нового участника
+        try:
+            # Получаем все значения в колонке A (ID) для поиска последней заполненной строки
+            col_a_values = google_sheet.col_values(1)  # Колонка A (ID)
+            # Находим первую пустую строку после заголовка
+            next_row = len(col_a_values) + 1
+            # Убеждаемся, что начинаем минимум со строки 2 (после заголовка)
+            next_row = max(next_row, 2)
+
+            # Проверяем, что строка действительно пустая
+            while next_row <= len(col_a_values) + 10:  # Проверяем следующие 10 строк
+                try:
+                    cell_value = google_sheet.cell(next_row, 1).value
+                    if not cell_value or str(cell_value).strip() == "":
+                        break  # Нашли пустую строку
+                    next_row += 1
+                except:
+                    break  # Если ошибка чтения, используем эту строку
+
+            # Записываем данные в найденную строку
+            google_sheet.update_cell(next_row, 1, str(reg_id))
+            google_sheet.update_cell(next_row, 2, masked_name)
+            google_sheet.update_cell(next_row, 3, masked_telegram_id)
+            google_sheet.update_cell(next_row, 4, telegram_verified_status)
+            google_sheet.update_cell(next_row, 5, position_name)
+            google_sheet.update_cell(next_row, 6, event_date)
+            google_sheet.update_cell(next_row, 7, event_time)
+            google_sheet.update_cell(next_row, 8, family_member_status)
+            google_sheet.update_cell(next_row, 9, family_holder_id)
+            google_sheet.update_cell(next_row, 10, action)
+            google_sheet.update_cell(next_row, 11, status)
+            google_sheet.update_cell(next_row, 12, timestamp)
+
+            logger.info(f"✅ Новый участник {masked_name} добавлен в Google Sheets (строка {next_row}, {action}, {status})")
+        except Exception as insert_error:
+            logger.error(f"❌ Ошибка при вставке новой строки: {insert_error}")
+            # Fallback: используем append_row как резервный вариант
+            try:
+                google_sheet.append_row([
+        str(reg_id),
+        masked_name,
+        masked_telegram_id,
+        telegram_verified_status,
+        position_name,
+        event_date,
+        event_time,
+        family_member_status,
+        family_holder_id,
+        action,
+        status,
+        timestamp
+    ])
+                logger.info(f"✅ Новый участник {masked_name} добавлен в Google Sheets (append_row fallback, {action}, {status})")
+            except Exception as fallback_error:
+                logger.error(f"❌ Ошибка и в резервном методе добавления: {fallback_error}")
+
+# Выполнение задачи журнала записей с повторными попытками
+def process_sheets_registration_task(task):
+    """Записывает задачу (reg_id, full_name, position_id, event_date, event_time, action, status) в Google Sheets"""
+    reg_id, full_name, position_id, event_date, event_time, action, status = task
+    # Пытаемся выполнить операцию с повторными попытками
+    for attempt in range(MAX_RETRY_ATTEMPTS):
+        try:
+            if google_sheet is None or not google_sheets_enabled:
+                logger.warning("Google Sheets недоступен при попытке сохранения")
+                break
+            write_registration_to_sheets(reg_id, full_name, position_id, event_date, event_time, action, status)
+            break  # Успешное выполнение - выходим из цикла попыток
+        except SheetsUnavailable:
+            break
+        except (TransportError, ConnectionError, Timeout) as e:
+            logger.warning(f"⚠️ Попытка {attempt + 1}/{MAX_RETRY_ATTEMPTS} не удалась: {e}")
+            if attempt < MAX_RETRY_ATTEMPTS - 1 and sheets_gateway.is_available():
+                time.sleep(RETRY_DELAY * (attempt + 1))  # Экспоненциальная задержка
+        except Exception as e:
+            logger.error(f"❌ Ошибка при сохранении в Google Sheets: {e}")
+            break
+
 # Обновление статуса записи в Google Sheets
 def update_registration_status_in_sheets(reg_id, new_status):
     """Обновляет статус конкретной записи в Google Sheets"""
@@ -605,9 +1285,77 @@ def update_registration_status_in_sheets(reg_id, new_status):
         logger.error(f"❌ Ошибка при обновлении статуса в Google Sheets: {e}")
         return False
 
+# Групповое обновление действия и статуса записей в Google Sheets
+def bulk_update_registrations_in_sheets(reg_ids, action, new_status):
+    """Обновляет колонки "Действие", "Статус" и "Время изменения" для набора записей одним запросом"""
+    if not google_sheets_enabled or not google_sheet or not reg_ids:
+        return 0
+    try:
+        wanted = {str(reg_id) for reg_id in reg_ids}
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # Одно чтение колонки ID вместо поиска каждой записи
+        id_column = google_sheet.col_values(1)
+        updates = [
+            {"range": f"J{row}:L{row}", "values": [[action, new_status, timestamp]]}
+            for row, value in enumerate(id_column, start=1)
+            if row > 1 and str(value).strip() in wanted
+        ]
+        if updates:
+            google_sheet.batch_update(updates)
+        logger.info(f"🔄 Обновлено {len(updates)} записей в Google Sheets ({action}, {new_status})")
+        return len(updates)
+    except Exception as e:
+        logger.error(f"❌ Ошибка группового обновления записей в Google Sheets: {e}")
+        return 0
+
+# Статистика переиспользования соединений с Google API
+def get_sheets_connection_stats():
+    """Возвращает (запросов, открыто соединений) по пулам HTTP-адаптера gspread"""
+    if not sheets_http_adapter:
+        return 0, 0
+    requests_count = connections_count = 0
+    pools = sheets_http_adapter.poolmanager.pools
+    for key in list(pools.keys()):
+        pool = pools.get(key)
+        if pool is not None:
+            requests_count += pool.num_requests
+            connections_count += pool.num_connections
+    return requests_count, connections_count
+
+# Вывод статистики соединений в лог (вызывается из sheets_worker)
+def log_sheets_connection_stats():
+    global sheets_http_stats_last_log
+    sheets_http_stats_last_log = time.time()
+    requests_count, connections_count = get_sheets_connection_stats()
+    if requests_count:
+        reused = requests_count - connections_count
+        logger.info(f"🔌 Соединения с Google API: запросов {requests_count}, открыто соединений {connections_count}, "
+                    f"переиспользовано {reused} ({reused * 100 // requests_count}%)")
+    stats = sheets_gateway.stats
+    if stats["calls"] or stats["rejected"] or stats["short_circuited"]:
+        logger.info(f"🚦 Квота Google Sheets: запросов {stats['calls']}, ожиданий {stats['waits']} ({stats['wait_seconds']:.0f} с), "
+                    f"отклонено {stats['rejected']}, ответов 429 {stats['throttled']}, объединено чтений {stats['coalesced']}, "
+                    f"ошибок {stats['failures']}, режим деградации включался {stats['breaker_opened']} раз, "
+                    f"отклонено без запроса {stats['short_circuited']}")
+
+# Строка состояния Google Sheets для админ-панели
+def get_google_sheets_status_text():
+    if not has_local_sheets_worker():
+        return f"📊 Google Sheets: синхронизирует фоновый процесс (в очереди: {count_sheets_outbox()})"
+    if not google_sheets_enabled:
+        return "📊 Google Sheets: отключен"
+    state = sheets_gateway.state()
+    if state == "closed":
+        return "📊 Google Sheets: ✅ работает"
+    pending = sheets_queue.qsize() + sheets_jobs_queue.qsize()
+    if state == "half_open":
+        return f"📊 Google Sheets: ⚠️ режим деградации, идет проверка связи (ожидает задач: {pending})"
+    return (f"📊 Google Sheets: ⚠️ режим деградации, проверка связи через {sheets_gateway.seconds_until_probe():.0f} с "
+            f"(ожидает задач: {pending}). Запись и изменения сохраняются в базе данных")
+
 # Инициализация Google Sheets с двумя листами
 def init_google_sheets():
-    global google_sheet, masters_sheet, google_sheets_enabled, google_sheets_initialized, masters_data, previous_masters_data
+    global google_sheet, masters_sheet, google_sheets_enabled, google_sheets_initialized, masters_data, previous_masters_data, sheets_http_adapter
     if google_sheets_initialized:
         return google_sheets_enabled
     try:
@@ -628,26 +1376,27 @@ def init_google_sheets():
             return False
 
         try:
-            # Настраиваем HTTP клиент с таймаутом
-            import requests
+            # Настраиваем авторизованный HTTP клиент с пулом keep-alive соединений
+            from google.auth.transport.requests import AuthorizedSession
             from requests.adapters import HTTPAdapter
             from urllib3.util.retry import Retry
 
-            # Создаем сессию с таймаутами и повторными попытками
-            session = requests.Session()
+            # AuthorizedSession сама добавляет и обновляет токен, поэтому пул и повторные
+            # попытки настраиваются на ней, а не на отдельной requests.Session
+            session = AuthorizedSession(creds)
+            # 429 обрабатывает шлюз квоты (sheets_gateway), чтобы пауза была общей для всех потоков
             retry = Retry(
                 total=3,
                 backoff_factor=0.5,
-                status_forcelist=[429, 500, 502, 503, 504]
+                status_forcelist=[500, 502, 503, 504]
             )
-            adapter = HTTPAdapter(max_retries=retry)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=GOOGLE_SHEETS_POOL_SIZE, max_retries=retry)
             session.mount('https://', adapter)
-            session.mount('http://', adapter)
 
-            # Используем сессию для авторизации gspread
-            client = gspread.authorize(creds)
-            # Устанавливаем таймаут для всех запросов клиента
-            client.session = session
+            client = QuotaAwareClient(auth=creds, session=session)
+            # Таймаут для всех запросов клиента
+            client.set_timeout(GOOGLE_SHEETS_TIMEOUT)
+            sheets_http_adapter = adapter
         except Exception as client_error:
             logger.error(f"❌ Ошибка авторизации клиента Google Sheets: {client_error}")
             google_sheets_enabled = False
@@ -704,16 +1453,16 @@ def init_google_sheets():
             try:
                 masters_sheet = spreadsheet.add_worksheet(title="Мастер-классы", rows="100", cols="15")
                 # Создаем заголовки для мастер-классов
-                masters_headers = ["ID", "Название", "Свободных мест", "Всего мест", "Записано", "Дата начала", "Дата окончания", "Время начала", "Время окончания", "Доступен для записи", "Исключить выходные", "Описание"]
-                masters_sheet.insert_row(masters_headers, 1)
+                masters_sheet.insert_row(MASTERS_SHEET_HEADERS, 1)
             except Exception as create_error:
                 logger.error(f"❌ Не удалось создать лист мастер-классов: {create_error}")
                 logger.error("Проверьте права сервисного аккаунта Google на создание листов")
                 google_sheets_enabled = False
                 google_sheets_initialized = True
                 return False
-            # Добавляем примеры мастер-классов
-            example_classes = [
+            # Добавляем примеры мастер-классов, если в базе данных их еще нет
+            # (иначе лист заполнится из базы при первой синхронизации)
+            example_classes = [] if count_master_classes() else [
                 ["MC001", "💻 Программирование на Python", "20", "20", "0", "2025-12-01", "2026-01-31", "10:00", "12:00", "да", "нет", "Основы Python для начинающих"],
                 ["MC002", "🎨 Графический дизайн", "15", "15", "0", "2025-12-05", "2026-01-25", "13:00", "15:00", "да", "нет", "Создание визуального контента в Figma"],
                 ["MC003", "📊 Бизнес-аналитика", "25", "25", "0", "2025-12-10", "2026-01-20", "16:00", "18:00", "да", "нет", "Анализ данных и визуализация"]
@@ -732,210 +1481,585 @@ def init_google_sheets():
         logger.error(f"❌ Критическая ошибка подключения к Google Sheets: {e}")
         google_sheets_enabled = False
         google_sheets_initialized = True
-        # При ошибке подключения используем временные данные
-        with masters_data_lock:
-            masters_data = {}
-            for i in range(1, 4):
-                master_id = f"MC{i:03d}"
-                masters_data[master_id] = {
-                    "id": master_id,
-                    "name": f"Мастер-класс {i}",
-                    "free_spots": 20,
-                    "total_spots": 20,
-                    "booked": 0,
-                    "date_start": "2025-12-01",
-                    "date_end": "2026-01-31",
-                    "time_start": "10:00",
-                    "time_end": "12:00",
-                    "available": True,
-                    "description": f"Описание мастер-класса {i}",
-                    "specific_slots": {}  # Format: {"YYYY-MM-DD": {"start": "HH:MM", "end": "HH:MM"}}
-                }
-        masters_last_update = time.time()
+        # При ошибке подключения работаем с мастер-классами из базы данных
+        load_masters_data()
         previous_masters_data = masters_data.copy()
         return False
 
+# Временные данные о мастер-классах, если в базе данных их нет
+def get_placeholder_masters_data():
+    placeholders = {}
+    for i in range(1, 4):
+        master_id = f"MC{i:03d}"
+        placeholders[master_id] = {
+            "id": master_id,
+            "name": f"Мастер-класс {i}",
+            "free_spots": 20,
+            "total_spots": 20,
+            "booked": 0,
+            "date_start": "2025-12-01",
+            "date_end": "2026-01-31",
+            "time_start": "10:00",
+            "time_end": "12:00",
+            "available": True,
+            "enabled": True,
+            "exclude_weekends": False,
+            "description": f"Описание мастер-класса {i}",
+            "specific_slots": {}  # Format: {"YYYY-MM-DD": {"start": "HH:MM", "end": "HH:MM"}}
+        }
+    return placeholders
+
 # Загрузка данных о мастер-классах
 def load_masters_data():
-    """Загружает данные о мастер-классах из Google Sheets в кэш"""
+    """
+    Загружает данные о мастер-классах из таблицы master_classes в кэш.
+    Количество записанных считается по активным записям, Google Sheets не запрашивается.
+    """
     global masters_data, masters_last_update
-    if not masters_sheet:
-        logger.warning("Мастер-классы недоступны - лист не инициализирован")
-        # Используем временные данные, если Google Sheets недоступен
+    # Первый запуск после перехода на базу данных: переносим мастер-классы с листа
+    if masters_sheet and google_sheets_enabled and count_master_classes() == 0:
+        sync_master_classes_with_sheets(reload_cache=False)
+
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Невозможно загрузить мастер-классы: база данных недоступна")
         with masters_data_lock:
-            masters_data = {}
-            for i in range(1, 4):
-                master_id = f"MC{i:03d}"
-                masters_data[master_id] = {
-                    "id": master_id,
-                    "name": f"Мастер-класс {i}",
-                    "free_spots": 20,
-                    "total_spots": 20,
-                    "booked": 0,
-                    "date_start": "2025-12-01",
-                    "date_end": "2026-01-31",
-                    "time_start": "10:00",
-                    "time_end": "12:00",
-                    "available": True,
-                    "exclude_weekends": False,
-                    "description": f"Описание мастер-класса {i}",
-                    "specific_slots": {}  # Format: {"YYYY-MM-DD": {"start": "HH:MM", "end": "HH:MM"}}
-                }
+            if not masters_data:
+                masters_data = get_placeholder_masters_data()
+        invalidate_masters_schedule()
         masters_last_update = time.time()
-        return True
+        return False
+
     try:
-        # Получаем все данные из листа
-        all_records = masters_sheet.get_all_records()
-        with masters_data_lock:
-            masters_data = {}
-        current_date = datetime.now(MOSCOW_TZ).date()
-        for record in all_records:
-            # Пропускаем пустые или неактивные мастер-классы
-            if not record.get("ID") or not record.get("Название"):
-                continue
-            master_id = record["ID"]
-            master_name = record["Название"]
-            description = record.get("Описание", "")
-            # Проверяем количество мест
-            try:
-                total_spots = int(record.get("Всего мест", 20))
-                booked = int(record.get("Записано", 0))
-                free_spots = total_spots - booked
-            except (ValueError, TypeError):
-                total_spots = 20
-                booked = 0
-                free_spots = 20
-            # Проверяем дату проведения
-            try:
-                date_start_str = record.get("Дата начала", "2025-12-01")
-                date_end_str = record.get("Дата окончания", "2026-01-31")
-                date_start = datetime.strptime(date_start_str, "%Y-%m-%d").date()
-                date_end = datetime.strptime(date_end_str, "%Y-%m-%d").date()
-            except (ValueError, TypeError):
-                date_start = datetime(2025, 12, 1).date()
-                date_end = datetime(2026, 1, 31).date()
-            # Проверяем время проведения
-            time_start = record.get("Время начала", "10:00")
-            time_end = record.get("Время окончания", "12:00")
-            # Проверяем доступность
-            available = record.get("Доступен для записи", "да").lower() == "да" and free_spots > 0
-            # Проверяем исключение выходных
-            exclude_weekends = record.get("Исключить выходные", "нет").lower() == "да"
-            with masters_data_lock:
-                masters_data[master_id] = {
-                    "id": master_id,
-                    "name": master_name,
-                    "free_spots": free_spots,
-                    "total_spots": total_spots,
-                    "booked": booked,
-                    "date_start": date_start_str,
-                    "date_end": date_end_str,
-                    "time_start": time_start,
-                    "time_end": time_end,
-                    "available": available,
-                    "exclude_weekends": exclude_weekends,
-                    "description": description,
-                    "specific_slots": {}  # Format: {"YYYY-MM-DD": {"start": "HH:MM", "end": "HH:MM"}}
-                }
-        masters_last_update = time.time()
-        logger.info(f"✅ Загружено {len(masters_data)} доступных мастер-классов")
-        # Если нет данных из Google Sheets, используем временные данные
-        if not masters_data:
-            with masters_data_lock:
-                masters_data = {}
-                for i in range(1, 4):
-                    master_id = f"MC{i:03d}"
-                    masters_data[master_id] = {
-                        "id": master_id,
-                        "name": f"Мастер-класс {i}",
-                        "free_spots": 20,
-                        "total_spots": 20,
-                        "booked": 0,
-                        "date_start": "2025-12-01",
-                        "date_end": "2026-01-31",
-                        "time_start": "10:00",
-                        "time_end": "12:00",
-                        "available": True,
-                        "exclude_weekends": False,
-                        "description": f"Описание мастер-класса {i}"
-                    }
-        return True
-    except Exception as e:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT mc.id, mc.name, mc.description, mc.total_spots, mc.date_start, mc.date_end,
+                   mc.time_start, mc.time_end, mc.available, mc.exclude_weekends, mc.specific_slots,
+                   COALESCE(b.booked, 0)
+            FROM master_classes mc
+            LEFT JOIN (
+                SELECT position, COUNT(*) AS booked FROM registrations
+                WHERE status IN ('создана', 'перенесена')
+                GROUP BY position
+            ) b ON b.position = mc.id
+            WHERE mc.deleted = 0
+            ORDER BY mc.id
+        ''')
+        rows = cursor.fetchall()
+    except sqlite3.Error as e:
         logger.error(f"❌ Ошибка загрузки данных о мастер-классах: {e}")
-        # При ошибке используем временные данные
-        with masters_data_lock:
-            masters_data = {}
-            for i in range(1, 4):
-                master_id = f"MC{i:03d}"
-                masters_data[master_id] = {
-                    "id": master_id,
-                    "name": f"Мастер-класс {i}",
-                    "free_spots": 20,
-                    "total_spots": 20,
-                    "booked": 0,
-                    "date_start": "2025-12-01",
-                    "date_end": "2026-01-31",
-                    "time_start": "10:00",
-                    "time_end": "12:00",
-                    "available": True,
-                    "exclude_weekends": False,
-                    "description": f"Описание мастер-класса {i}",
-                    "specific_slots": {}  # Format: {"YYYY-MM-DD": {"start": "HH:MM", "end": "HH:MM"}}
-                }
         masters_last_update = time.time()
         return False
+    finally:
+        conn.close()
 
-# Обновление количества мест при записи
-def update_master_class_spots(master_id, change=-1):
-    """Обновляет количество свободных мест для мастер-класса"""
-    global masters_data
-    if not masters_sheet or not masters_data.get(master_id):
-        return False
+    new_data = {}
+    for (master_id, name, description, total_spots, date_start, date_end, time_start, time_end,
+         enabled, exclude_weekends, specific_slots_json, booked) in rows:
+        try:
+            specific_slots = json.loads(specific_slots_json or "{}")
+        except ValueError:
+            logger.warning(f"⚠️ Некорректные временные слоты мастер-класса {master_id}, слоты сброшены")
+            specific_slots = {}
+        free_spots = max(0, total_spots - booked)
+        new_data[master_id] = {
+            "id": master_id,
+            "name": name,
+            "free_spots": free_spots,
+            "total_spots": total_spots,
+            "booked": booked,
+            "date_start": date_start,
+            "date_end": date_end,
+            "time_start": time_start,
+            "time_end": time_end,
+            "available": bool(enabled) and free_spots > 0,
+            "enabled": bool(enabled),  # Ручной флаг "Доступен для записи"
+            "exclude_weekends": bool(exclude_weekends),
+            "description": description or "",
+            "specific_slots": specific_slots  # Format: {"YYYY-MM-DD": {"start": "HH:MM", "end": "HH:MM"}}
+        }
+    if new_data:
+        # Согласуем счетчик ID с базой данных
+        reconcile_master_id_sequence(list(new_data.keys()))
+    else:
+        # Если мастер-классов нет, используем временные данные
+        new_data = get_placeholder_masters_data()
+
+    with masters_data_lock:
+        masters_data = new_data
+    invalidate_masters_schedule()
+    masters_last_update = time.time()
+    logger.info(f"✅ Загружено {len(rows)} мастер-классов из базы данных")
+    return True
+
+# Количество мастер-классов в базе данных (включая удаленные, но еще не убранные с листа)
+def count_master_classes():
+    conn = get_connection()
+    if not conn:
+        return 0
     try:
-        # Находим строку в листе мастер-классов
-        cell = masters_sheet.find(master_id)
-        if not cell:
-            logger.warning(f"❌ Мастер-класс {master_id} не найден в таблице")
-            return False
-        row = cell.row
-        # Получаем текущие значения
-        free_spots = int(masters_sheet.cell(row, 3).value)  # "Свободных мест"
-        booked = int(masters_sheet.cell(row, 5).value)      # "Записано"
-        # Обновляем значения
-        new_free_spots = max(0, free_spots + change)
-        new_booked = booked - change  # отрицательное значение change = увеличение booked
-        # Обновляем в таблице
-        masters_sheet.update_cell(row, 3, str(new_free_spots))  # Свободных мест
-        masters_sheet.update_cell(row, 5, str(new_booked))      # Записано
-        # Обновляем статус доступности
-        available = "да" if new_free_spots > 0 else "нет"
-        masters_sheet.update_cell(row, 10, available)  # Доступен для записи
-        # Обновляем кэш
-        with masters_data_lock:
-            if master_id in masters_data:
-                masters_data[master_id]["free_spots"] = new_free_spots
-                masters_data[master_id]["booked"] = new_booked
-                masters_data[master_id]["available"] = new_free_spots > 0
-        logger.info(f"🔄 Обновлено количество мест для мастер-класса {master_id}: свободно {new_free_spots}, записано {new_booked}")
-        return True
-    except Exception as e:
-        logger.error(f"❌ Ошибка обновления мест для мастер-класса {master_id}: {e}")
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM master_classes")
+        return cursor.fetchone()[0]
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка подсчета мастер-классов: {e}")
+        return 0
+    finally:
+        conn.close()
+
+# Сохранение мастер-класса из кэша в базу данных
+def save_master_class(master_id):
+    """
+    Записывает мастер-класс из masters_data в таблицу master_classes и помечает его
+    для выгрузки на лист (выгрузка выполняется в sheets_worker).
+    """
+    with masters_data_lock:
+        master_info = dict(masters_data.get(master_id) or {})
+    if not master_info:
+        logger.warning(f"❌ Мастер-класс {master_id} не найден в кэше")
         return False
 
-# Функция завершения работы бота
-def shutdown():
-    """Корректное завершение работы бота и фоновых потоков"""
-    global sheets_worker_running, reminder_worker_running
+    conn = get_connection()
+    if not conn:
+        logger.error(f"❌ Невозможно сохранить мастер-класс {master_id}: база данных недоступна")
+        return False
 
-    # Создаем резервную копию данных перед завершением
     try:
-        import shutil
-        from pathlib import Path
-
-        logger.info("💾 Создание резервной копии данных...")
-
-        # Создаем директорию для бэкапов если не существует
-        backup_dir = Path("backups")
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO master_classes (id, name, description, total_spots, date_start, date_end, time_start, time_end,
+                                        available, exclude_weekends, specific_slots, deleted, dirty, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, 1, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                name = excluded.name, description = excluded.description, total_spots = excluded.total_spots,
+                date_start = excluded.date_start, date_end = excluded.date_end,
+                time_start = excluded.time_start, time_end = excluded.time_end,
+                available = excluded.available, exclude_weekends = excluded.exclude_weekends,
+                specific_slots = excluded.specific_slots, deleted = 0, dirty = 1, updated_at = excluded.updated_at
+        ''', (
+            master_id,
+            master_info.get("name", ""),
+            master_info.get("description", ""),
+            int(master_info.get("total_spots", 20)),
+            master_info.get("date_start", "2025-12-01"),
+            master_info.get("date_end", "2026-01-31"),
+            master_info.get("time_start", "10:00"),
+            master_info.get("time_end", "12:00"),
+            bool(master_info.get("enabled", master_info.get("available", True))),
+            bool(master_info.get("exclude_weekends", False)),
+            json.dumps(master_info.get("specific_slots") or {}, ensure_ascii=False, sort_keys=True),
+            time.time()
+        ))
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка сохранения мастер-класса {master_id}: {e}")
+        return False
+    finally:
+        conn.close()
+
+    masters_mirror_requested.set()
+    logger.info(f"💾 Мастер-класс {master_id} сохранен в базе данных")
+    return True
+
+# Удаление мастер-класса из базы данных
+def delete_master_class(master_id):
+    """Помечает мастер-класс удаленным; строка убирается с листа и из базы при следующей синхронизации"""
+    conn = get_connection()
+    if not conn:
+        logger.error(f"❌ Невозможно удалить мастер-класс {master_id}: база данных недоступна")
+        return False
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE master_classes SET deleted = 1, dirty = 1, updated_at = ? WHERE id = ?
+        ''', (time.time(), master_id))
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка удаления мастер-класса {master_id}: {e}")
+        return False
+    finally:
+        conn.close()
+
+    masters_mirror_requested.set()
+    return True
+
+# Поля мастер-класса из строки листа "Мастер-классы"
+def parse_master_sheet_row(row, header_index):
+    """Возвращает (master_id, fields) или None для пустой строки; колонки ищутся по заголовкам"""
+    def cell(header, default=""):
+        index = header_index.get(header)
+        if index is None or index >= len(row):
+            return default
+        value = str(row[index]).strip()
+        return value if value else default
+
+    master_id = cell("ID")
+    name = cell("Название")
+    if not master_id or not name:
+        return None
+    try:
+        total_spots = int(cell("Всего мест", "20"))
+    except ValueError:
+        total_spots = 20
+    return master_id, {
+        "name": name,
+        "description": cell("Описание"),
+        "total_spots": total_spots,
+        "date_start": cell("Дата начала", "2025-12-01"),
+        "date_end": cell("Дата окончания", "2026-01-31"),
+        "time_start": cell("Время начала", "10:00"),
+        "time_end": cell("Время окончания", "12:00"),
+        "available": cell("Доступен для записи", "да").lower() == "да",
+        "exclude_weekends": cell("Исключить выходные", "нет").lower() == "да"
+    }
+
+# Строка листа "Мастер-классы" в порядке MASTERS_SHEET_HEADERS
+def build_master_sheet_row(master_id, fields, booked=0):
+    total_spots = int(fields.get("total_spots", 20))
+    return [
+        master_id,
+        fields.get("name") or "",
+        str(max(0, total_spots - booked)),
+        str(total_spots),
+        str(booked),
+        fields.get("date_start") or "",
+        fields.get("date_end") or "",
+        fields.get("time_start") or "",
+        fields.get("time_end") or "",
+        "да" if fields.get("available", True) else "нет",
+        "да" if fields.get("exclude_weekends", False) else "нет",
+        fields.get("description") or ""
+    ]
+
+# Хэш редактируемых полей мастер-класса (места вычисляются по записям и не учитываются)
+def master_fields_hash(master_id, fields):
+    row = build_master_sheet_row(master_id, fields)
+    del row[2:5]
+    return hashlib.sha1("\x1f".join(str(value).strip() for value in row).encode("utf-8")).hexdigest()
+
+# Отпечаток содержимого листа (пустые хвосты строк и пустые строки в конце не учитываются)
+def get_sheet_values_fingerprint(values):
+    rows = [[str(value).strip() for value in row] for row in values]
+    for row in rows:
+        while row and not row[-1]:
+            row.pop()
+    while rows and not rows[-1]:
+        rows.pop()
+    return hashlib.sha1(json.dumps(rows, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+# Двусторонняя синхронизация таблицы master_classes с листом "Мастер-классы" (sheets_worker и админ-панель)
+def sync_master_classes_with_sheets(reload_cache=True, local_changes=True):
+    """Запускает синхронизацию; одновременно выполняется не больше одной"""
+    with masters_sync_lock:
+        return sync_master_classes_once(reload_cache, local_changes)
+
+# Один проход синхронизации листа мастер-классов
+def sync_master_classes_once(reload_cache=True, local_changes=True):
+    """
+    Лист читается одним запросом. Если его отпечаток не изменился с последней синхронизации
+    и в боте нет изменений (local_changes=False), разбор и обращения к базе пропускаются.
+    Строки, измененные на листе вручную, переносятся в базу; новые строки листа добавляются в базу.
+    Если строка изменена и на листе, и в боте, сохраняются изменения из бота, конфликт записывается в лог.
+    Затем лист целиком собирается из базы и, если отличается, записывается одним запросом по диапазону.
+    """
+    global masters_mirror_last_run, masters_sheet_fingerprint
+    masters_mirror_last_run = time.time()
+    if not masters_sheet or not google_sheets_enabled:
+        return False
+
+    try:
+        all_values = masters_sheet.get_all_values()
+    except Exception as e:
+        logger.error(f"❌ Ошибка чтения листа мастер-классов: {e}")
+        # Следующая попытка пройдет полную сверку, чтобы не потерять невыгруженные изменения
+        masters_sheet_fingerprint = None
+        return False
+
+    masters_mirror_stats["checks"] += 1
+    fingerprint = get_sheet_values_fingerprint(all_values)
+    sheet_changed = fingerprint != masters_sheet_fingerprint
+    if not sheet_changed and not local_changes:
+        masters_mirror_stats["skipped"] += 1
+        logger.debug(f"ℹ️ Лист мастер-классов не изменился, синхронизация пропущена (всего пропущено: {masters_mirror_stats['skipped']} из {masters_mirror_stats['checks']})")
+        return True
+
+    header_index = {str(header).strip(): index for index, header in enumerate(all_values[0])} if all_values else {}
+    sheet_rows = {}
+    # Ручные правки ищем, только если лист изменился
+    for row in (all_values[1:] if sheet_changed else []):
+        parsed = parse_master_sheet_row(row, header_index)
+        if parsed and parsed[0] not in sheet_rows:
+            sheet_rows[parsed[0]] = parsed[1]
+
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Невозможно синхронизировать мастер-классы: база данных недоступна")
+        return False
+
+    conn.isolation_level = None  # Транзакцией управляем явно
+    pulled = 0
+    try:
+        cursor = conn.cursor()
+        # 1. Переносим в базу ручные правки листа
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT id, deleted, dirty, synced_hash FROM master_classes")
+        db_state = {row[0]: row[1:] for row in cursor.fetchall()}
+        now = time.time()
+        for master_id, fields in sheet_rows.items():
+            sheet_hash = master_fields_hash(master_id, fields)
+            params = (fields["name"], fields["description"], fields["total_spots"], fields["date_start"], fields["date_end"],
+                      fields["time_start"], fields["time_end"], fields["available"], fields["exclude_weekends"], sheet_hash, now, master_id)
+            if master_id not in db_state:
+                cursor.execute('''
+                    INSERT INTO master_classes (name, description, total_spots, date_start, date_end, time_start, time_end,
+                                                available, exclude_weekends, synced_hash, updated_at, id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', params)
+                logger.info(f"📥 Мастер-класс {master_id} добавлен с листа Google Sheets")
+                pulled += 1
+                continue
+            deleted, dirty, synced_hash = db_state[master_id]
+            if deleted or sheet_hash == synced_hash:
+                continue
+            if dirty:
+                if synced_hash is not None:
+                    logger.warning(f"⚠️ Конфликт синхронизации мастер-класса {master_id}: строка изменена и на листе, и в боте. Сохраняются изменения из бота")
+                continue
+            cursor.execute('''
+                UPDATE master_classes SET name = ?, description = ?, total_spots = ?, date_start = ?, date_end = ?,
+                    time_start = ?, time_end = ?, available = ?, exclude_weekends = ?, synced_hash = ?, updated_at = ?
+                WHERE id = ?
+            ''', params)
+            logger.info(f"📥 Мастер-класс {master_id} обновлен по правкам на листе Google Sheets")
+            pulled += 1
+        cursor.execute("COMMIT")
+
+        # 2. Собираем лист из базы
+        cursor.execute('''
+            SELECT mc.id, mc.name, mc.description, mc.total_spots, mc.date_start, mc.date_end,
+                   mc.time_start, mc.time_end, mc.available, mc.exclude_weekends, mc.deleted, mc.updated_at,
+                   COALESCE(b.booked, 0)
+            FROM master_classes mc
+            LEFT JOIN (
+                SELECT position, COUNT(*) AS booked FROM registrations
+                WHERE status IN ('создана', 'перенесена')
+                GROUP BY position
+            ) b ON b.position = mc.id
+        ''')
+        snapshot = cursor.fetchall()
+        live_rows = []
+        for (master_id, name, description, total_spots, date_start, date_end, time_start, time_end,
+             available, exclude_weekends, deleted, updated_at, booked) in snapshot:
+            if deleted:
+                continue
+            fields = {"name": name, "description": description or "", "total_spots": total_spots,
+                      "date_start": date_start, "date_end": date_end, "time_start": time_start, "time_end": time_end,
+                      "available": bool(available), "exclude_weekends": bool(exclude_weekends)}
+            live_rows.append((master_id, fields, booked, updated_at))
+        live_rows.sort(key=lambda item: (parse_master_id_number(item[0]) is None, parse_master_id_number(item[0]) or 0, item[0]))
+
+        width = len(MASTERS_SHEET_HEADERS)
+        new_values = [list(MASTERS_SHEET_HEADERS)]
+        new_values.extend(build_master_sheet_row(master_id, fields, booked) for master_id, fields, booked, _ in live_rows)
+        # Лишние строки очищаем в том же запросе
+        new_values.extend([[""] * width for _ in range(len(all_values) - len(new_values))])
+        current_values = [(list(row[:width]) + [""] * width)[:width] for row in all_values]
+        current_values.extend([[""] * width for _ in range(len(new_values) - len(current_values))])
+        if [[str(value).strip() for value in row] for row in current_values] != new_values:
+            last_cell = gspread.utils.rowcol_to_a1(len(new_values), width)
+            masters_sheet.update(f"A1:{last_cell}", new_values)
+            fingerprint = get_sheet_values_fingerprint(new_values)
+            masters_mirror_stats["pushed"] += 1
+            logger.info(f"📤 Лист мастер-классов обновлен из базы данных ({len(live_rows)} мастер-классов, "
+                        f"проверок без изменений пропущено: {masters_mirror_stats['skipped']} из {masters_mirror_stats['checks']})")
+        masters_sheet_fingerprint = fingerprint
+
+        # 3. Отмечаем выгруженные строки; строки, измененные во время выгрузки, останутся помеченными
+        cursor.execute("BEGIN IMMEDIATE")
+        for master_id, fields, _, updated_at in live_rows:
+            cursor.execute('''
+                UPDATE master_classes SET dirty = 0, synced_hash = ?
+                WHERE id = ? AND updated_at IS ?
+            ''', (master_fields_hash(master_id, fields), master_id, updated_at))
+        for master_id, *_, deleted, updated_at, _ in snapshot:
+            if deleted:
+                cursor.execute("DELETE FROM master_classes WHERE id = ? AND deleted = 1 AND updated_at IS ?", (master_id, updated_at))
+        cursor.execute("COMMIT")
+    except Exception as e:
+        if conn.in_transaction:
+            conn.rollback()
+        logger.error(f"❌ Ошибка синхронизации мастер-классов с Google Sheets: {e}")
+        masters_sheet_fingerprint = None
+        return False
+    finally:
+        conn.close()
+
+    masters_mirror_stats["pulled"] += pulled
+    if pulled and reload_cache:
+        load_masters_data()
+    return True
+
+# Постановка групповой операции с Google Sheets в очередь фонового потока
+def enqueue_sheets_job(func, *args):
+    # Без своего фонового потока операция передается фоновому процессу через базу данных
+    if not has_local_sheets_worker() and func.__name__ in SHEETS_OUTBOX_JOBS:
+        add_to_sheets_outbox("job", {"func": func.__name__, "args": list(args)})
+        return
+    sheets_jobs_queue.put((func, args))
+
+# Есть ли в процессе фоновый поток Google Sheets (в режиме web его нет)
+def has_local_sheets_worker():
+    return bot_run_mode != "web"
+
+# Сохранение задачи Google Sheets в sheets_outbox
+def add_to_sheets_outbox(kind, payload, priority=TASK_PRIORITY_MEDIUM):
+    """kind: "registration" - строка журнала записей, "job" - групповая операция из SHEETS_OUTBOX_JOBS"""
+    conn = get_connection()
+    if not conn:
+        logger.error(f"❌ Невозможно сохранить задачу Google Sheets ({kind}): база данных недоступна")
+        return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO sheets_outbox (kind, priority, payload, created_at) VALUES (?, ?, ?, ?)",
+            (kind, priority, json.dumps(payload, ensure_ascii=False), time.time())
+        )
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка сохранения задачи Google Sheets ({kind}): {e}")
+        return False
+    finally:
+        conn.close()
+
+# Количество задач, ожидающих в sheets_outbox
+def count_sheets_outbox():
+    conn = get_connection()
+    if not conn:
+        return 0
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM sheets_outbox")
+        return cursor.fetchone()[0]
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка чтения sheets_outbox: {e}")
+        return 0
+    finally:
+        conn.close()
+
+# Извлечение задач из sheets_outbox
+def claim_sheets_outbox(limit=SHEETS_OUTBOX_BATCH):
+    """Забирает и удаляет из sheets_outbox до limit задач в одной транзакции - одну задачу получает один процесс"""
+    conn = get_connection()
+    if not conn:
+        return []
+    try:
+        conn.isolation_level = None
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT id, kind, priority, payload FROM sheets_outbox ORDER BY priority, id LIMIT ?", (limit,))
+        rows = cursor.fetchall()
+        if rows:
+            cursor.executemany("DELETE FROM sheets_outbox WHERE id = ?", [(row[0],) for row in rows])
+        cursor.execute("COMMIT")
+        return rows
+    except sqlite3.Error as e:
+        if conn.in_transaction:
+            conn.rollback()
+        logger.error(f"❌ Ошибка чтения sheets_outbox: {e}")
+        return []
+    finally:
+        conn.close()
+
+# Перенос задач из sheets_outbox в очереди фонового потока
+def drain_sheets_outbox(limit=SHEETS_OUTBOX_BATCH):
+    """Возвращает количество перенесенных задач; не поместившиеся в очередь возвращаются в sheets_outbox"""
+    moved = 0
+    claimed = claim_sheets_outbox(limit)
+    for index, (outbox_id, kind, priority, payload) in enumerate(claimed):
+        try:
+            data = json.loads(payload)
+            if kind == "registration":
+                sheets_queue.put_nowait((priority, tuple(data)))
+            elif kind == "job" and data.get("func") in SHEETS_OUTBOX_JOBS:
+                sheets_jobs_queue.put((globals()[data["func"]], tuple(data.get("args", []))))
+            else:
+                logger.error(f"❌ Неизвестная задача sheets_outbox {outbox_id}: {kind}")
+                continue
+            moved += 1
+        except queue.Full:
+            for _, rest_kind, rest_priority, rest_payload in claimed[index:]:
+                add_to_sheets_outbox(rest_kind, json.loads(rest_payload), rest_priority)
+            break
+        except (ValueError, TypeError) as e:
+            logger.error(f"❌ Поврежденная задача sheets_outbox {outbox_id}: {e}")
+    if moved:
+        logger.debug(f"📥 Из sheets_outbox получено задач: {moved}")
+    return moved
+
+# Выполнение накопившихся групповых операций с Google Sheets (вызывается из sheets_worker)
+def run_pending_sheets_jobs():
+    # В режиме деградации операции остаются в очереди
+    while sheets_gateway.is_available():
+        try:
+            func, args = sheets_jobs_queue.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            func(*args)
+        except Exception as e:
+            logger.error(f"❌ Ошибка выполнения групповой операции Google Sheets {getattr(func, '__name__', func)}: {e}")
+
+# Пересчет мест мастер-класса после изменения записей
+def update_master_class_spots(master_id):
+    """Пересчитывает места мастер-класса по активным записям в базе данных и ставит выгрузку на лист"""
+    if not masters_data.get(master_id):
+        return False
+    conn = get_connection()
+    if not conn:
+        logger.error(f"❌ Невозможно пересчитать места для мастер-класса {master_id}: база данных недоступна")
+        return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT COUNT(*) FROM registrations
+            WHERE position = ? AND status IN ('создана', 'перенесена')
+        ''', (master_id,))
+        booked = cursor.fetchone()[0]
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка обновления мест для мастер-класса {master_id}: {e}")
+        return False
+    finally:
+        conn.close()
+
+    with masters_data_lock:
+        master_info = masters_data.get(master_id)
+        if not master_info:
+            return False
+        free_spots = max(0, master_info.get("total_spots", 0) - booked)
+        master_info["free_spots"] = free_spots
+        master_info["booked"] = booked
+        master_info["available"] = master_info.get("enabled", True) and free_spots > 0
+    invalidate_masters_schedule()
+    masters_mirror_requested.set()
+    logger.info(f"🔄 Обновлено количество мест для мастер-класса {master_id}: свободно {free_spots}, записано {booked}")
+    return True
+
+# Функция завершения работы бота
+def shutdown():
+    """Корректное завершение работы бота и фоновых потоков"""
+    global sheets_worker_running, reminder_worker_running, leader_election_running
+
+    # Создаем резервную копию данных перед завершением
+    try:
+        import shutil
+        from pathlib import Path
+
+        logger.info("💾 Создание резервной копии данных...")
+
+        # Создаем директорию для бэкапов если не существует
+        backup_dir = Path("backups")
         backup_dir.mkdir(exist_ok=True)
 
         # Имя файла бэкапа с timestamp
@@ -997,6 +2121,10 @@ def shutdown():
     logger.info("🛑 Завершение работы фоновых потоков...")
     sheets_worker_running = False
     reminder_worker_running = False
+    leader_election_running = False
+    # Отдаем роль ведущего сразу, не дожидаясь истечения аренды
+    if is_background_leader() and release_worker_lease(BACKGROUND_LEASE_NAME):
+        logger.info(f"👑 Процесс {process_instance_id} освободил роль ведущего")
     # Добавляем несколько сигналов завершения в очередь
     for _ in range(3):  # Добавляем резервные сигналы
         try:
@@ -1028,6 +2156,27 @@ def shutdown():
     
     if not sheets_queue.empty():
         logger.warning("⚠️ Очередь Google Sheets не была полностью обработана за отведенное время")
+    # Пулы потоков обработчиков: новые задачи не принимаются, начатые завершаются сами
+    db_executor.shutdown(wait=False)
+    sheets_executor.shutdown(wait=False)
+    edits_total = message_edit_stats["sent"] + message_edit_stats["skipped"] + message_edit_stats["not_modified"]
+    if edits_total:
+        logger.info(f"✏️ Редактирования сообщений: отправлено {message_edit_stats['sent']}, пропущено без изменений {message_edit_stats['skipped']}, отклонено Telegram как неизмененные {message_edit_stats['not_modified']}")
+    if callback_guard_stats["dropped"]:
+        logger.info(f"🔁 Отброшено повторных нажатий кнопок: {callback_guard_stats['dropped']}, сэкономлено времени обработки {callback_guard_stats['saved_seconds']:.1f} с")
+    auth_stats = admin_auth_store.stats
+    if auth_stats["hits"] or auth_stats["misses"]:
+        logger.info(f"🔐 Кэш сессий администраторов: попаданий {admin_auth_store.hit_ratio():.0%} ({auth_stats['hits']} из {auth_stats['hits'] + auth_stats['misses']}), вытеснено {auth_stats['evictions']}, удалено истекших записей {auth_stats['purged']}")
+    if bot_persistence:
+        stats = bot_persistence.stats
+        logger.info(f"💾 Состояние диалогов: записей в базу {stats['rows_written']} за {stats['batches']} транзакций, пропущено без изменений {stats['unchanged']}, подхвачено из других процессов {stats['remote_changes']}")
+    reaper_stats = conversation_reaper.stats
+    if conversation_reaper.gauge or reaper_stats["timed_out"]:
+        logger.info(f"⌛ Диалогов завершено по таймауту: {reaper_stats['timed_out']}, удалено из базы брошенных диалогов и user_data: {reaper_stats['purged_rows']}, выгружено из памяти пользователей: {reaper_stats['evicted_users']}, чатов: {reaper_stats['evicted_chats']}")
+    if conversation_reaper.gauge:
+        logger.info(f"🧠 {conversation_reaper.format_gauge()}")
+    if loop_lag_stats["stalls"]:
+        logger.info(f"🐢 Блокировок event loop за время работы: {loop_lag_stats['stalls']} (максимум {loop_lag_stats['max_ms']} мс)")
     logger.info("✅ Все фоновые потоки завершены")
 
 def restore_queue_state():
@@ -1089,10 +2238,10 @@ def restore_queue_state():
 
 # === РАБОТА С БАЗОЙ ДАННЫХ ===
 # Получение надежного соединения с базой данных
-def get_connection():
+def get_connection(check_same_thread=True):
     """Создает соединение с базой данных с обработкой ошибок"""
     try:
-        return sqlite3.connect('events.db', timeout=DATABASE_TIMEOUT)
+        return sqlite3.connect('events.db', timeout=DATABASE_TIMEOUT, check_same_thread=check_same_thread)
     except sqlite3.OperationalError as e:
         logger.error(f"❌ Операционная ошибка базы данных: {e}")
         logger.error("Возможные причины: файл базы данных поврежден, недостаточно места на диске, или база данных заблокирована другим процессом")
@@ -1201,6 +2350,13 @@ def init_db():
         except sqlite3.OperationalError:
             # Поле уже существует
             pass
+        # Добавляем поле next_fire_at (unix timestamp ближайшей отправки, NULL - отправлять нечего)
+        try:
+            cursor.execute("ALTER TABLE admin_reminders ADD COLUMN next_fire_at REAL")
+            logger.info("✅ Добавлено поле next_fire_at в таблицу admin_reminders")
+        except sqlite3.OperationalError:
+            # Поле уже существует
+            pass
         # Создаем таблицу для отслеживания отправленных администраторских напоминаний
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS admin_reminder_logs (
@@ -1211,6 +2367,123 @@ def init_db():
                 FOREIGN KEY (reminder_id) REFERENCES admin_reminders(id)
             )
         ''')
+        # Создаем таблицу исходящих задач Google Sheets от процессов без фонового потока (режим web)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sheets_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                priority INTEGER NOT NULL DEFAULT 2,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sheets_outbox_order ON sheets_outbox (priority, id)")
+        # Создаем таблицу аренды ролей: фоновые задачи выполняет только процесс, удерживающий аренду
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS worker_leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                acquired_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        # Создаем таблицы для user_data и состояний ConversationHandler (SQLitePersistence)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS persistence_user_data (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS persistence_conversations (
+                name TEXT NOT NULL,
+                conv_key TEXT NOT NULL, -- JSON-список ключа диалога, например [chat_id, user_id]
+                user_id INTEGER NOT NULL,
+                state TEXT NOT NULL, -- JSON состояния
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (name, conv_key)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_persistence_conversations_user ON persistence_conversations (user_id)")
+        # Создаем таблицы сессий администраторов и неудачных попыток входа (записи со сроком действия)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS admin_sessions (
+                user_id INTEGER PRIMARY KEY,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS admin_login_attempts (
+                user_id INTEGER PRIMARY KEY,
+                attempts INTEGER NOT NULL,
+                last_attempt REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        # Создаем таблицу счетчиков для выдачи ID (например, 'master_class' для MC001, MC002...)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS id_sequences (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        # Создаем таблицу мастер-классов (лист "Мастер-классы" - ее зеркало)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS master_classes (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                description TEXT DEFAULT '',
+                total_spots INTEGER NOT NULL DEFAULT 20,
+                date_start TEXT,
+                date_end TEXT,
+                time_start TEXT,
+                time_end TEXT,
+                available BOOLEAN DEFAULT 1, -- ручной флаг "Доступен для записи"
+                exclude_weekends BOOLEAN DEFAULT 0,
+                specific_slots TEXT DEFAULT '{}', -- JSON {"YYYY-MM-DD": {"start": "HH:MM", "end": "HH:MM"}}
+                deleted BOOLEAN DEFAULT 0, -- удален в боте, строку нужно убрать с листа
+                dirty BOOLEAN DEFAULT 0, -- есть изменения, еще не выгруженные на лист
+                synced_hash TEXT, -- хэш полей строки листа на момент последней синхронизации
+                updated_at REAL
+            )
+        ''')
+        # Создаем таблицу пользователей бота (все, кто взаимодействовал с ботом)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bot_users (
+                user_id INTEGER PRIMARY KEY,
+                first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                blocked BOOLEAN DEFAULT 0 -- 1, если пользователь заблокировал бота
+            )
+        ''')
+        # Создаем таблицу недоступных чатов (ошибки Forbidden / Chat not found при отправке)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_status (
+                chat_id INTEGER PRIMARY KEY,
+                status TEXT NOT NULL, -- 'blocked', 'deactivated', 'not_found'
+                error TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Заполняем таблицу пользователями из существующих записей
+        cursor.execute('''
+            INSERT OR IGNORE INTO bot_users (user_id, first_seen, last_active)
+            SELECT user_id, MIN(created_at), MAX(created_at)
+            FROM registrations
+            WHERE user_id IS NOT NULL AND user_id != 0
+            GROUP BY user_id
+        ''')
+        # Создаем таблицу для отметок об отправке относительных напоминаний
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS relative_reminder_sends (
+                reminder_id INTEGER NOT NULL,
+                class_id TEXT NOT NULL,
+                class_date TEXT NOT NULL, -- YYYY-MM-DD, дата проведения мастер-класса
+                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
         # Создаем индексы для оптимизации запросов
         cursor.execute('''
             CREATE INDEX IF NOT EXISTS idx_registrations_event_date
@@ -1232,6 +2505,14 @@ def init_db():
             CREATE INDEX IF NOT EXISTS idx_registrations_event_time
             ON registrations(event_time)
         ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_registrations_position_user
+            ON registrations(position, user_id)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_bot_users_blocked
+            ON bot_users(blocked, user_id)
+        ''')
         cursor.execute('''
             CREATE INDEX IF NOT EXISTS idx_reminders_registration_id
             ON reminders(registration_id)
@@ -1248,10 +2529,22 @@ def init_db():
             CREATE INDEX IF NOT EXISTS idx_admin_reminders_schedule
             ON admin_reminders(schedule_type, reminder_time)
         ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_admin_reminders_next_fire
+            ON admin_reminders(is_active, next_fire_at)
+        ''')
         cursor.execute('''
             CREATE INDEX IF NOT EXISTS idx_admin_reminder_logs_reminder_id
             ON admin_reminder_logs(reminder_id)
         ''')
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_relative_reminder_sends_key
+            ON relative_reminder_sends(reminder_id, class_id, class_date)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_relative_reminder_sends_date
+            ON relative_reminder_sends(class_date)
+        ''')
         conn.commit()
         logger.info("✅ База данных инициализирована")
         return True
@@ -1261,47 +2554,103 @@ def init_db():
     finally:
         conn.close()
 
-# Сохранение записи в базу данных И Google Sheets
-def save_registration(full_name, position_id, event_date, event_time, user_id, telegram_verified=True, family_member=False, family_account_holder_id=None, status="создана"):
+# Результат бронирования места: status - одно из BOOKING_*, reg_id - ID новой записи,
+# existing - кортеж (id, position, event_date, event_time, status) мешающей записи
+BookingResult = namedtuple("BookingResult", ["status", "reg_id", "existing"])
+BOOKING_OK = "booked"
+BOOKING_DUPLICATE = "duplicate"  # Пользователь уже записан на этот мастер-класс
+BOOKING_CONFLICT = "conflict"    # У пользователя есть запись на то же время
+BOOKING_FULL = "full"            # Свободных мест нет
+BOOKING_ERROR = "error"          # База данных недоступна
+
+# Бронирование места на мастер-классе одной транзакцией
+def book_slot(full_name, position_id, event_date, event_time, user_id, telegram_verified=True, family_member=False, family_account_holder_id=None, status="создана"):
+    """
+    Проверяет дубликат, конфликт по времени и наличие мест и создает запись
+    в одной транзакции BEGIN IMMEDIATE. Возвращает BookingResult.
+    Google Sheets обновляется в фоне после фиксации транзакции.
+    """
     conn = get_connection()
     if not conn:
         logger.error("❌ Невозможно сохранить регистрацию: база данных недоступна")
-        return None
-    
+        return BookingResult(BOOKING_ERROR, None, None)
+
+    conn.isolation_level = None  # Транзакцией управляем явно
+    total_spots = masters_data.get(position_id, {}).get("total_spots", 0)
     try:
         cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
 
         # Проверяем, нет ли уже записи этого пользователя на этот же мастер-класс
         cursor.execute('''
-            SELECT id FROM registrations
+            SELECT id, position, event_date, event_time, status
+            FROM registrations
             WHERE user_id = ? AND position = ? AND status IN ('создана', 'перенесена')
+            ORDER BY created_at DESC
+            LIMIT 1
         ''', (user_id, position_id))
         existing = cursor.fetchone()
-
         if existing:
+            cursor.execute("ROLLBACK")
             logger.warning(f"⚠️ Пользователь {user_id} уже записан на мастер-класс {position_id} (ID записи: {existing[0]})")
-            return None
+            return BookingResult(BOOKING_DUPLICATE, None, existing)
+
+        # Проверяем конфликты по времени (в том числе записи членов семьи)
+        cursor.execute('''
+            SELECT id, position, event_date, event_time, status
+            FROM registrations
+            WHERE (user_id = ? OR family_account_holder_id = ?) AND event_date = ? AND event_time = ?
+            AND status IN ('создана', 'перенесена')
+            LIMIT 1
+        ''', (user_id, user_id, event_date, event_time))
+        conflict = cursor.fetchone()
+        if conflict:
+            cursor.execute("ROLLBACK")
+            logger.info(f"⚠️ Конфликт времени для пользователя {user_id}: {event_date} {event_time} уже занято записью ID {conflict[0]}")
+            return BookingResult(BOOKING_CONFLICT, None, conflict)
+
+        # Проверяем наличие свободных мест
+        cursor.execute('''
+            SELECT COUNT(*) FROM registrations
+            WHERE position = ? AND status IN ('создана', 'перенесена')
+        ''', (position_id,))
+        booked = cursor.fetchone()[0]
+        if total_spots and booked >= total_spots:
+            cursor.execute("ROLLBACK")
+            logger.info(f"⚠️ Нет свободных мест на мастер-класс {position_id} ({booked}/{total_spots})")
+            return BookingResult(BOOKING_FULL, None, None)
 
         cursor.execute('''
             INSERT INTO registrations (full_name, position, event_date, event_time, user_id, telegram_verified, family_member, family_account_holder_id, status)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (full_name, position_id, event_date, event_time, user_id, telegram_verified, family_member, family_account_holder_id, status))
         reg_id = cursor.lastrowid
-        conn.commit()
-        logger.info(f"✅ Регистрация сохранена: {full_name}, {position_id}, {event_date}, {event_time} (ID: {reg_id}, статус: {status})")
-        # Асинхронно сохраняем в Google Sheets
-        if google_sheets_enabled:
-            async_save_to_google_sheets(reg_id, full_name, position_id, event_date, event_time, "Создание", status, TASK_PRIORITY_HIGH)
-        # Обновляем количество мест в мастер-классе
-        if google_sheets_enabled and position_id in masters_data:
-            update_master_class_spots(position_id, change=-1)
-        return reg_id
+        cursor.execute("COMMIT")
     except sqlite3.Error as e:
+        if conn.in_transaction:
+            conn.rollback()
         logger.error(f"❌ Ошибка при сохранении регистрации: {e}")
-        return None
+        return BookingResult(BOOKING_ERROR, None, None)
     finally:
         conn.close()
 
+    logger.info(f"✅ Регистрация сохранена: {full_name}, {position_id}, {event_date}, {event_time} (ID: {reg_id}, статус: {status})")
+    # Обновляем кэш мест; Google Sheets синхронизируется в фоне
+    with masters_data_lock:
+        if position_id in masters_data and total_spots:
+            masters_data[position_id]["booked"] = booked + 1
+            masters_data[position_id]["free_spots"] = max(0, total_spots - booked - 1)
+            masters_data[position_id]["available"] = masters_data[position_id].get("enabled", True) and total_spots - booked - 1 > 0
+    invalidate_masters_schedule()
+    masters_mirror_requested.set()
+    async_save_to_google_sheets(reg_id, full_name, position_id, event_date, event_time, "Создание", status, TASK_PRIORITY_HIGH)
+    return BookingResult(BOOKING_OK, reg_id, None)
+
+# Сохранение записи в базу данных И Google Sheets
+def save_registration(full_name, position_id, event_date, event_time, user_id, telegram_verified=True, family_member=False, family_account_holder_id=None, status="создана"):
+    result = book_slot(full_name, position_id, event_date, event_time, user_id, telegram_verified, family_member, family_account_holder_id, status)
+    return result.reg_id
+
 # Проверка существующей записи по ФИО
 def get_existing_registration(full_name, user_id=None, position_id=None):
     """
@@ -1417,6 +2766,49 @@ def get_user_registrations(user_id, include_family_members=True):
     finally:
         conn.close()
 
+# Количество активных регистраций, оформленных с Telegram-аккаунта пользователя
+def count_verified_registrations(user_id):
+    conn = get_connection()
+    if not conn:
+        return 0
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT COUNT(*) FROM registrations
+            WHERE user_id = ? AND telegram_verified = 1 AND status IN ('создана', 'перенесена')
+        ''', (user_id,))
+        return cursor.fetchone()[0]
+    except Exception as e:
+        logger.error(f"❌ Ошибка проверки семейных регистраций: {e}")
+        return 0
+    finally:
+        conn.close()
+
+# Активные регистрации для списка участников в админ-панели (None - база данных недоступна)
+def get_active_participants(master_filter=None):
+    conn = get_connection()
+    if not conn:
+        return None
+    try:
+        cursor = conn.cursor()
+        if master_filter:
+            cursor.execute('''
+                SELECT id, full_name, position, event_date, event_time, user_id, family_member, family_account_holder_id
+                FROM registrations
+                WHERE status IN ('создана', 'перенесена') AND position = ?
+                ORDER BY event_date, event_time, full_name
+            ''', (master_filter,))
+        else:
+            cursor.execute('''
+                SELECT id, full_name, position, event_date, event_time, user_id, family_member, family_account_holder_id
+                FROM registrations
+                WHERE status IN ('создана', 'перенесена')
+                ORDER BY event_date, event_time, full_name
+            ''')
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
 def check_time_conflict(user_id, event_date, event_time):
     """
     Проверяет, есть ли у пользователя другая регистрация в то же время.
@@ -1555,6 +2947,7 @@ def create_admin_reminder(master_class_id, title, message, reminder_type, schedu
 
         conn.commit()
         logger.info(f"✅ Создано администраторское напоминание ID {reminder_id}: {title}")
+        reschedule_admin_reminder(reminder_id)
         return True, reminder_id
     except sqlite3.Error as e:
         logger.error(f"❌ Ошибка при создании администраторского напоминания: {e}")
@@ -1639,6 +3032,7 @@ def update_admin_reminder(reminder_id, **kwargs):
         conn.commit()
 
         logger.info(f"✅ Обновлено администраторское напоминание ID {reminder_id}")
+        reschedule_admin_reminder(reminder_id)
         return True
     except sqlite3.Error as e:
         logger.error(f"❌ Ошибка при обновлении администраторского напоминания: {e}")
@@ -1655,9 +3049,10 @@ def deactivate_admin_reminder(reminder_id):
 
     try:
         cursor = conn.cursor()
-        cursor.execute("UPDATE admin_reminders SET is_active = 0 WHERE id = ?", (reminder_id,))
+        cursor.execute("UPDATE admin_reminders SET is_active = 0, next_fire_at = NULL WHERE id = ?", (reminder_id,))
         conn.commit()
         logger.info(f"✅ Деактивировано администраторское напоминание ID {reminder_id}")
+        invalidate_admin_reminders_wakeup()
         return True
     except sqlite3.Error as e:
         logger.error(f"❌ Ошибка при деактивации администраторского напоминания: {e}")
@@ -1680,6 +3075,7 @@ def delete_admin_reminder_permanently(reminder_id):
         cursor.execute("DELETE FROM admin_reminders WHERE id = ?", (reminder_id,))
         conn.commit()
         logger.info(f"✅ Полностью удалено администраторское напоминание ID {reminder_id}")
+        invalidate_admin_reminders_wakeup()
         return True
     except sqlite3.Error as e:
         logger.error(f"❌ Ошибка при удалении администраторского напоминания: {e}")
@@ -1691,445 +3087,905 @@ def delete_admin_reminder_permanently(reminder_id):
 def delete_admin_reminder(reminder_id):
     return deactivate_admin_reminder(reminder_id)
 
-# Получение пользователей для отправки напоминания
-def get_users_for_admin_reminder(master_class_id):
+# Отметка активности пользователя бота
+def touch_bot_user(user_id):
+    """Добавляет пользователя в bot_users или обновляет last_active (не чаще BOT_USER_TOUCH_INTERVAL)"""
+    now = time.time()
+    if now - bot_users_last_touch.get(user_id, 0) < BOT_USER_TOUCH_INTERVAL:
+        return
+    bot_users_last_touch[user_id] = now
+
     conn = get_connection()
     if not conn:
-        return []
+        return
 
     try:
         cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO bot_users (user_id) VALUES (?)
+            ON CONFLICT(user_id) DO UPDATE SET last_active = CURRENT_TIMESTAMP
+        ''', (user_id,))
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка при обновлении активности пользователя {user_id}: {e}")
+    finally:
+        conn.close()
 
-        if master_class_id == 'all':
-            # Получить всех пользователей со всех активных мастер-классов
-            cursor.execute('''
-                SELECT DISTINCT r.user_id
-                FROM registrations r
-                JOIN admin_reminders ar ON (
-                    ar.master_class_id = 'all' OR
-                    ar.master_class_id = r.position
-                )
-                WHERE r.status IN ('создана', 'перенесена')
-                AND r.user_id IS NOT NULL
-                AND ar.is_active = 1
-            ''')
-        else:
-            # Получить пользователей конкретного мастер-класса
-            cursor.execute('''
-                SELECT DISTINCT user_id
-                FROM registrations
-                WHERE position = ?
-                AND status IN ('создана', 'перенесена')
-                AND user_id IS NOT NULL
-            ''', (master_class_id,))
+# Время последней активности пользователя по bot_users (unix time или None)
+def get_bot_user_last_active(user_id):
+    """last_active обновляется не чаще BOT_USER_TOUCH_INTERVAL, поэтому может отставать на это время"""
+    conn = get_connection()
+    if not conn:
+        return None
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT CAST(strftime('%s', last_active) AS INTEGER) FROM bot_users WHERE user_id = ?", (user_id,))
+        row = cursor.fetchone()
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка чтения активности пользователя {user_id}: {e}")
+        return None
+    finally:
+        conn.close()
+    return row[0] if row else None
 
-        users = [row[0] for row in cursor.fetchall()]
+# Загрузка списка недоступных чатов
+def load_unreachable_chats():
+    """Загружает недоступные чаты из таблицы chat_status в память"""
+    global unreachable_chats, unreachable_chats_loaded
 
-        # ДОБАВЛЯЕМ ВСЕХ АДМИНИСТРАТОРОВ К СПИСКУ ПОЛУЧАТЕЛЕЙ
-        # Администраторы получают все админ-напоминания независимо от их регистраций
-        admin_users = [admin_id for admin_id in ADMIN_IDS if admin_id not in users]
-        if admin_users:
-            users.extend(admin_users)
-            logger.info(f"👑 Добавлено {len(admin_users)} администраторов к списку получателей")
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Невозможно загрузить статусы чатов: база данных недоступна")
+        return False
 
-        return users
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT chat_id FROM chat_status")
+        loaded = {row[0] for row in cursor.fetchall()}
+        with unreachable_chats_lock:
+            unreachable_chats = loaded
+            unreachable_chats_loaded = True
+        if loaded:
+            logger.info(f"🚫 Загружено {len(loaded)} недоступных чатов")
+        return True
     except sqlite3.Error as e:
-        logger.error(f"❌ Ошибка при получении пользователей для напоминания: {e}")
-        return []
+        logger.error(f"❌ Ошибка загрузки статусов чатов: {e}")
+        return False
     finally:
         conn.close()
 
-# Проверка, нужно ли отправить администраторское напоминание сейчас
-def should_send_admin_reminder(reminder):
-    reminder_id, master_class_id, title, message, reminder_type, schedule_type, day_of_week, reminder_date, reminder_time, time_offset, is_active, created_by, created_at, last_sent = reminder
-
-    if not is_active:
-        logger.debug(f"⏸️ Напоминание ID {reminder_id} неактивно")
-        return False
+# Проверка, доступен ли чат для отправки сообщений
+def is_chat_unreachable(chat_id):
+    if not unreachable_chats_loaded:
+        load_unreachable_chats()
+    return chat_id in unreachable_chats
 
-    now = datetime.now(MOSCOW_TZ)
-    current_time = now.strftime("%H:%M")
-    current_date = now.strftime("%Y-%m-%d")
-    current_weekday = now.weekday()  # 0 = Monday, 6 = Sunday
+# Отметка чата как недоступного
+def mark_chat_unreachable(chat_id, status, error=None):
+    """Сохраняет статус недоступного чата и помечает пользователя как заблокировавшего бота"""
+    with unreachable_chats_lock:
+        unreachable_chats.add(chat_id)
+    chat_delivery_stats["marked"] += 1
 
-    if reminder_type == 'relative_to_class':
-        # Относительные напоминания - проверяем по расписанию мастер-классов
-        return should_send_relative_reminder(reminder, now)
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Невозможно сохранить статус чата: база данных недоступна")
+        return False
 
-    # Обычные напоминания (scheduled/recurring)
-    # Используем более гибкую логику отправки для надежности
-    if schedule_type == 'once':
-        # Одноразовое напоминание
-        logger.debug(f"📅 Проверка одноразового напоминания: дата={reminder_date}, текущая={current_date}")
-        if reminder_date == current_date:
-            # Проверяем время с допуском ±5 минут
-            reminder_hour, reminder_minute = map(int, reminder_time.split(':'))
-            current_hour, current_minute = map(int, current_time.split(':'))
-            current_minutes = current_hour * 60 + current_minute
-            reminder_minutes = reminder_hour * 60 + reminder_minute
-
-            time_diff = abs(current_minutes - reminder_minutes)
-            logger.debug(f"⏰ Текущее время: {current_time} ({current_minutes} мин), Время напоминания: {reminder_time} ({reminder_minutes} мин), Разница: {time_diff} минут")
-
-            # Проверяем, было ли уже успешно отправлено сегодня
-            if last_sent:
-                last_sent_date = datetime.fromisoformat(last_sent.replace('Z', '+00:00')).strftime("%Y-%m-%d")
-                if last_sent_date == current_date:
-                    # Проверяем, были ли успешные отправки (не просто попытки)
-                    conn = get_connection()
-                    if conn:
-                        try:
-                            cursor = conn.cursor()
-                            cursor.execute(
-                                "SELECT COUNT(*) FROM admin_reminder_logs WHERE reminder_id = ? AND sent_to_users > 0",
-                                (reminder_id,)
-                            )
-                            successful_sends = cursor.fetchone()[0]
-                            if successful_sends > 0:
-                                logger.debug(f"✅ Напоминание уже успешно отправлено сегодня ({successful_sends} отправок)")
-                                return False
-                            else:
-                                logger.debug(f"🔄 Предыдущая попытка отправки не удалась, повторяем")
-                        except Exception as e:
-                            logger.error(f"❌ Ошибка проверки логов отправки: {e}")
-                        finally:
-                            conn.close()
-                    else:
-                        logger.warning(f"⚠️ Невозможно проверить логи отправки, пропускаем напоминание")
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR REPLACE INTO chat_status (chat_id, status, error, updated_at)
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (chat_id, status, error))
+        cursor.execute('''
+            INSERT INTO bot_users (user_id, blocked) VALUES (?, 1)
+            ON CONFLICT(user_id) DO UPDATE SET blocked = 1
+        ''', (chat_id,))
+        conn.commit()
+        logger.warning(f"🚫 Чат {chat_id} отмечен как недоступный ({status}): {error}")
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка при сохранении статуса чата {chat_id}: {e}")
+        return False
+    finally:
+        conn.close()
 
-            # Отправляем если в окне ±5 минут от запланированного времени
-            if time_diff <= 5:
-                logger.debug(f"🎯 Время отправки наступило!")
-                return True
-            else:
-                logger.debug(f"⏳ Ждем подходящего времени (разница {time_diff} мин)")
-                return False
+# Снятие отметки о недоступности чата
+def clear_chat_status(chat_id):
+    """Снимает отметку о недоступности чата (пользователь снова написал боту)"""
+    with unreachable_chats_lock:
+        unreachable_chats.discard(chat_id)
+    chat_delivery_stats["cleared"] += 1
 
-    elif schedule_type == 'daily':
-        # Ежедневное напоминание
-        logger.debug(f"📆 Проверка ежедневного напоминания")
-        # Проверяем время с допуском ±5 минут
-        reminder_hour, reminder_minute = map(int, reminder_time.split(':'))
-        current_hour, current_minute = map(int, current_time.split(':'))
-        current_minutes = current_hour * 60 + current_minute
-        reminder_minutes = reminder_hour * 60 + reminder_minute
-
-        time_diff = abs(current_minutes - reminder_minutes)
-
-        # Если уже отправляли сегодня, не отправляем снова
-        if last_sent:
-            last_sent_date = datetime.fromisoformat(last_sent.replace('Z', '+00:00')).strftime("%Y-%m-%d")
-            if last_sent_date == current_date:
-                logger.debug(f"✅ Ежедневное напоминание уже отправлено сегодня")
-                return False
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Невозможно обновить статус чата: база данных недоступна")
+        return False
 
-        # Отправляем если в окне ±5 минут от запланированного времени
-        if time_diff <= 5:
-            logger.debug(f"🎯 Время ежедневного напоминания наступило!")
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM chat_status WHERE chat_id = ?", (chat_id,))
+        cursor.execute("UPDATE bot_users SET blocked = 0 WHERE user_id = ?", (chat_id,))
+        conn.commit()
+        logger.info(f"✅ Чат {chat_id} снова доступен для отправки сообщений")
         return True
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка при обновлении статуса чата {chat_id}: {e}")
+        return False
+    finally:
+        conn.close()
 
-    elif schedule_type == 'weekly':
-        # Еженедельное напоминание (в указанный день недели)
-        logger.debug(f"📊 Проверка еженедельного напоминания: день={day_of_week}, текущий={current_weekday}")
-        if day_of_week is not None and current_weekday == day_of_week:
-            # Проверяем время с допуском ±5 минут
-            reminder_hour, reminder_minute = map(int, reminder_time.split(':'))
-            current_hour, current_minute = map(int, current_time.split(':'))
-            current_minutes = current_hour * 60 + current_minute
-            reminder_minutes = reminder_hour * 60 + reminder_minute
-
-            time_diff = abs(current_minutes - reminder_minutes)
-
-            # Если уже отправляли на этой неделе, не отправляем снова
-            if last_sent:
-                last_sent_datetime = datetime.fromisoformat(last_sent.replace('Z', '+00:00'))
-                if last_sent_datetime.isocalendar()[1] == now.isocalendar()[1]:
-                    logger.debug(f"✅ Еженедельное напоминание уже отправлено на этой неделе")
-                    return False
-
-            # Отправляем если в окне ±5 минут от запланированного времени
-            if time_diff <= 5:
-                logger.debug(f"🎯 Время еженедельного напоминания наступило!")
-            return True
-
-    logger.debug(f"⏸️ Условия отправки не выполнены для напоминания ID {reminder_id}")
-    return False
+# Обработчик, отмечающий активность пользователя при любом обновлении
+async def track_bot_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    watch_event_loop()
+    # До touch_bot_user: таймаут диалога считается от предыдущей активности
+    await conversation_reaper.on_update(update, context)
+    if update.effective_user:
+        # Пользователь снова пишет боту (например, /start после разблокировки) - чат доступен
+        if await run_db(is_chat_unreachable, update.effective_user.id):
+            await run_db(clear_chat_status, update.effective_user.id)
+        await run_db(touch_bot_user, update.effective_user.id)
+
+# Ключ нажатия кнопки: одно и то же сообщение и те же callback_data
+def get_callback_guard_key(query):
+    if query.message:
+        return (query.message.chat.id, query.message.message_id, query.data)
+    return (query.inline_message_id, None, query.data)
+
+# Обрабатывается ли нажатие сейчас или обработано недавно
+def is_callback_guard_active(entry, now):
+    started, finished = entry
+    if finished is None:
+        return now - started < CALLBACK_DEDUP_MAX_PROCESSING
+    return now - finished < CALLBACK_DEDUP_TTL
+
+# Отбрасывание повторных нажатий одной кнопки (выполняется раньше всех обработчиков)
+async def drop_repeated_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Двойное нажатие кнопки ("time|...", "delete_record:...") повторило бы запись в базу данных, задачи Google Sheets
+    и пересчет мест. Нажатие, пока предыдущее такое же обрабатывается или в течение CALLBACK_DEDUP_TTL секунд
+    после него, только гасит индикатор загрузки на кнопке.
+    """
+    query = update.callback_query
+    key = get_callback_guard_key(query)
+    now = time.monotonic()
+    # Ключи упорядочены по времени последнего изменения, поэтому устаревшие всегда в начале
+    while callback_guard:
+        if is_callback_guard_active(next(iter(callback_guard.values())), now):
+            break
+        callback_guard.popitem(last=False)
+    entry = callback_guard.get(key)
+    if entry and is_callback_guard_active(entry, now):
+        callback_guard_stats["dropped"] += 1
+        if entry[1] is not None:
+            callback_guard_stats["saved_seconds"] += entry[1] - entry[0]
+        logger.info(f"🔁 Повторное нажатие '{query.data}' пользователем {update.effective_user.id} проигнорировано")
+        try:
+            await query.answer()
+        except BadRequest:
+            pass
+        raise ApplicationHandlerStop
+    callback_guard[key] = [now, None]
+    callback_guard.move_to_end(key)
+
+# Отметка об окончании обработки нажатия (выполняется после всех обработчиков)
+async def finish_repeated_callback_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    key = get_callback_guard_key(update.callback_query)
+    entry = callback_guard.get(key)
+    if entry and entry[1] is None:
+        entry[1] = time.monotonic()
+        callback_guard.move_to_end(key)
+
+# Постраничная выборка получателей администраторского напоминания
+def iter_admin_reminder_recipient_pages(master_class_id, page_size=RECIPIENTS_PAGE_SIZE):
+    """Генератор страниц (списков user_id) получателей напоминания.
+
+    Сначала идут пользователи с активными записями (на все или на указанный мастер-класс),
+    в конце добавляются администраторы. Заблокировавшие бота пропускаются.
+    """
+    if master_class_id == 'all':
+        # Все пользователи с активными записями
+        registered_query = '''
+            SELECT DISTINCT r.user_id
+            FROM registrations r
+            LEFT JOIN bot_users u ON u.user_id = r.user_id
+            WHERE r.status IN ('создана', 'перенесена')
+            AND r.user_id > ?
+            AND COALESCE(u.blocked, 0) = 0
+            ORDER BY r.user_id
+            LIMIT ?
+        '''
+        registered_params = ()
+    else:
+        # Пользователи конкретного мастер-класса
+        registered_query = '''
+            SELECT DISTINCT r.user_id
+            FROM registrations r
+            LEFT JOIN bot_users u ON u.user_id = r.user_id
+            WHERE r.position = ?
+            AND r.status IN ('создана', 'перенесена')
+            AND r.user_id > ?
+            AND COALESCE(u.blocked, 0) = 0
+            ORDER BY r.user_id
+            LIMIT ?
+        '''
+        registered_params = (master_class_id,)
+
+    def fetch_pages(query, params):
+        last_user_id = 0
+        while True:
+            conn = get_connection()
+            if not conn:
+                logger.error("❌ Невозможно получить получателей напоминания: база данных недоступна")
+                return
+            try:
+                cursor = conn.cursor()
+                cursor.execute(query, params + (last_user_id, page_size))
+                page = [row[0] for row in cursor.fetchall()]
+            except sqlite3.Error as e:
+                logger.error(f"❌ Ошибка при получении пользователей для напоминания: {e}")
+                return
+            finally:
+                conn.close()
+            if not page:
+                return
+            yield page
+            if len(page) < page_size:
+                return
+            last_user_id = page[-1]
+
+    pending_admins = set(ADMIN_IDS)
+    for page in fetch_pages(registered_query, registered_params):
+        pending_admins.difference_update(page)
+        yield page
+
+    # ДОБАВЛЯЕМ ВСЕХ АДМИНИСТРАТОРОВ К СПИСКУ ПОЛУЧАТЕЛЕЙ
+    # Администраторы получают все админ-напоминания независимо от их регистраций
+    admin_users = [admin_id for admin_id in ADMIN_IDS if admin_id in pending_admins]
+    if admin_users:
+        logger.info(f"👑 Добавлено {len(admin_users)} администраторов к списку получателей")
+        yield admin_users
 
-# Проверка, нужно ли отправить относительное напоминание
-def should_send_relative_reminder(reminder, now):
-    reminder_id, master_class_id, title, message, reminder_type, schedule_type, day_of_week, reminder_date, reminder_time, time_offset, is_active, created_by, created_at, last_sent = reminder
+# Получение пользователей для отправки напоминания
+def get_users_for_admin_reminder(master_class_id):
+    return [user_id for page in iter_admin_reminder_recipient_pages(master_class_id) for user_id in page]
 
+# Разбор смещения относительного напоминания ("-1 hour", "-1 day", "-1 week")
+def parse_reminder_time_offset(time_offset):
+    """Возвращает timedelta для смещения относительного напоминания или None"""
     if not time_offset:
-        return False
+        return None
 
-    # Парсим смещение времени (например: "-1 hour", "-1 day", "-1 week")
     try:
         parts = time_offset.split()
         if len(parts) != 2:
-            return False
+            return None
 
         amount = int(parts[0])  # например: -1
         unit = parts[1].lower()  # например: "hour", "day", "week"
+    except (ValueError, IndexError) as e:
+        logger.error(f"❌ Ошибка при разборе смещения времени '{time_offset}': {e}")
+        return None
 
-        # Получаем все предстоящие мастер-классы
-        upcoming_classes = get_upcoming_master_classes()
-
-        for class_info in upcoming_classes:
-            class_id = class_info['id']
-            class_date = class_info['date']
-            class_time = class_info['time']
-            class_datetime_str = f"{class_date} {class_time}"
-            class_datetime = datetime.strptime(class_datetime_str, "%Y-%m-%d %H:%M").replace(tzinfo=timezone.utc)
+    if unit == 'hour':
+        return timedelta(hours=amount)
+    elif unit == 'day':
+        return timedelta(days=amount)
+    elif unit == 'week':
+        return timedelta(weeks=amount)
+    return None
 
-            # Проверяем, соответствует ли класс фильтру (all или конкретный ID)
-            if master_class_id != 'all' and master_class_id != class_id:
-                continue
+# Вычисление времени следующей отправки администраторского напоминания
+def compute_admin_reminder_next_fire_at(reminder, now=None):
+    """Возвращает unix timestamp следующей отправки напоминания или None, если отправлять нечего.
 
-            # Вычисляем время отправки напоминания
-            if unit == 'hour':
-                reminder_datetime = class_datetime + timedelta(hours=amount)
-            elif unit == 'day':
-                reminder_datetime = class_datetime + timedelta(days=amount)
-            elif unit == 'week':
-                reminder_datetime = class_datetime + timedelta(weeks=amount)
-            else:
-                continue
+    Напоминание, время которого прошло не более ADMIN_REMINDER_GRACE_PERIOD секунд назад,
+    считается еще не пропущенным (например, после перезапуска бота).
+    """
+    reminder_id, master_class_id, title, message, reminder_type, schedule_type, day_of_week, reminder_date, reminder_time, time_offset, is_active, created_by, created_at, last_sent = reminder
 
-            # Проверяем, совпадает ли текущее время со временем отправки
-            if (abs((now - reminder_datetime).total_seconds()) < 60 and  # В пределах 1 минуты
-                now >= reminder_datetime):  # Не отправлять до наступления времени
+    if not is_active:
+        return None
 
-                # Проверяем, не отправляли ли уже напоминание для этого класса
-                reminder_key = f"{reminder_id}_{class_id}_{class_date}"
-                if not was_relative_reminder_sent(reminder_key):
-                    # Помечаем как отправленное и возвращаем True
-                    mark_relative_reminder_sent(reminder_key)
-                    return True
+    if now is None:
+        now = datetime.now(MOSCOW_TZ)
+    earliest = now - timedelta(seconds=ADMIN_REMINDER_GRACE_PERIOD)
 
-    except (ValueError, IndexError) as e:
-        logger.error(f"❌ Ошибка при разборе смещения времени '{time_offset}': {e}")
-        return False
+    if reminder_type == 'relative_to_class':
+        offset = parse_reminder_time_offset(time_offset)
+        if offset is None:
+            return None
+        # Первое неотправленное занятие, время напоминания для которого еще не пропущено
+        index, keys = get_class_occurrence_index()
+        for start_ts, class_id, class_date, class_time in index[bisect.bisect_left(keys, (earliest - offset).timestamp()):]:
+            if master_class_id != 'all' and master_class_id != class_id:
+                continue
+            if not was_relative_reminder_sent(reminder_id, class_id, class_date):
+                return start_ts + offset.total_seconds()
+        return None
 
-    return False
+    try:
+        fire_time = datetime.strptime(reminder_time, "%H:%M").time()
+        last_sent_at = datetime.fromisoformat(last_sent.replace('Z', '+00:00')) if last_sent else None
+        if last_sent_at is not None and last_sent_at.tzinfo is None:
+            last_sent_at = last_sent_at.replace(tzinfo=MOSCOW_TZ)
+    except (ValueError, TypeError, AttributeError) as e:
+        logger.error(f"❌ Некорректное время напоминания ID {reminder_id}: {e}")
+        return None
 
-# Получение предстоящих мастер-классов
-def get_upcoming_master_classes():
-    """Получает список предстоящих мастер-классов"""
-    upcoming = []
-    now = datetime.now(MOSCOW_TZ)
+    if schedule_type == 'once':
+        # Одноразовое напоминание
+        try:
+            fire_at = datetime.combine(datetime.strptime(reminder_date, "%Y-%m-%d").date(), fire_time).replace(tzinfo=MOSCOW_TZ)
+        except (ValueError, TypeError) as e:
+            logger.error(f"❌ Некорректная дата напоминания ID {reminder_id}: {e}")
+            return None
+        # Уже отправлено (last_sent выставляется при захвате напоминания) или пропущено
+        if last_sent_at is not None and last_sent_at >= fire_at - timedelta(seconds=ADMIN_REMINDER_GRACE_PERIOD):
+            return None
+        if fire_at < earliest:
+            return None
+        return fire_at.timestamp()
 
-    for master_id, master_info in masters_data.items():
-        if not master_info.get("available", False):
-            continue
+    elif schedule_type == 'daily':
+        # Ежедневное напоминание - не чаще одного раза в день
+        fire_at = datetime.combine(now.date(), fire_time).replace(tzinfo=MOSCOW_TZ)
+        while fire_at < earliest or (last_sent_at is not None and last_sent_at.astimezone(MOSCOW_TZ).date() >= fire_at.date()):
+            fire_at += timedelta(days=1)
+        return fire_at.timestamp()
 
-        # Получаем даты начала и окончания
-        try:
-            date_start = datetime.strptime(master_info["date_start"], "%Y-%m-%d").date()
-            date_end = datetime.strptime(master_info["date_end"], "%Y-%m-%d").date()
-            time_start = datetime.strptime(master_info["time_start"], "%H:%M").time()
-
-            # Проходим по всем датам в диапазоне
-            current_date = date_start
-            while current_date <= date_end:
-                # Проверяем, является ли дата будущей или сегодняшней
-                class_datetime = datetime.combine(current_date, time_start).replace(tzinfo=timezone.utc)
-                if class_datetime >= now:
-                    upcoming.append({
-                        'id': master_id,
-                        'name': master_info['name'],
-                        'date': current_date.strftime("%Y-%m-%d"),
-                        'time': master_info["time_start"],
-                        'datetime': class_datetime
-                    })
-                current_date += timedelta(days=1)
-        except (ValueError, KeyError) as e:
-            logger.error(f"❌ Ошибка при обработке мастер-класса {master_id}: {e}")
-            continue
+    elif schedule_type == 'weekly':
+        # Еженедельное напоминание (в указанный день недели) - не чаще одного раза в неделю
+        if day_of_week is None:
+            return None
+        fire_date = now.date() + timedelta(days=(int(day_of_week) - now.weekday()) % 7)
+        fire_at = datetime.combine(fire_date, fire_time).replace(tzinfo=MOSCOW_TZ)
+        while fire_at < earliest or (last_sent_at is not None and last_sent_at.astimezone(MOSCOW_TZ).isocalendar()[:2] >= fire_at.isocalendar()[:2]):
+            fire_at += timedelta(weeks=1)
+        return fire_at.timestamp()
 
-    return upcoming
+    return None
 
-# Проверка, было ли отправлено относительное напоминание
-def was_relative_reminder_sent(reminder_key):
-    """Проверяет, было ли отправлено относительное напоминание"""
-    # Используем файл для отслеживания отправленных относительных напоминаний
-    sent_file = "relative_reminders_sent.txt"
+# Сохранение времени следующей отправки администраторского напоминания
+def set_admin_reminder_next_fire_at(reminder_id, next_fire_at):
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Невозможно сохранить время следующей отправки напоминания: база данных недоступна")
+        return False
 
     try:
-        with open(sent_file, 'r', encoding='utf-8') as f:
-            sent_keys = f.read().splitlines()
-        return reminder_key in sent_keys
-    except FileNotFoundError:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE admin_reminders SET next_fire_at = ? WHERE id = ?", (next_fire_at, reminder_id))
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка при сохранении времени следующей отправки напоминания: {e}")
         return False
+    finally:
+        conn.close()
 
-# Отмечаем относительное напоминание как отправленное
-def mark_relative_reminder_sent(reminder_key):
-    """Отмечает относительное напоминание как отправленное"""
-    sent_file = "relative_reminders_sent.txt"
+# Захват наступившего администраторского напоминания перед отправкой
+def claim_admin_reminder(reminder, now):
+    """Одним запросом переносит next_fire_at наступившего напоминания на следующее время отправки.
 
-    try:
-        with open(sent_file, 'a', encoding='utf-8') as f:
-            f.write(f"{reminder_key}\n")
-    except Exception as e:
-        logger.error(f"❌ Ошибка при сохранении статуса отправки относительного напоминания: {e}")
+    Прерванный на середине проход не отправит напоминание повторно. Возвращает False,
+    если напоминание уже захватил другой проход.
+    """
+    claimed = reminder[:13] + (now.isoformat(),)
+    next_fire_at = compute_admin_reminder_next_fire_at(claimed, now)
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Невозможно захватить напоминание: база данных недоступна")
+        return False
 
-# Отправка администраторского напоминания
-def send_admin_reminder(application, reminder):
-    reminder_id, master_class_id, title, message, reminder_type, schedule_type, day_of_week, reminder_date, reminder_time, time_offset, is_active, created_by, created_at, last_sent = reminder
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE admin_reminders SET next_fire_at = ?, last_sent = ?
+            WHERE id = ? AND is_active = 1 AND next_fire_at IS NOT NULL AND next_fire_at <= ?
+        ''', (next_fire_at, claimed[13], reminder[0], now.timestamp()))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка при захвате напоминания ID {reminder[0]}: {e}")
+        return False
+    finally:
+        conn.close()
 
-    logger.info(f"🚀 Начинаем отправку напоминания ID {reminder_id}: '{title}' для мастер-класса '{master_class_id}'")
+# Возврат захваченного напоминания, которое не удалось отправить
+def release_admin_reminder_claim(reminder, retry_at):
+    """Восстанавливает last_sent, чтобы неудачная отправка повторилась в пределах допуска"""
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Невозможно вернуть напоминание: база данных недоступна")
+        return None
 
     try:
-        # Получаем список пользователей для отправки
-        users = get_users_for_admin_reminder(master_class_id)
-        logger.info(f"👥 Найдено {len(users)} пользователей для отправки напоминания ID {reminder_id}")
-
-        # Для администраторских напоминаний конкретного мастер-класса,
-        # если нет зарегистрированных пользователей, отправляем всем пользователям бота
-        # (для промо-рассылок новых или полностью занятых мастер-классов)
-        if not users and master_class_id != 'all':
-            logger.info(f"ℹ️ Нет зарегистрированных пользователей для мастер-класса '{master_class_id}', отправка всем пользователям бота")
-            # Получаем всех пользователей бота для промо-рассылки
-            conn = get_connection()
-            if conn:
-                try:
-                    cursor = conn.cursor()
-                    cursor.execute('''
-                        SELECT DISTINCT user_id FROM registrations
-                        WHERE user_id IS NOT NULL
-                    ''')
-                    all_users = cursor.fetchall()
-                    users = [user[0] for user in all_users]
-
-                    # ДОБАВЛЯЕМ АДМИНИСТРАТОРОВ К ПРОМО-РАССЫЛКЕ
-                    admin_users = [admin_id for admin_id in ADMIN_IDS if admin_id not in users]
-                    if admin_users:
-                        users.extend(admin_users)
-                        logger.info(f"👑 Добавлено {len(admin_users)} администраторов к промо-рассылке")
-
-                    logger.info(f"📢 Найдено {len(users)} пользователей для промо-рассылки")
-                except Exception as e:
-                    logger.error(f"❌ Ошибка получения списка всех пользователей: {e}")
-                finally:
-                    conn.close()
+        cursor = conn.cursor()
+        cursor.execute("UPDATE admin_reminders SET last_sent = ? WHERE id = ?", (reminder[13], reminder[0]))
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка при возврате напоминания ID {reminder[0]}: {e}")
+        return None
+    finally:
+        conn.close()
+    return reschedule_admin_reminder(reminder[0], retry_at=retry_at)
 
-        if not users:
-            logger.info(f"ℹ️ Нет пользователей для отправки напоминания '{title}'")
-            return 0
+# Сброс ближайшего времени пробуждения фонового потока
+def invalidate_admin_reminders_wakeup():
+    """Заставляет фоновый поток перечитать ближайший next_fire_at из базы данных"""
+    global admin_reminders_next_wakeup
+    admin_reminders_next_wakeup = 0
+    reminder_worker_wakeup.set()
 
-        # Получаем название мастер-класса
-        if master_class_id == 'all':
-            master_name = "всех мастер-классов"
-        else:
-            master_name = masters_data.get(master_class_id, {}).get("name", master_class_id)
+# Пересчет времени следующей отправки одного напоминания
+def reschedule_admin_reminder(reminder_id, retry_at=None):
+    """Пересчитывает next_fire_at напоминания после создания, изменения или отправки.
 
-        # Формируем сообщение
-        full_message = f"📢 {title}\n\n{message}\n\n🎯 Мастер-класс: {master_name}"
+    retry_at позволяет повторить неудачную отправку, пока она не вышла за ADMIN_REMINDER_GRACE_PERIOD.
+    """
+    reminder = get_admin_reminder_by_id(reminder_id)
+    if not reminder:
+        return None
 
-        sent_count = 0
-        # Отправляем всем пользователям
-        for user_id in users:
-            try:
-                logger.info(f"📨 Отправка админ-напоминания пользователю {user_id}")
-                print(f"📨 Отправка админ-напоминания ID {reminder_id} пользователю {user_id}")
-                success = schedule_coroutine(application,
-                    send_reminder_to_user(application, user_id, full_message)
-                )
-                if success:
-                    sent_count += 1
-                    print(f"✅ MESSAGE SENT: to {user_id}")
-                else:
-                    print(f"❌ MESSAGE FAILED: to {user_id}")
-            except Exception as e:
-                logger.error(f"❌ Ошибка при отправке напоминания пользователю {user_id}: {e}")
-                print(f"❌ MESSAGE ERROR: to {user_id}, error: {e}")
+    next_fire_at = compute_admin_reminder_next_fire_at(reminder)
+    if retry_at is not None and next_fire_at is not None:
+        next_fire_at = max(next_fire_at, retry_at)
+    set_admin_reminder_next_fire_at(reminder_id, next_fire_at)
+    invalidate_admin_reminders_wakeup()
 
-        # Обновляем время последней отправки ТОЛЬКО при успешной отправке
-        if sent_count > 0:
-            conn = get_connection()
-        if conn:
-            try:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "UPDATE admin_reminders SET last_sent = ? WHERE id = ?",
-                        (datetime.now(MOSCOW_TZ).isoformat(), reminder_id)
-                )
-                conn.commit()
+    if next_fire_at is not None:
+        logger.debug(f"⏰ Напоминание ID {reminder_id} запланировано на {datetime.fromtimestamp(next_fire_at, MOSCOW_TZ)}")
+    return next_fire_at
 
-                # Логируем отправку
-                cursor.execute(
-                    "INSERT INTO admin_reminder_logs (reminder_id, sent_to_users) VALUES (?, ?)",
-                    (reminder_id, sent_count)
-                )
-                conn.commit()
-            except sqlite3.Error as e:
-                logger.error(f"❌ Ошибка при обновлении времени отправки: {e}")
-            finally:
-                conn.close()
+# Пересчет времени следующей отправки всех активных напоминаний
+def reschedule_all_admin_reminders(reminder_type=None):
+    """Пересчитывает next_fire_at для всех активных напоминаний (или только указанного типа)"""
+    global admin_reminders_schedule_signature
 
-        if sent_count > 0:
-            logger.info(f"✅ Отправлено администраторское напоминание '{title}' для {sent_count} пользователей")
-        else:
-            logger.warning(f"⚠️ Администраторское напоминание '{title}' не было отправлено никому")
-        return sent_count
+    if reminder_type in (None, 'relative_to_class'):
+        admin_reminders_schedule_signature = get_masters_schedule_signature()
 
-    except Exception as e:
-        logger.error(f"❌ Ошибка при отправке администраторского напоминания '{title}': {e}")
-        return 0
+    count = 0
+    for reminder in get_admin_reminders():
+        if reminder_type is not None and reminder[4] != reminder_type:
+            continue
+        set_admin_reminder_next_fire_at(reminder[0], compute_admin_reminder_next_fire_at(reminder))
+        count += 1
 
-# Проверка и отправка всех активных администраторских напоминаний
-def check_and_send_admin_reminders(application):
-    """Проверяет и отправляет активные администраторские напоминания"""
-    logger.info("🔔 Проверка администраторских напоминаний...")
+    invalidate_admin_reminders_wakeup()
+    logger.info(f"✅ Пересчитано время отправки для {count} администраторских напоминаний")
+    return count
 
-    # Debug: Log current time
-    now = datetime.now(MOSCOW_TZ)
-    logger.info(f"📅 Текущее время MSK: {now}")
+# Получение напоминаний, время отправки которых наступило
+def get_due_admin_reminders(now_ts):
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Невозможно получить администраторские напоминания: база данных недоступна")
+        return []
 
     try:
-        reminders = get_admin_reminders()
-        logger.info(f"📋 Найдено {len(reminders)} администраторских напоминаний в базе данных")
-
-        # Выводим список всех активных напоминаний в консоль
-        if reminders:
-            print("📋 СПИСОК АКТИВНЫХ АДМИН-НАПОМИНАНИЙ:")
-            for reminder in reminders:
-                rem_id, master_id, title, msg, rem_type, sched_type, day_week, rem_date, rem_time, offset, active, created_by, created_at, last_sent = reminder
-                status = "✅ ОТПРАВЛЕНО" if last_sent else "⏳ ОЖИДАЕТ"
-                print(f"  ID {rem_id}: '{title}' | Тип: {sched_type} | Время: {rem_date} {rem_time} | Статус: {status}")
-            print("📋 КОНЕЦ СПИСКА АКТИВНЫХ НАПОМИНАНИЙ")
-        else:
-            print("📋 АКТИВНЫХ АДМИН-НАПОМИНАНИЙ НЕ НАЙДЕНО")
-
-        sent_count = 0
-
-        for reminder in reminders:
-            reminder_id = reminder[0]
-            title = reminder[2]
-            schedule_type = reminder[5]
-            reminder_time = reminder[8]
-            reminder_date = reminder[7]
-            logger.info(f"🔍 Проверка админ-напоминания ID {reminder_id}: '{title}' (тип: {schedule_type}, дата: {reminder_date}, время: {reminder_time})")
-
-            if should_send_admin_reminder(reminder):
-                logger.info(f"✅ Админ-напоминание ID {reminder_id} должно быть отправлено")
-                print(f"🔔 АДМИН-НАПОМИНАНИЕ: ID {reminder_id} '{title}' - НАЧАЛО ОТПРАВКИ")
-                count = send_admin_reminder(application, reminder)
-                logger.info(f"📤 Админ-напоминание ID {reminder_id} отправлено {count} пользователям")
-                print(f"✅ АДМИН-НАПОМИНАНИЕ: ID {reminder_id} отправлено {count} пользователям")
-                sent_count += count
-            else:
-                logger.debug(f"⏸️ Админ-напоминание ID {reminder_id} не должно быть отправлено сейчас")
-                print(f"⏸️ АДМИН-НАПОМИНАНИЕ: ID {reminder_id} '{title}' - ожидает отправки ({schedule_type} {reminder_time})")
-
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, master_class_id, reminder_title, reminder_message, reminder_type,
+                   schedule_type, day_of_week, reminder_date, reminder_time, time_offset, is_active,
+                   created_by, created_at, last_sent
+            FROM admin_reminders
+            WHERE is_active = 1 AND next_fire_at IS NOT NULL AND next_fire_at <= ?
+            ORDER BY next_fire_at
+        ''', (now_ts,))
+        return cursor.fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка при получении администраторских напоминаний: {e}")
+        return []
+    finally:
+        conn.close()
+
+# Получение ближайшего времени отправки среди активных напоминаний
+def get_next_admin_reminder_fire_at():
+    conn = get_connection()
+    if not conn:
+        return None
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT MIN(next_fire_at) FROM admin_reminders WHERE is_active = 1 AND next_fire_at IS NOT NULL")
+        return cursor.fetchone()[0]
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка при получении времени следующей отправки напоминаний: {e}")
+        return None
+    finally:
+        conn.close()
+
+# Проверка, нужно ли отправить относительное напоминание
+def should_send_relative_reminder(reminder, now, window=60):
+    reminder_id, master_class_id, title, message, reminder_type, schedule_type, day_of_week, reminder_date, reminder_time, time_offset, is_active, created_by, created_at, last_sent = reminder
+
+    offset = parse_reminder_time_offset(time_offset)
+    if offset is None:
+        return False
+
+    # Напоминание отправляется в течение window секунд после (начало занятия + смещение),
+    # значит, нас интересуют занятия с началом в (now - offset - window, now - offset]
+    window_end = (now - offset).timestamp()
+    for start_ts, class_id, class_date, class_time in get_class_occurrences_between(window_end - window, window_end):
+        # Проверяем, соответствует ли класс фильтру (all или конкретный ID)
+        if master_class_id != 'all' and master_class_id != class_id:
+            continue
+
+        # Проверяем, не отправляли ли уже напоминание для этого класса
+        if not was_relative_reminder_sent(reminder_id, class_id, class_date):
+            # Помечаем как отправленное и возвращаем True
+            if mark_relative_reminder_sent(reminder_id, class_id, class_date):
+                return True
+
+    return False
+
+# Отметка об изменении расписания мастер-классов (вызывается после каждой записи в masters_data)
+def invalidate_masters_schedule():
+    global masters_schedule_version
+    masters_schedule_version += 1
+
+# Подпись расписания мастер-классов для отслеживания изменений masters_data
+def get_masters_schedule_signature():
+    """Возвращает кортеж полей masters_data, от которых зависит индекс занятий.
+
+    Подпись пересчитывается только после invalidate_masters_schedule().
+    """
+    global masters_schedule_signature_cache
+    # Версия читается до подсчета: изменение во время подсчета вызовет пересчет в следующий раз
+    version = masters_schedule_version
+    cached_version, signature = masters_schedule_signature_cache
+    if cached_version != version:
+        signature = tuple(sorted(
+            (master_id, bool(info.get("available", False)), info.get("date_start"), info.get("date_end"), info.get("time_start"))
+            for master_id, info in list(masters_data.items())
+        ))
+        masters_schedule_signature_cache = (version, signature)
+    return signature
+
+# Построение индекса занятий мастер-классов
+def rebuild_class_occurrence_index(signature=None):
+    """Разворачивает диапазоны дат мастер-классов в отсортированный список занятий"""
+    global class_occurrence_index, class_occurrence_index_keys, class_occurrence_index_signature
+
+    if signature is None:
+        signature = get_masters_schedule_signature()
+
+    occurrences = []
+    for master_id, available, date_start_str, date_end_str, time_start_str in signature:
+        if not available:
+            continue
+        try:
+            date_start = datetime.strptime(date_start_str, "%Y-%m-%d").date()
+            date_end = datetime.strptime(date_end_str, "%Y-%m-%d").date()
+            time_start = datetime.strptime(time_start_str, "%H:%M").time()
+        except (ValueError, TypeError) as e:
+            logger.error(f"❌ Ошибка при обработке мастер-класса {master_id}: {e}")
+            continue
+
+        current_date = date_start
+        while current_date <= date_end:
+            start_ts = datetime.combine(current_date, time_start).replace(tzinfo=MOSCOW_TZ).timestamp()
+            occurrences.append((start_ts, master_id, current_date.strftime("%Y-%m-%d"), time_start_str))
+            current_date += timedelta(days=1)
+
+    occurrences.sort()
+    with class_occurrence_index_lock:
+        class_occurrence_index = occurrences
+        class_occurrence_index_keys = [occurrence[0] for occurrence in occurrences]
+        class_occurrence_index_signature = signature
+    logger.debug(f"🔄 Индекс занятий перестроен: {len(occurrences)} занятий")
+
+# Получение актуального индекса занятий (перестраивается только при изменении masters_data)
+def get_class_occurrence_index():
+    """Возвращает (индекс занятий, ключи start_ts), перестраивая индекс при изменении расписания"""
+    signature = get_masters_schedule_signature()
+    if signature != class_occurrence_index_signature:
+        rebuild_class_occurrence_index(signature)
+    with class_occurrence_index_lock:
+        return class_occurrence_index, class_occurrence_index_keys
+
+# Занятия с началом в полуинтервале (start_ts_from, start_ts_to]
+def get_class_occurrences_between(start_ts_from, start_ts_to):
+    """Возвращает занятия, начинающиеся в (start_ts_from, start_ts_to], поиском bisect"""
+    index, keys = get_class_occurrence_index()
+    left = bisect.bisect_right(keys, start_ts_from)
+    right = bisect.bisect_right(keys, start_ts_to)
+    return index[left:right]
+
+# Получение предстоящих мастер-классов
+def get_upcoming_master_classes():
+    """Получает список предстоящих мастер-классов"""
+    index, keys = get_class_occurrence_index()
+    now_ts = datetime.now(MOSCOW_TZ).timestamp()
+
+    upcoming = []
+    for start_ts, master_id, class_date, class_time in index[bisect.bisect_left(keys, now_ts):]:
+        upcoming.append({
+            'id': master_id,
+            'name': masters_data.get(master_id, {}).get('name', master_id),
+            'date': class_date,
+            'time': class_time,
+            'datetime': datetime.fromtimestamp(start_ts, MOSCOW_TZ)
+        })
+
+    return upcoming
+
+# Загрузка отметок об отправке относительных напоминаний в кэш
+def load_relative_reminder_sends_cache():
+    """Загружает отметки об отправке относительных напоминаний из базы данных в кэш"""
+    global relative_reminder_sends_cache, relative_reminder_sends_cache_loaded
+
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Невозможно загрузить отметки относительных напоминаний: база данных недоступна")
+        return False
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT reminder_id, class_id, class_date FROM relative_reminder_sends")
+        with relative_reminder_sends_lock:
+            relative_reminder_sends_cache = {(row[0], row[1], row[2]) for row in cursor.fetchall()}
+            relative_reminder_sends_cache_loaded = True
+        logger.info(f"✅ Загружено {len(relative_reminder_sends_cache)} отметок относительных напоминаний")
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка загрузки отметок относительных напоминаний: {e}")
+        return False
+    finally:
+        conn.close()
+
+# Импорт отметок из старого файла relative_reminders_sent.txt
+def import_legacy_relative_reminder_sends():
+    """Переносит отметки из файла relative_reminders_sent.txt в базу данных и переименовывает файл"""
+    if not os.path.exists(LEGACY_RELATIVE_REMINDERS_FILE):
+        return 0
+
+    rows = []
+    try:
+        with open(LEGACY_RELATIVE_REMINDERS_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                # Формат ключа: {reminder_id}_{class_id}_{class_date}
+                parts = line.strip().split('_')
+                if len(parts) < 3 or not parts[0].isdigit():
+                    continue
+                rows.append((int(parts[0]), '_'.join(parts[1:-1]), parts[-1]))
+    except Exception as e:
+        logger.error(f"❌ Ошибка чтения файла {LEGACY_RELATIVE_REMINDERS_FILE}: {e}")
+        return 0
+
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Невозможно импортировать отметки относительных напоминаний: база данных недоступна")
+        return 0
+
+    try:
+        cursor = conn.cursor()
+        cursor.executemany(
+            "INSERT OR IGNORE INTO relative_reminder_sends (reminder_id, class_id, class_date) VALUES (?, ?, ?)",
+            rows
+        )
+        conn.commit()
+        os.replace(LEGACY_RELATIVE_REMINDERS_FILE, LEGACY_RELATIVE_REMINDERS_FILE + ".imported")
+        logger.info(f"✅ Импортировано {len(rows)} отметок из {LEGACY_RELATIVE_REMINDERS_FILE}")
+        return len(rows)
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"❌ Ошибка импорта отметок относительных напоминаний: {e}")
+        return 0
+    finally:
+        conn.close()
+
+# Проверка, было ли отправлено относительное напоминание
+def was_relative_reminder_sent(reminder_id, class_id, class_date):
+    """Проверяет по кэшу, было ли отправлено относительное напоминание для занятия"""
+    if not relative_reminder_sends_cache_loaded:
+        load_relative_reminder_sends_cache()
+    with relative_reminder_sends_lock:
+        return (reminder_id, class_id, class_date) in relative_reminder_sends_cache
+
+# Отмечаем относительное напоминание как отправленное
+def mark_relative_reminder_sent(reminder_id, class_id, class_date):
+    """Отмечает относительное напоминание как отправленное.
+
+    Возвращает True, если отметка создана этим вызовом, и False, если она уже существовала
+    (уникальный индекс не дает отправить одно напоминание дважды).
+    """
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Невозможно сохранить статус отправки относительного напоминания: база данных недоступна")
+        return False
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT OR IGNORE INTO relative_reminder_sends (reminder_id, class_id, class_date) VALUES (?, ?, ?)",
+            (reminder_id, class_id, class_date)
+        )
+        conn.commit()
+        with relative_reminder_sends_lock:
+            relative_reminder_sends_cache.add((reminder_id, class_id, class_date))
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка при сохранении статуса отправки относительного напоминания: {e}")
+        return False
+    finally:
+        conn.close()
+
+# Очистка устаревших отметок об отправке относительных напоминаний
+def cleanup_relative_reminder_sends():
+    """Удаляет отметки для занятий, прошедших более RELATIVE_REMINDER_SENDS_TTL_DAYS дней назад"""
+    global relative_reminder_last_cleanup
+
+    relative_reminder_last_cleanup = time.time()
+    cutoff_date = (datetime.now(MOSCOW_TZ) - timedelta(days=RELATIVE_REMINDER_SENDS_TTL_DAYS)).strftime("%Y-%m-%d")
+
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Невозможно очистить отметки относительных напоминаний: база данных недоступна")
+        return 0
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM relative_reminder_sends WHERE class_date < ?", (cutoff_date,))
+        deleted = cursor.rowcount
+        conn.commit()
+        with relative_reminder_sends_lock:
+            relative_reminder_sends_cache.difference_update(
+                {key for key in relative_reminder_sends_cache if key[2] < cutoff_date}
+            )
+        if deleted:
+            logger.info(f"🧹 Удалено {deleted} устаревших отметок относительных напоминаний")
+        return deleted
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка очистки отметок относительных напоминаний: {e}")
+        return 0
+    finally:
+        conn.close()
+
+# Отправка администраторского напоминания
+def send_admin_reminder(application, reminder, keep_alive=None):
+    reminder_id, master_class_id, title, message, reminder_type, schedule_type, day_of_week, reminder_date, reminder_time, time_offset, is_active, created_by, created_at, last_sent = reminder
+
+    logger.info(f"🚀 Начинаем отправку напоминания ID {reminder_id}: '{title}' для мастер-класса '{master_class_id}'")
+
+    try:
+        # Получаем название мастер-класса
+        if master_class_id == 'all':
+            master_name = "всех мастер-классов"
+        else:
+            master_name = masters_data.get(master_class_id, {}).get("name", master_class_id)
+
+        # Формируем сообщение
+        full_message = f"📢 {title}\n\n{message}\n\n🎯 Мастер-класс: {master_name}"
+
+        sent_count = 0
+        total_users = 0
+        # Отправляем получателям постранично, не загружая весь список в память
+        for users in iter_admin_reminder_recipient_pages(master_class_id):
+            # Продлеваем аренду прохода; отправку уже захваченного напоминания не прерываем
+            if keep_alive is not None:
+                keep_alive()
+            total_users += len(users)
+            for user_id in users:
+                try:
+                    logger.info(f"📨 Отправка админ-напоминания пользователю {user_id}")
+                    print(f"📨 Отправка админ-напоминания ID {reminder_id} пользователю {user_id}")
+                    success = schedule_coroutine(application,
+                        send_reminder_to_user(application, user_id, full_message)
+                    )
+                    if success:
+                        sent_count += 1
+                        print(f"✅ MESSAGE SENT: to {user_id}")
+                    else:
+                        print(f"❌ MESSAGE FAILED: to {user_id}")
+                except Exception as e:
+                    logger.error(f"❌ Ошибка при отправке напоминания пользователю {user_id}: {e}")
+                    print(f"❌ MESSAGE ERROR: to {user_id}, error: {e}")
+
+        logger.info(f"👥 Напоминание ID {reminder_id} обработано для {total_users} пользователей")
+        if not total_users:
+            logger.info(f"ℹ️ Нет пользователей для отправки напоминания '{title}'")
+            return 0
+
+        # Обновляем время последней отправки ТОЛЬКО при успешной отправке
+        conn = get_connection() if sent_count > 0 else None
+        if conn:
+            try:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "UPDATE admin_reminders SET last_sent = ? WHERE id = ?",
+                        (datetime.now(MOSCOW_TZ).isoformat(), reminder_id)
+                )
+                conn.commit()
+
+                # Логируем отправку
+                cursor.execute(
+                    "INSERT INTO admin_reminder_logs (reminder_id, sent_to_users) VALUES (?, ?)",
+                    (reminder_id, sent_count)
+                )
+                conn.commit()
+            except sqlite3.Error as e:
+                logger.error(f"❌ Ошибка при обновлении времени отправки: {e}")
+            finally:
+                conn.close()
+
+        logger.info(f"🚫 Статистика недоступных чатов: пропущено {chat_delivery_stats['skipped']}, отмечено {chat_delivery_stats['marked']}, восстановлено {chat_delivery_stats['cleared']}")
+        if sent_count > 0:
+            logger.info(f"✅ Отправлено администраторское напоминание '{title}' для {sent_count} пользователей")
+        else:
+            logger.warning(f"⚠️ Администраторское напоминание '{title}' не было отправлено никому")
+        return sent_count
+
+    except Exception as e:
+        logger.error(f"❌ Ошибка при отправке администраторского напоминания '{title}': {e}")
+        return 0
+
+# Проверка и отправка всех активных администраторских напоминаний
+def check_and_send_admin_reminders(application, keep_alive=None):
+    """Отправляет администраторские напоминания, время отправки (next_fire_at) которых наступило.
+
+    Пока ближайшее время отправки не наступило, обращений к базе данных нет.
+    keep_alive продлевает аренду прохода /tick; когда он возвращает False, проход останавливается.
+    Возвращает количество отправленных сообщений.
+    """
+    global admin_reminders_next_wakeup, admin_reminders_wakeup_refreshed
+
+    # Расписание мастер-классов изменилось - пересчитываем относительные напоминания
+    if get_masters_schedule_signature() != admin_reminders_schedule_signature:
+        reschedule_all_admin_reminders('relative_to_class')
+
+    now = datetime.now(MOSCOW_TZ)
+    # Напоминание могли создать или изменить в другом процессе - ближайшее время перечитывается
+    # из базы не реже раза в REMINDER_CHECK_INTERVAL
+    if now.timestamp() < admin_reminders_next_wakeup and time.time() - admin_reminders_wakeup_refreshed < REMINDER_CHECK_INTERVAL:
+        return 0
+
+    sent_count = 0
+    try:
+        for reminder in get_due_admin_reminders(now.timestamp()):
+            if keep_alive is not None and not keep_alive():
+                logger.info("⏱️ Время прохода вышло - остальные админ-напоминания будут отправлены в следующий раз")
+                break
+            reminder_id = reminder[0]
+            title = reminder[2]
+            reminder_type = reminder[4]
+            schedule_type = reminder[5]
+
+            if reminder_type == 'relative_to_class' and not should_send_relative_reminder(reminder, now, window=ADMIN_REMINDER_GRACE_PERIOD):
+                # Занятие уже обработано другим проходом - просто пересчитываем время
+                reschedule_admin_reminder(reminder_id)
+                continue
+
+            # Захватываем напоминание до отправки: next_fire_at переносится на следующее время
+            if not claim_admin_reminder(reminder, now):
+                logger.info(f"ℹ️ Админ-напоминание ID {reminder_id} уже отправляется другим проходом")
+                continue
+
+            logger.info(f"✅ Админ-напоминание ID {reminder_id} '{title}' ({schedule_type or reminder_type}) должно быть отправлено")
+            print(f"🔔 АДМИН-НАПОМИНАНИЕ: ID {reminder_id} '{title}' - НАЧАЛО ОТПРАВКИ")
+            count = send_admin_reminder(application, reminder, keep_alive)
+            logger.info(f"📤 Админ-напоминание ID {reminder_id} отправлено {count} пользователям")
+            print(f"✅ АДМИН-НАПОМИНАНИЕ: ID {reminder_id} отправлено {count} пользователям")
+            sent_count += count
+
+            # Неудачную отправку повторяем на следующей проверке (в пределах допуска)
+            if count == 0:
+                release_admin_reminder_claim(reminder, retry_at=time.time() + REMINDER_CHECK_INTERVAL)
+
         if sent_count > 0:
             logger.info(f"✅ Отправлено {sent_count} администраторских напоминаний")
             print(f"🔔 Отправлено {sent_count} администраторских напоминаний")
-        else:
-            logger.info("ℹ️ Администраторских напоминаний для отправки не найдено")
-            print("ℹ️ Администраторских напоминаний для отправки не найдено")
 
     except Exception as e:
         logger.error(f"❌ Ошибка при проверке администраторских напоминаний: {e}")
+    finally:
+        next_fire_at = get_next_admin_reminder_fire_at()
+        admin_reminders_next_wakeup = next_fire_at if next_fire_at is not None else float('inf')
+        admin_reminders_wakeup_refreshed = time.time()
+
+    return sent_count
 
 # Удаление записи по ID из базы данных И Google Sheets
 def delete_registration(reg_id):
@@ -2155,12 +4011,11 @@ def delete_registration(reg_id):
         logger.info(f"🗑️ Запись ID {reg_id} удалена из базы данных")
         
         # Асинхронно сохраняем в Google Sheets (для аудита)
-        if google_sheets_enabled:
-            async_save_to_google_sheets(reg_id, full_name, position_id, event_date, event_time, "Удаление", "удалена", TASK_PRIORITY_LOW)
+        async_save_to_google_sheets(reg_id, full_name, position_id, event_date, event_time, "Удаление", "удалена", TASK_PRIORITY_LOW)
         
         # Восстанавливаем место в мастер-классе (обязательно проверяем наличие position_id в masters_data)
-        if google_sheets_enabled and position_id in masters_data:
-            update_master_class_spots(position_id, change=1)
+        if position_id in masters_data:
+            update_master_class_spots(position_id)
         
         return True
     except sqlite3.Error as e:
@@ -2170,6 +4025,69 @@ def delete_registration(reg_id):
         if conn:
             conn.close()
 
+# Отмена всех активных записей на мастер-класс одной операцией
+def cancel_master_class_registrations(master_id):
+    """
+    Удаляет все активные записи на мастер-класс одним запросом и ставит в очередь
+    одно групповое обновление Google Sheets. Возвращает список удаленных записей
+    (id, full_name, event_date, event_time, user_id, family_member, family_account_holder_id)
+    или None при ошибке базы данных.
+    """
+    conn = get_connection()
+    if not conn:
+        logger.error(f"❌ Невозможно отменить записи на мастер-класс {master_id}: база данных недоступна")
+        return None
+
+    conn.isolation_level = None  # Транзакцией управляем явно
+    try:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute('''
+            SELECT id, full_name, event_date, event_time, user_id, family_member, family_account_holder_id
+            FROM registrations
+            WHERE position = ? AND status IN ('создана', 'перенесена')
+        ''', (master_id,))
+        records = cursor.fetchall()
+        cursor.execute('''
+            DELETE FROM registrations
+            WHERE position = ? AND status IN ('создана', 'перенесена')
+        ''', (master_id,))
+        cursor.execute("COMMIT")
+    except sqlite3.Error as e:
+        if conn.in_transaction:
+            conn.rollback()
+        logger.error(f"❌ Ошибка при отмене записей на мастер-класс {master_id}: {e}")
+        return None
+    finally:
+        conn.close()
+
+    logger.info(f"🗑️ Удалено {len(records)} записей на мастер-класс {master_id}")
+    if records and google_sheets_enabled:
+        enqueue_sheets_job(bulk_update_registrations_in_sheets, [record[0] for record in records], "Удаление", "удалена")
+    return records
+
+# Уведомление пользователей об отмене мастер-класса (одна фоновая задача на всю рассылку)
+async def notify_master_class_cancelled(application, master_name, records):
+    """Отправляет каждому владельцу записи одно сообщение со списком его отмененных записей"""
+    by_user = {}
+    for reg_id, full_name, event_date, event_time, user_id, family_member, family_account_holder_id in records:
+        notification_user_id = family_account_holder_id if family_member and family_account_holder_id else user_id
+        if notification_user_id:
+            by_user.setdefault(notification_user_id, []).append((full_name, event_date, event_time))
+
+    sent_count = 0
+    for notification_user_id, user_records in by_user.items():
+        message = "📢 ВАЖНОЕ УВЕДОМЛЕНИЕ О МАСТЕР-КЛАССЕ\n"
+        message += f"❌ Мастер-класс \"{master_name}\" ОТМЕНЕН\n"
+        for full_name, event_date, event_time in user_records:
+            message += f"👤 Ваша запись: {full_name} — {event_date} {event_time}\n"
+        message += "Свяжитесь с организаторами для получения дополнительной информации."
+        if await send_reminder_to_user(application, notification_user_id, message):
+            sent_count += 1
+
+    logger.info(f"✅ Уведомление об отмене мастер-класса \"{master_name}\" отправлено {sent_count} из {len(by_user)} пользователей")
+    return sent_count
+
 # Обновление записи в базе данных И Google Sheets
 def update_registration_field(reg_id, field_name, field_value, old_value=None):
     # Белый список допустимых полей для предотвращения SQL-инъекций
@@ -2196,18 +4114,17 @@ def update_registration_field(reg_id, field_name, field_value, old_value=None):
         # Если обновляется поле position и это не первоначальная запись
         if field_name == "position" and old_value:
             # Восстанавливаем место в старом мастер-классе
-            update_master_class_spots(old_value, change=1)
+            update_master_class_spots(old_value)
             # Занимаем место в новом мастер-классе
-            update_master_class_spots(field_value, change=-1)
+            update_master_class_spots(field_value)
         # Асинхронно сохраняем в Google Sheets
-        if google_sheets_enabled:
-            updated_record = get_registration_by_id(reg_id)
-            if updated_record:
-                _, full_name, position_id, event_date, event_time, status, _ = updated_record
-                action = f"Изменение {field_name}"
-                if field_name == "position":
-                    action = f"Изменение позиции (было: {old_value}, стало: {field_value})"
-                async_save_to_google_sheets(reg_id, full_name, position_id, event_date, event_time, action, "перенесена", TASK_PRIORITY_MEDIUM)
+        updated_record = get_registration_by_id(reg_id)
+        if updated_record:
+            _, full_name, position_id, event_date, event_time, status, _ = updated_record
+            action = f"Изменение {field_name}"
+            if field_name == "position":
+                action = f"Изменение позиции (было: {old_value}, стало: {field_value})"
+            async_save_to_google_sheets(reg_id, full_name, position_id, event_date, event_time, action, "перенесена", TASK_PRIORITY_MEDIUM)
         return True
     except sqlite3.Error as e:
         logger.error(f"❌ Ошибка при обновлении поля записи ID {reg_id}: {e}")
@@ -2235,23 +4152,20 @@ def update_registration_full(reg_id, event_date, event_time, old_date=None, old_
         logger.info(f"✅ SQL UPDATE выполнен успешно для записи ID {reg_id}: {event_date}, {event_time}")
 
         # Асинхронно сохраняем в Google Sheets (не блокируем основной поток)
-        if google_sheets_enabled:
-            try:
-                logger.info(f"📊 Планируем сохранение в Google Sheets для записи ID {reg_id}")
-                updated_record = get_registration_by_id(reg_id)
-                if updated_record:
-                    _, full_name, position_id, _, _, status, _ = updated_record
-                    action = "Изменение даты/времени"
-                    if old_date and old_time:
-                        action = f"Изменение времени (было: {old_date} {old_time}, стало: {event_date} {event_time})"
-                        logger.info(f"📤 Добавляем задачу в очередь Google Sheets для записи ID {reg_id}")
-                    async_save_to_google_sheets(reg_id, full_name, position_id, event_date, event_time, action, "перенесена", TASK_PRIORITY_MEDIUM)
-                else:
-                    logger.warning(f"⚠️ Не удалось получить обновленную запись ID {reg_id} для Google Sheets")
-            except Exception as e:
-                logger.error(f"❌ Ошибка при планировании сохранения в Google Sheets для записи ID {reg_id}: {e}")
-        else:
-            logger.info(f"ℹ️ Google Sheets отключен, пропускаем сохранение")
+        try:
+            logger.info(f"📊 Планируем сохранение в Google Sheets для записи ID {reg_id}")
+            updated_record = get_registration_by_id(reg_id)
+            if updated_record:
+                _, full_name, position_id, _, _, status, _ = updated_record
+                action = "Изменение даты/времени"
+                if old_date and old_time:
+                    action = f"Изменение времени (было: {old_date} {old_time}, стало: {event_date} {event_time})"
+                    logger.info(f"📤 Добавляем задачу в очередь Google Sheets для записи ID {reg_id}")
+                async_save_to_google_sheets(reg_id, full_name, position_id, event_date, event_time, action, "перенесена", TASK_PRIORITY_MEDIUM)
+            else:
+                logger.warning(f"⚠️ Не удалось получить обновленную запись ID {reg_id} для Google Sheets")
+        except Exception as e:
+            logger.error(f"❌ Ошибка при планировании сохранения в Google Sheets для записи ID {reg_id}: {e}")
 
         logger.info(f"✅ update_registration_full завершен успешно для записи ID {reg_id}")
         return True
@@ -2358,11 +4272,32 @@ def build_reminder_message(user_id, highlighted_reg_id=None, reminder_type="24h"
 
 async def send_reminder_to_user(application, user_id, message):
     """Отправляет напоминание пользователю"""
+    # Не тратим HTTP-запрос на пользователей, заблокировавших бота (проверка по набору в памяти)
+    if not unreachable_chats_loaded:
+        await run_db(load_unreachable_chats)
+    if user_id in unreachable_chats:
+        chat_delivery_stats["skipped"] += 1
+        logger.debug(f"🚫 Пропуск отправки недоступному чату {user_id}")
+        return False
+
     try:
         result = await application.bot.send_message(chat_id=user_id, text=message)
         logger.info(f"✅ Напоминание отправлено пользователю {user_id} (message_id: {result.message_id})")
         print(f"✅ MESSAGE SENT: to {user_id}, message_id: {result.message_id}")
         return True
+    except Forbidden as e:
+        # Бот заблокирован пользователем или аккаунт удален
+        status = "deactivated" if "deactivated" in str(e).lower() else "blocked"
+        await run_db(mark_chat_unreachable, user_id, status, str(e))
+        print(f"🚫 MESSAGE FAILED: to {user_id}, chat {status}")
+        return False
+    except BadRequest as e:
+        if "chat not found" in str(e).lower():
+            await run_db(mark_chat_unreachable, user_id, "not_found", str(e))
+        else:
+            logger.error(f"❌ Ошибка отправки напоминания пользователю {user_id}: {e}")
+        print(f"❌ MESSAGE FAILED: to {user_id}, error: {e}")
+        return False
     except Exception as e:
         logger.error(f"❌ Ошибка отправки напоминания пользователю {user_id}: {e}")
         print(f"❌ MESSAGE FAILED: to {user_id}, error: {e}")
@@ -2468,24 +4403,11 @@ def check_missed_reminders(application):
                         else:
                             logger.warning(f"⚠️ Не удалось создать сообщение для пропущенного напоминания {reminder_type}, запись {reg_id}")
 
-        # Проверяем пропущенные администраторские напоминания
+        # Проверяем пропущенные администраторские напоминания: пересчитываем next_fire_at
+        # (в пределах ADMIN_REMINDER_GRACE_PERIOD) и отправляем те, время которых наступило
         logger.info("🔍 Проверка пропущенных администраторских напоминаний...")
-        admin_reminders = get_admin_reminders()
-        for reminder in admin_reminders:
-            if should_send_admin_reminder(reminder):
-                reminder_id = reminder[0]
-                # Проверяем, было ли уже отправлено это напоминание
-                cursor.execute(
-                    "SELECT COUNT(*) FROM admin_reminder_logs WHERE reminder_id = ? AND sent_to_users > 0",
-                    (reminder_id,)
-                )
-                was_sent = cursor.fetchone()[0] > 0
-
-                if not was_sent:
-                    logger.info(f"📤 Отправка пропущенного админ-напоминания ID {reminder_id}")
-                    sent_count = send_admin_reminder(application, reminder)
-                    missed_reminders_count += sent_count
-                    logger.info(f"✅ Пропущенное админ-напоминание ID {reminder_id} отправлено {sent_count} пользователям")
+        reschedule_all_admin_reminders()
+        missed_reminders_count += check_and_send_admin_reminders(application)
 
         logger.info(f"✅ Проверка пропущенных напоминаний завершена. Отправлено: {missed_reminders_count} напоминаний")
 
@@ -2495,8 +4417,11 @@ def check_missed_reminders(application):
         if 'conn' in locals():
             conn.close()
 
-def check_and_send_reminders(application):
-    """Проверяет и отправляет напоминания пользователям за 24 часа и за 1 час до начала мастер-класса"""
+def check_and_send_reminders(application, keep_alive=None):
+    """Проверяет и отправляет напоминания пользователям за 24 часа и за 1 час до начала мастер-класса.
+
+    keep_alive продлевает аренду прохода /tick; когда он возвращает False, проход останавливается.
+    """
     global last_reminder_check
     current_time = time.time()
     if current_time - last_reminder_check < REMINDER_CHECK_INTERVAL:
@@ -2606,6 +4531,9 @@ def check_and_send_reminders(application):
         
         # Отправляем напоминания за 24 часа
         for record in records_24h:
+            if keep_alive is not None and not keep_alive():
+                logger.info("⏱️ Время прохода вышло - остальные напоминания за 24 часа будут отправлены в следующий раз")
+                break
             reg_id, full_name, position_id, event_date, event_time, user_id, family_member, family_account_holder_id = record
             if not user_id or was_reminder_sent(reg_id, "24h"):
                 continue
@@ -2638,6 +4566,9 @@ def check_and_send_reminders(application):
         # Отправляем напоминания за 60 минут
         logger.info(f"🔍 Проверка 60-минутных напоминаний: найдено {len(records_60min)} записей в окне 45-75 минут")
         for record in records_60min:
+            if keep_alive is not None and not keep_alive():
+                logger.info("⏱️ Время прохода вышло - остальные напоминания за 60 минут будут отправлены в следующий раз")
+                break
             reg_id, full_name, position_id, event_date, event_time, user_id, family_member, family_account_holder_id = record
             if not user_id:
                 logger.warning(f"⚠️ Пропущена запись {reg_id}: отсутствует user_id")
@@ -2800,6 +4731,24 @@ def reminder_worker(application):
 
     while reminder_worker_running:
         try:
+            # Напоминания и уведомления об изменениях отправляет только ведущий процесс
+            if not is_background_leader():
+                reminder_worker_wakeup.wait(LEADER_HEARTBEAT_INTERVAL)
+                reminder_worker_wakeup.clear()
+                continue
+            if background_takeover_pending.is_set():
+                background_takeover_pending.clear()
+                # Предыдущий ведущий мог отправить напоминания - перечитываем отметки и расписание
+                load_relative_reminder_sends_cache()
+                invalidate_admin_reminders_wakeup()
+                load_masters_data()
+                check_missed_reminders(application)
+            elif time.time() - masters_last_update > REMINDER_CHECK_INTERVAL:
+                # Мастер-классы могли изменить через другой процесс
+                load_masters_data()
+            # Периодически удаляем устаревшие отметки относительных напоминаний
+            if time.time() - relative_reminder_last_cleanup > RELATIVE_REMINDER_CLEANUP_INTERVAL:
+                cleanup_relative_reminder_sends()
             # Проверяем пользовательские напоминания
             check_and_send_reminders(application)
             # Проверяем администраторские напоминания
@@ -2827,85 +4776,151 @@ def reminder_worker(application):
                 schedule_coroutine(application,
                     notify_users_about_changes(application, master_id, "changed", old_data, new_data)
                 )
-            # Ждем перед следующей проверкой
-            time.sleep(REMINDER_CHECK_INTERVAL)
+            # Ждем до следующей проверки или до ближайшего админ-напоминания,
+            # если оно наступит раньше; изменение напоминаний будит поток досрочно
+            sleep_seconds = min(REMINDER_CHECK_INTERVAL, max(1, admin_reminders_next_wakeup - time.time()))
+            reminder_worker_wakeup.wait(sleep_seconds)
+            reminder_worker_wakeup.clear()
         except Exception as e:
             logger.error(f"❌ Ошибка в фоновом потоке напоминаний: {e}")
             time.sleep(60)  # Ждем минуту перед повторной попыткой
 
-# === ОБНОВЛЕНИЕ КОЛИЧЕСТВА МЕСТ ===
-def refresh_master_class_slots():
-    """Обновляет количество свободных мест для всех мастер-классов на основе текущих регистраций"""
+# Один проход фоновых задач (маршрут /tick для бессерверного развертывания)
+def run_tick(application, budget=TICK_TIME_BUDGET):
+    """
+    Выполняет один проход напоминаний и админ-напоминаний и, если осталось время, выгрузку
+    sheets_outbox и изменений мастер-классов в Google Sheets. Проход выполняется под арендой
+    BACKGROUND_LEASE_NAME: одновременные вызовы и работающий процесс в режиме worker не выполняют
+    его повторно. Возвращает словарь со статистикой.
+    """
+    global last_reminder_check, google_sheets_enabled
+    started = time.monotonic()
+    deadline = started + budget
+    stats = {"status": "ok", "admin_reminders_sent": 0, "outbox_processed": 0, "outbox_left": 0, "masters_synced": False}
+    # В процессе с фоновыми потоками эту работу уже выполняет ведущий
+    if bot_run_mode != "web":
+        stats["status"] = "skipped"
+        stats["elapsed"] = 0
+        return stats
+    # Аренда исключает другие процессы, блокировка - другие потоки этого процесса
+    if not tick_lock.acquire(blocking=False):
+        stats["status"] = "busy"
+        stats["elapsed"] = 0
+        return stats
+    lease_expires_at = acquire_worker_lease(BACKGROUND_LEASE_NAME, ttl=budget + LEADER_HEARTBEAT_INTERVAL)
+    if not lease_expires_at:
+        tick_lock.release()
+        stats["status"] = "busy"
+        stats["elapsed"] = round(time.monotonic() - started, 3)
+        return stats
+
+    # Продление аренды во время долгих проходов и проверка оставшегося времени
+    def keep_tick_alive():
+        nonlocal lease_expires_at
+        if time.time() > lease_expires_at - LEADER_HEARTBEAT_INTERVAL:
+            expires_at = acquire_worker_lease(BACKGROUND_LEASE_NAME, ttl=LEADER_LEASE_TTL)
+            if expires_at == 0 or (expires_at is None and time.time() >= lease_expires_at):
+                logger.warning("⚠️ Аренда прохода /tick потеряна - проход останавливается")
+                return False
+            if expires_at:
+                lease_expires_at = expires_at
+        return time.monotonic() < deadline
+
     try:
-        conn = get_connection()
-        if not conn:
-            logger.error("❌ Невозможно обновить места: база данных недоступна")
-            return False
-
-        cursor = conn.cursor()
-
-        # Получаем все мастер-классы
-        masters_to_update = {}
-        with masters_data_lock:
-            for master_id, master_info in masters_data.items():
-                masters_to_update[master_id] = master_info.copy()
+        # Состояние могли изменить другие экземпляры - перечитываем его из базы
+        load_relative_reminder_sends_cache()
+        invalidate_admin_reminders_wakeup()
+        load_masters_data()
+        last_reminder_check = 0
+        check_and_send_reminders(application, keep_tick_alive)
+        stats["admin_reminders_sent"] = check_and_send_admin_reminders(application, keep_tick_alive)
 
-        updated_count = 0
+        # Google Sheets - только в оставшееся время
+        if keep_tick_alive() and not google_sheets_initialized:
+            google_sheets_enabled = init_google_sheets()
+        if google_sheets_enabled:
+            set_sheets_priority(SHEETS_PRIORITY_BACKGROUND)
+            while stats["outbox_processed"] < TICK_OUTBOX_LIMIT and keep_tick_alive() and sheets_gateway.is_available():
+                claimed = claim_sheets_outbox(1)
+                if not claimed:
+                    break
+                outbox_id, kind, priority, payload = claimed[0]
+                try:
+                    data = json.loads(payload)
+                except ValueError as e:
+                    logger.error(f"❌ Поврежденная задача sheets_outbox {outbox_id}: {e}")
+                    continue
+                if kind == "registration":
+                    process_sheets_registration_task(tuple(data))
+                elif kind == "job" and data.get("func") in SHEETS_OUTBOX_JOBS:
+                    globals()[data["func"]](*data.get("args", []))
+                else:
+                    logger.error(f"❌ Неизвестная задача sheets_outbox {outbox_id}: {kind}")
+                    continue
+                # Google Sheets перестал отвечать - задача вернется в sheets_outbox до следующего прохода
+                if not sheets_gateway.is_available():
+                    add_to_sheets_outbox(kind, data, priority)
+                    break
+                stats["outbox_processed"] += 1
+            if keep_tick_alive() and sheets_gateway.is_available() and has_unsynced_master_classes():
+                stats["masters_synced"] = sync_master_classes_with_sheets(local_changes=True)
+    except Exception as e:
+        logger.error(f"❌ Ошибка прохода /tick: {e}")
+        stats["status"] = "error"
+        stats["error"] = str(e)
+    finally:
+        release_worker_lease(BACKGROUND_LEASE_NAME)
+        tick_lock.release()
+        stats["outbox_left"] = count_sheets_outbox()
+        stats["elapsed"] = round(time.monotonic() - started, 3)
+    logger.info(f"⏱️ Проход /tick: {stats}")
+    return stats
 
-        for master_id, master_info in masters_to_update.items():
-            # Подсчитываем активные регистрации для этого мастер-класса
-            cursor.execute('''
-                SELECT COUNT(*) FROM registrations
-                WHERE position = ? AND status IN ('создана', 'перенесена')
-                AND user_id IS NOT NULL
-            ''', (master_id,))
+# === ОБНОВЛЕНИЕ КОЛИЧЕСТВА МЕСТ ===
+def refresh_master_class_slots():
+    """Обновляет количество свободных мест для всех мастер-классов на основе текущих регистраций"""
+    conn = get_connection()
+    if not conn:
+        logger.error("❌ Невозможно обновить места: база данных недоступна")
+        return False
 
-            active_registrations = cursor.fetchone()[0]
-            total_spots = master_info.get('total_spots', 20)
-            new_free_spots = max(0, total_spots - active_registrations)
+    try:
+        cursor = conn.cursor()
+        # Подсчитываем активные регистрации для всех мастер-классов одним запросом
+        cursor.execute('''
+            SELECT position, COUNT(*) FROM registrations
+            WHERE status IN ('создана', 'перенесена') AND user_id IS NOT NULL
+            GROUP BY position
+        ''')
+        booked_by_master = dict(cursor.fetchall())
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка при обновлении количества мест: {e}")
+        return False
+    finally:
+        conn.close()
 
-            # Проверяем, нужно ли обновление
+    updated_count = 0
+    with masters_data_lock:
+        for master_id, master_info in masters_data.items():
+            active_registrations = booked_by_master.get(master_id, 0)
+            new_free_spots = max(0, master_info.get('total_spots', 20) - active_registrations)
             current_free_spots = master_info.get('free_spots', 0)
-            if new_free_spots != current_free_spots:
-                # Обновляем кэш
-                with masters_data_lock:
-                    if master_id in masters_data:
-                        masters_data[master_id]['free_spots'] = new_free_spots
-                        masters_data[master_id]['booked'] = active_registrations
-                        masters_data[master_id]['available'] = new_free_spots > 0
-
-                # Обновляем Google Sheets
-                try:
-                    if masters_sheet:
-                        # Находим строку с этим мастер-классом
-                        for row in range(2, masters_sheet.row_count + 1):  # Начинаем со второй строки (после заголовка)
-                            if masters_sheet.cell(row, 1).value == master_id:  # Предполагаем, что ID в первом столбце
-                                # Обновляем "Свободных мест" (столбец 3) и "Записано" (столбец 5)
-                                masters_sheet.update_cell(row, 3, str(new_free_spots))
-                                masters_sheet.update_cell(row, 5, str(active_registrations))
-
-                                # Обновляем статус доступности (столбец 10)
-                                available_status = "да" if new_free_spots > 0 else "нет"
-                                masters_sheet.update_cell(row, 10, available_status)
-                                break
-                except Exception as e:
-                    logger.error(f"❌ Ошибка обновления Google Sheets для {master_id}: {e}")
-
+            if new_free_spots != current_free_spots or master_info.get('booked') != active_registrations:
+                master_info['free_spots'] = new_free_spots
+                master_info['booked'] = active_registrations
+                master_info['available'] = master_info.get('enabled', True) and new_free_spots > 0
                 updated_count += 1
                 logger.info(f"🔄 Обновлены места для {master_id}: было {current_free_spots} свободно, стало {new_free_spots} (активных регистраций: {active_registrations})")
 
-        conn.close()
-
-        if updated_count > 0:
-            logger.info(f"✅ Обновлено количество мест для {updated_count} мастер-классов")
-        else:
-            logger.info("ℹ️ Количество мест актуально, обновлений не требуется")
-
-        return True
+    if updated_count > 0:
+        invalidate_masters_schedule()
+        # Лист обновится в фоне
+        masters_mirror_requested.set()
+        logger.info(f"✅ Обновлено количество мест для {updated_count} мастер-классов")
+    else:
+        logger.info("ℹ️ Количество мест актуально, обновлений не требуется")
 
-    except Exception as e:
-        logger.error(f"❌ Ошибка при обновлении количества мест: {e}")
-        return False
+    return True
 
 # === ГЕНЕРАЦИЯ КНОПОК ===
 # Генерация кнопок для выбора мастер-класса
@@ -3152,6 +5167,25 @@ async def handle_random_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # Если не можем отправить сообщение, игнорируем
         pass
 
+# Нажатие кнопки, которую не принял ни один обработчик
+async def handle_stale_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка из старого сообщения или диалога, завершенного по таймауту: гасим загрузку и показываем кнопку Start"""
+    query = update.callback_query
+    try:
+        await query.answer("⌛ Эта кнопка больше не активна")
+    except BadRequest:
+        pass
+    if not query.message:
+        return
+    keyboard = [[InlineKeyboardButton("🚀 Начать", callback_data="show_main_menu")]]
+    try:
+        await query.message.reply_text(
+            "👋 Время ожидания истекло. Нажмите кнопку ниже, чтобы открыть меню бота:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    except Exception:
+        pass
+
 # Обработчик для fallback в conversation handlers
 async def handle_random_text_fallback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Fallback обработчик для conversation handlers - показывает кнопку Start"""
@@ -3198,7 +5232,7 @@ async def about_event(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message += "📍 Место проведения: будет известно позже\n"
     message += "🎯 Доступные мастер-классы:\n"
     # Перезагружаем данные о мастер-классах перед отображением
-    load_masters_data()
+    await run_db(load_masters_data)
 
     if not masters_data:
         # Если данные из Google Sheets не загружены, используем временные данные
@@ -3285,7 +5319,7 @@ async def refresh_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     # Принудительно перезагружаем данные
-    success = load_masters_data()
+    success = await run_db(load_masters_data)
     if success:
         await query.answer("✅ Данные успешно обновлены!", show_alert=True)
     else:
@@ -3323,7 +5357,7 @@ async def get_full_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['user_id'] = update.effective_user.id  # Сохраняем ID пользователя
 
     # Проверяем все активные регистрации пользователя
-    user_registrations = get_user_registrations(update.effective_user.id)
+    user_registrations = await run_db(get_user_registrations, update.effective_user.id)
 
     if user_registrations:
         # Показываем все регистрации пользователя
@@ -3359,20 +5393,7 @@ async def get_full_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return MANAGE_MULTIPLE_RECORDS
     # Если нет активных регистраций, продолжаем обычную регистрацию
     # Проверяем, есть ли уже верифицированные регистрации от этого пользователя
-    conn = get_connection()
-    family_count = 0
-    if conn:
-        try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT COUNT(*) FROM registrations
-                WHERE user_id = ? AND telegram_verified = 1 AND status IN ('создана', 'перенесена')
-            ''', (update.effective_user.id,))
-            family_count = cursor.fetchone()[0]
-        except Exception as e:
-            logger.error(f"❌ Ошибка проверки семейных регистраций: {e}")
-        finally:
-            conn.close()
+    family_count = await run_db(count_verified_registrations, update.effective_user.id)
 
     # Предлагаем варианты регистрации
     keyboard = [
@@ -3407,7 +5428,7 @@ async def handle_registration_type(update: Update, context: ContextTypes.DEFAULT
         await query.edit_message_text(
             "👤 Регистрация для вас лично\n"
             "📝 Теперь выберите мастер-класс:",
-            reply_markup=get_masters_buttons()
+            reply_markup=await run_db(get_masters_buttons)
         )
         return POSITION_SELECTION
 
@@ -3420,7 +5441,7 @@ async def handle_registration_type(update: Update, context: ContextTypes.DEFAULT
         await query.edit_message_text(
             "👨‍👩‍👧‍👦 Регистрация члена семьи\n"
             "📝 Теперь выберите мастер-класс для члена вашей семьи:",
-            reply_markup=get_masters_buttons()
+            reply_markup=await run_db(get_masters_buttons)
         )
         return POSITION_SELECTION
 
@@ -3448,7 +5469,7 @@ async def manage_record(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reg_id = int(reg_id)
             context.user_data['record_id'] = reg_id
             # Получаем данные о текущей записи
-            record = get_registration_by_id(reg_id)
+            record = await run_db(get_registration_by_id, reg_id)
             if record:
                 _, _, master_id, old_date, old_time, _, _ = record
 
@@ -3494,7 +5515,7 @@ async def manage_record(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data['from_manage_multiple'] = True
 
             # Получаем данные о текущей записи
-            record = get_registration_by_id(reg_id)
+            record = await run_db(get_registration_by_id, reg_id)
             if record:
                 _, _, old_master_id, _, _, _, _ = record
 
@@ -3504,7 +5525,7 @@ async def manage_record(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     await query.edit_message_text(
                         "🔄 Вы выбрали изменение мастер-класса.\n"
                         "Выберите новый мастер-класс для записи:",
-                            reply_markup=get_masters_buttons(with_back=True)
+                            reply_markup=await run_db(get_masters_buttons, with_back=True)
                     )
                     return POSITION_SELECTION
                 else:
@@ -3536,7 +5557,7 @@ async def manage_record(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reg_id = int(reg_id)
 
             # Проверяем, существует ли запись перед удалением
-            record = get_registration_by_id(reg_id)
+            record = await run_db(get_registration_by_id, reg_id)
             if not record:
                 await safe_edit_message(
                     query,
@@ -3548,7 +5569,7 @@ async def manage_record(update: Update, context: ContextTypes.DEFAULT_TYPE):
             _, full_name, position_id, event_date, event_time, _, _ = record
             position_name = masters_data.get(position_id, {}).get("name", position_id)
 
-            success = delete_registration(reg_id)
+            success = await run_db(delete_registration, reg_id)
             if success:
                 await query.edit_message_text(
                     f"✅ Запись успешно удалена!\n"
@@ -3583,7 +5604,7 @@ async def manage_record(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = context.user_data.get('user_id')
 
         # Ищем запись пользователя
-        existing_record = get_existing_registration(full_name, user_id=user_id) if user_id else get_existing_registration(full_name)
+        existing_record = await run_db(get_existing_registration, full_name, user_id=user_id) if user_id else await run_db(get_existing_registration, full_name)
 
         if existing_record:
             reg_id, position_id, event_date, event_time, status = existing_record
@@ -3649,20 +5670,7 @@ async def manage_multiple_records(update: Update, context: ContextTypes.DEFAULT_
     if data == "register_new":
         # Продолжаем обычную регистрацию
         # Проверяем семейные регистрации
-        conn = get_connection()
-        family_count = 0
-        if conn:
-            try:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT COUNT(*) FROM registrations
-                    WHERE user_id = ? AND telegram_verified = 1 AND status IN ('создана', 'перенесена')
-                ''', (update.effective_user.id,))
-                family_count = cursor.fetchone()[0]
-            except Exception as e:
-                logger.error(f"❌ Ошибка проверки семейных регистраций: {e}")
-            finally:
-                conn.close()
+        family_count = await run_db(count_verified_registrations, update.effective_user.id)
 
         # Предлагаем варианты регистрации
         keyboard = [
@@ -3681,7 +5689,7 @@ async def manage_multiple_records(update: Update, context: ContextTypes.DEFAULT_
 
     elif data == "manage_existing":
         # Показываем список всех регистраций пользователя для управления
-        user_registrations = get_user_registrations(update.effective_user.id)
+        user_registrations = await run_db(get_user_registrations, update.effective_user.id)
 
         if not user_registrations:
             await query.edit_message_text(
@@ -3736,7 +5744,7 @@ async def manage_multiple_records(update: Update, context: ContextTypes.DEFAULT_
         reg_id = data.split(":")[1]
 
         # Получаем информацию о записи
-        record = get_registration_by_id(reg_id)
+        record = await run_db(get_registration_by_id, reg_id)
         if not record:
             await safe_edit_message(
                 query,
@@ -3801,7 +5809,7 @@ async def select_position(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.edit_message_text(
                     f"🚫 К сожалению, в мастер-классе '{master_info['name']}' нет свободных мест.\n"
                     "Пожалуйста, выберите другой мастер-класс:",
-                    reply_markup=get_masters_buttons(with_back=False)
+                    reply_markup=await run_db(get_masters_buttons, with_back=False)
                 )
                 return POSITION_SELECTION
             # Проверяем, есть ли ID записи в контексте (для изменения мастер-класса)
@@ -3827,12 +5835,12 @@ async def select_position(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 full_name = context.user_data.get('full_name')
                 if user_id and full_name:
                     # Get the current record to check its date/time
-                    current_record = get_registration_by_id(record_id)
+                    current_record = await run_db(get_registration_by_id, record_id)
                     if current_record:
                         _, _, _, event_date, event_time, _, _ = current_record
 
                         # Check if changing to this master-class at the same time would create a conflict
-                        if check_time_conflict(user_id, event_date, event_time):
+                        if await run_db(check_time_conflict, user_id, event_date, event_time):
                             # There's a conflict - ask user if they want to change date/time too
                             position_name = masters_data.get(master_id, {}).get("name", master_id)
                             await query.edit_message_text(
@@ -3849,10 +5857,10 @@ async def select_position(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             return MANAGE_MULTIPLE_RECORDS
 
                 # No conflict - proceed with changing master-class
-                update_registration_field(record_id, 'position', master_id, old_value=old_master_id)
+                await run_db(update_registration_field, record_id, 'position', master_id, old_value=old_master_id)
 
                 # Get updated record info
-                updated_record = get_registration_by_id(record_id)
+                updated_record = await run_db(get_registration_by_id, record_id)
                 if updated_record:
                     _, full_name, pos_id, event_date, event_time, status, _ = updated_record
                     position_name = masters_data.get(pos_id, {}).get("name", pos_id)
@@ -3917,7 +5925,7 @@ async def select_position(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             if record_id:
                 # Rescheduling flow - go back to record management
-                record = get_registration_by_id(record_id)
+                record = await run_db(get_registration_by_id, record_id)
                 if record:
                     _, full_name, pos_id, event_date, event_time, status, _ = record
                     position_name = masters_data.get(pos_id, {}).get("name", pos_id)
@@ -3941,14 +5949,14 @@ async def select_position(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # We're in change master-class flow - go back to master-class selection
                 await query.edit_message_text(
                     "🔄 Выберите новый мастер-класс для записи:",
-                    reply_markup=get_masters_buttons(with_back=True)
+                    reply_markup=await run_db(get_masters_buttons, with_back=True)
                 )
                 return POSITION_SELECTION
             else:
                 # Regular registration flow
                 await query.edit_message_text(
                     "Выберите мастер-класс для записи:",
-                    reply_markup=get_masters_buttons(with_back=True)
+                    reply_markup=await run_db(get_masters_buttons, with_back=True)
                 )
                 return POSITION_SELECTION
         elif data == "no_masters_available":
@@ -3964,7 +5972,7 @@ async def select_position(update: Update, context: ContextTypes.DEFAULT_TYPE):
             record_id = context.user_data.get('record_id')
             if record_id:
                 # We're in rescheduling flow, go back to record management
-                record = get_registration_by_id(record_id)
+                record = await run_db(get_registration_by_id, record_id)
                 if record:
                     _, full_name, pos_id, event_date, event_time, status, _ = record
                     position_name = masters_data.get(pos_id, {}).get("name", pos_id)
@@ -4024,7 +6032,8 @@ async def select_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
             _, year_str, month_str, master_id = parts
             year = int(year_str.strip())
             month = int(month_str.strip())
-            await query.edit_message_text(
+            await safe_edit_message(
+                query,
                 "Выберите дату проведения:",
                 reply_markup=get_calendar_buttons(month, year, master_id=master_id)
             )
@@ -4067,7 +6076,7 @@ async def select_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             if record_id:
                 # Rescheduling flow - go back to record management
-                record = get_registration_by_id(record_id)
+                record = await run_db(get_registration_by_id, record_id)
                 if record:
                     _, full_name, pos_id, event_date, event_time, status, _ = record
                     position_name = masters_data.get(pos_id, {}).get("name", pos_id)
@@ -4091,7 +6100,7 @@ async def select_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # Regular registration flow
                 await query.edit_message_text(
                     "Выберите мастер-класс для записи:",
-                    reply_markup=get_masters_buttons(with_back=True)
+                    reply_markup=await run_db(get_masters_buttons, with_back=True)
                 )
                 return POSITION_SELECTION
             return POSITION_SELECTION
@@ -4170,7 +6179,7 @@ async def select_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     return ConversationHandler.END
 
                 logger.info(f"🔄 Начинаем обновление записи ID {record_id} для переноса: {old_date} {old_time} → {date_str} {time_str}")
-                success = update_registration_full(record_id, date_str, time_str, old_date=old_date, old_time=old_time)
+                success = await run_db(update_registration_full, record_id, date_str, time_str, old_date=old_date, old_time=old_time)
                 if not success:
                     logger.error(f"❌ Не удалось обновить запись ID {record_id}")
                     await query.edit_message_text(
@@ -4182,7 +6191,7 @@ async def select_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     return ConversationHandler.END
                 logger.info(f"✅ Запись ID {record_id} успешно обновлена")
                 # Получаем обновленные данные записи
-                updated_record = get_registration_by_id(record_id)
+                updated_record = await run_db(get_registration_by_id, record_id)
                 if updated_record:
                     _, full_name, pos_id, event_date, event_time, status, _ = updated_record
                     position_name = masters_data.get(pos_id, {}).get("name", pos_id)
@@ -4207,38 +6216,35 @@ async def select_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     )
                 context.user_data.pop('record_id', None)
             else:
-                # Создаем новую запись
-                # Проверяем, нет ли уже активной регистрации на этот мастер-класс на эту же дату
-                existing_reg = get_existing_registration(full_name, user_id=user_id, position_id=master_id)
-                if existing_reg:
-                    existing_reg_id, existing_pos_id, existing_date, existing_time, existing_status = existing_reg
-                    # Проверяем, является ли существующая регистрация на ту же дату
-                    if existing_date == date_str:
-                        existing_master_name = masters_data.get(existing_pos_id, {}).get("name", existing_pos_id)
-                        await query.edit_message_text(
-                            f"🚫 Вы уже записаны на этот мастер-класс на выбранную дату!\n\n"
-                            f"👤 ФИО: {full_name}\n"
-                            f"🎯 Мастер-класс: {existing_master_name}\n"
-                            f"📅 Дата: {existing_date}\n"
-                            f"🕒 Время: {existing_time}\n"
-                            f"🔖 Статус: {existing_status}\n\n"
-                            f"Вы можете изменить существующую запись или выбрать другую дату:",
-                            reply_markup=InlineKeyboardMarkup([
-                                [InlineKeyboardButton("✏️ Изменить дату/время", callback_data=f"change_datetime:{existing_reg_id}")],
-                                [InlineKeyboardButton("🔄 Изменить мастер-класс", callback_data=f"change_position:{existing_reg_id}")],
-                                [InlineKeyboardButton("🗑️ Удалить запись", callback_data=f"delete_record:{existing_reg_id}")],
-                                [InlineKeyboardButton("🔙 Назад к выбору даты", callback_data=f"back_to_masters|{master_id}")]
-                            ])
-                        )
-                        return ConversationHandler.END
-                    else:
-                        # Разрешить регистрацию на другую дату того же мастер-класса
-                        pass
+                # Создаем новую запись: проверка дубликата, конфликта по времени, мест и сохранение - одной транзакцией
+                telegram_verified = context.user_data.get('telegram_verified', True)
+                family_member = context.user_data.get('family_member', False)
+                family_account_holder_id = context.user_data.get('family_account_holder_id')
+                booking = await run_db(book_slot, full_name, master_id, date_str, time_str, user_id, telegram_verified, family_member, family_account_holder_id)
+
+                if booking.status == BOOKING_DUPLICATE:
+                    existing_reg_id, existing_pos_id, existing_date, existing_time, existing_status = booking.existing
+                    existing_master_name = masters_data.get(existing_pos_id, {}).get("name", existing_pos_id)
+                    await query.edit_message_text(
+                        f"🚫 Вы уже записаны на этот мастер-класс!\n\n"
+                        f"👤 ФИО: {full_name}\n"
+                        f"🎯 Мастер-класс: {existing_master_name}\n"
+                        f"📅 Дата: {existing_date}\n"
+                        f"🕒 Время: {existing_time}\n"
+                        f"🔖 Статус: {existing_status}\n\n"
+                        f"Вы можете изменить существующую запись или выбрать другую дату:",
+                        reply_markup=InlineKeyboardMarkup([
+                            [InlineKeyboardButton("✏️ Изменить дату/время", callback_data=f"change_datetime:{existing_reg_id}")],
+                            [InlineKeyboardButton("🔄 Изменить мастер-класс", callback_data=f"change_position:{existing_reg_id}")],
+                            [InlineKeyboardButton("🗑️ Удалить запись", callback_data=f"delete_record:{existing_reg_id}")],
+                            [InlineKeyboardButton("🔙 Назад к выбору даты", callback_data=f"back_to_masters|{master_id}")]
+                        ])
+                    )
+                    return ConversationHandler.END
 
-                # Проверяем конфликты по времени (пользователь не может быть записан на два мастер-класса одновременно)
-                if check_time_conflict(user_id, date_str, time_str):
+                if booking.status == BOOKING_CONFLICT:
                     # Есть конфликт - показываем существующие регистрации на это время
-                    user_regs = get_user_registrations(user_id)
+                    user_regs = await run_db(get_user_registrations, user_id)
                     conflicting_regs = [reg for reg in user_regs if reg[3] == date_str and reg[4] == time_str]
 
                     message = f"⚠️ Конфликт времени! Вы уже записаны на мастер-класс в это время:\n\n"
@@ -4263,10 +6269,22 @@ async def select_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     await query.edit_message_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
                     return ConversationHandler.END
 
-                telegram_verified = context.user_data.get('telegram_verified', True)
-                family_member = context.user_data.get('family_member', False)
-                family_account_holder_id = context.user_data.get('family_account_holder_id')
-                reg_id = save_registration(full_name, master_id, date_str, time_str, user_id, telegram_verified, family_member, family_account_holder_id)
+                if booking.status != BOOKING_OK:
+                    error_text = (
+                        f"😔 На мастер-класс \"{master_name}\" больше нет свободных мест."
+                        if booking.status == BOOKING_FULL else
+                        "❌ Не удалось сохранить запись. Попробуйте еще раз позже."
+                    )
+                    await query.edit_message_text(
+                        error_text,
+                        reply_markup=InlineKeyboardMarkup([
+                            [InlineKeyboardButton("📝 Выбрать другой мастер-класс", callback_data="register")],
+                            [InlineKeyboardButton("🏠 Назад в меню", callback_data="back_to_menu")]
+                        ])
+                    )
+                    return ConversationHandler.END
+
+                reg_id = booking.reg_id
 
                 # Отправляем немедленное уведомление о регистрации (отдельное приватное сообщение)
                 if reg_id and user_id:
@@ -4333,7 +6351,7 @@ async def select_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             if record_id:
                 # Rescheduling flow - go back to record management
-                record = get_registration_by_id(record_id)
+                record = await run_db(get_registration_by_id, record_id)
                 if record:
                     _, full_name, pos_id, event_date, event_time, status, _ = record
                     position_name = masters_data.get(pos_id, {}).get("name", pos_id)
@@ -4357,7 +6375,7 @@ async def select_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # Regular registration flow
                 await query.edit_message_text(
                     "Выберите мастер-класс для записи:",
-                    reply_markup=get_masters_buttons(with_back=True)
+                    reply_markup=await run_db(get_masters_buttons, with_back=True)
                 )
                 return POSITION_SELECTION
         elif data == "back_to_menu":
@@ -4403,11 +6421,11 @@ async def find_record(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
     # Получаем ВСЕ активные записи пользователя (собственные + семейные)
-    existing_records = get_user_registrations(user_id, include_family_members=True)
+    existing_records = await run_db(get_user_registrations, user_id, include_family_members=True)
 
     # Если не нашли по user_id, попробуем по имени (старый способ для обратной совместимости)
     if not existing_records:
-        existing_records = get_registrations_by_name_legacy(full_name)
+        existing_records = await run_db(get_registrations_by_name_legacy, full_name)
 
     keyboard = [[InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -4549,6 +6567,13 @@ def mask_telegram_id(telegram_id):
 
 def async_save_to_google_sheets(reg_id, full_name, position_id, event_date, event_time, action, status, priority=TASK_PRIORITY_MEDIUM):
     """Асинхронно сохраняет данные в Google Sheets через очередь"""
+    # Фоновый поток этого процесса не запущен или Google Sheets в нем отключен
+    if has_local_sheets_worker() and not google_sheets_enabled:
+        return
+    # Без своего фонового потока задачу выполнит фоновый процесс
+    if not has_local_sheets_worker():
+        add_to_sheets_outbox("registration", [reg_id, full_name, position_id, event_date, event_time, action, status], priority)
+        return
     try:
         # Создаем задачу для сохранения данных участника
         task = (priority, (reg_id, full_name, position_id, event_date, event_time, action, status))
@@ -4566,42 +6591,348 @@ def get_main_menu_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
-# === ФУНКЦИИ АДМИН-ПАНЕЛИ ===
-async def show_participants_list(query, context, master_filter=None, title="👥 Список участников"):
-    """Показывает список участников с возможностью фильтрации по мастер-классу"""
-    conn = get_connection()
-    if not conn:
-        back_button_text = "🔙 Вернуться к редактированию" if master_filter else "🔙 Вернуться в админ-панель"
-        back_callback = f"admin_edit_master|{master_filter}" if master_filter else "back_to_admin_menu"
+# === СЕССИИ АДМИНИСТРАТОРОВ ===
+class AdminAuthStore:
+    """
+    Сессии администраторов и счетчики неудачных входов. Хранятся в базе данных со сроком действия
+    (общие для всех процессов, переживают перезапуск), перед базой - небольшой LRU-кэш процесса.
+    Кэш держит запись не дольше ADMIN_AUTH_CACHE_TTL секунд; отсутствие сессии не кэшируется,
+    чтобы вход, выполненный в другом процессе, был виден сразу.
+    """
+    def __init__(self, cache_size=ADMIN_AUTH_CACHE_SIZE, cache_ttl=ADMIN_AUTH_CACHE_TTL):
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.cache = OrderedDict()  # (вид, user_id) -> (значение, действительно до)
+        self.lock = threading.Lock()
+        self.last_purge = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "purged": 0}
+
+    def cache_get(self, key):
+        """Возвращает (найдено, значение)"""
+        now = time.time()
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry and entry[1] > now:
+                self.cache.move_to_end(key)
+                self.stats["hits"] += 1
+                return True, entry[0]
+            if entry:
+                del self.cache[key]
+            self.stats["misses"] += 1
+            return False, None
+
+    def cache_put(self, key, value, valid_until):
+        with self.lock:
+            self.cache[key] = (value, min(valid_until, time.time() + self.cache_ttl))
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def hit_ratio(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+    # Есть ли у пользователя действующая сессия администратора
+    def has_session(self, user_id):
+        found, _ = self.cache_get(("session", user_id))
+        if found:
+            return True
+        conn = get_connection()
+        if not conn:
+            logger.error(f"❌ Невозможно проверить сессию администратора {user_id}: база данных недоступна")
+            return False
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT expires_at FROM admin_sessions WHERE user_id = ? AND expires_at > ?", (user_id, time.time()))
+            row = cursor.fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"❌ Ошибка проверки сессии администратора {user_id}: {e}")
+            return False
+        finally:
+            conn.close()
+        if row:
+            self.cache_put(("session", user_id), True, row[0])
+        return row is not None
 
-        await query.edit_message_text(
-            "❌ Ошибка подключения к базе данных",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(back_button_text, callback_data=back_callback)]
-            ])
-        )
-        return
+    # Открытие сессии после верного пароля (счетчик неудачных входов сбрасывается)
+    def start_session(self, user_id):
+        conn = get_connection()
+        if not conn:
+            logger.error(f"❌ Невозможно сохранить сессию администратора {user_id}: база данных недоступна")
+            return False
+        now = time.time()
+        expires_at = now + ADMIN_SESSION_TTL
+        try:
+            conn.isolation_level = None
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute('''
+                INSERT INTO admin_sessions (user_id, created_at, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET created_at = excluded.created_at, expires_at = excluded.expires_at
+            ''', (user_id, now, expires_at))
+            cursor.execute("DELETE FROM admin_login_attempts WHERE user_id = ?", (user_id,))
+            cursor.execute("COMMIT")
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.rollback()
+            logger.error(f"❌ Ошибка сохранения сессии администратора {user_id}: {e}")
+            return False
+        finally:
+            conn.close()
+        self.cache_put(("session", user_id), True, expires_at)
+        self.cache_put(("attempts", user_id), None, expires_at)
+        self.purge_expired()
+        return True
 
-    try:
-        cursor = conn.cursor()
+    # Неудачные попытки входа: (время последней попытки, количество) или None
+    def get_login_attempts(self, user_id):
+        found, value = self.cache_get(("attempts", user_id))
+        if found:
+            return value
+        conn = get_connection()
+        if not conn:
+            logger.error(f"❌ Невозможно проверить попытки входа пользователя {user_id}: база данных недоступна")
+            return None
+        now = time.time()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT last_attempt, attempts, expires_at FROM admin_login_attempts
+                WHERE user_id = ? AND expires_at > ?
+            ''', (user_id, now))
+            row = cursor.fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"❌ Ошибка проверки попыток входа пользователя {user_id}: {e}")
+            return None
+        finally:
+            conn.close()
+        value = (row[0], row[1]) if row else None
+        self.cache_put(("attempts", user_id), value, row[2] if row else now + self.cache_ttl)
+        return value
 
-        # Формируем запрос в зависимости от фильтра
-        if master_filter:
+    # Учет неверного пароля: счетчик живет LOGIN_COOLDOWN секунд после последней попытки
+    def record_failed_login(self, user_id):
+        """Возвращает количество неудачных попыток подряд, включая эту"""
+        conn = get_connection()
+        if not conn:
+            logger.error(f"❌ Невозможно учесть попытку входа пользователя {user_id}: база данных недоступна")
+            return MAX_ATTEMPTS
+        now = time.time()
+        expires_at = now + LOGIN_COOLDOWN
+        try:
+            conn.isolation_level = None
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
             cursor.execute('''
-                SELECT id, full_name, position, event_date, event_time, user_id, family_member, family_account_holder_id
-                FROM registrations
-                WHERE status IN ('создана', 'перенесена') AND position = ?
-                ORDER BY event_date, event_time, full_name
-            ''', (master_filter,))
+                INSERT INTO admin_login_attempts (user_id, attempts, last_attempt, expires_at) VALUES (?, 1, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    attempts = CASE WHEN admin_login_attempts.expires_at > excluded.last_attempt
+                                    THEN admin_login_attempts.attempts + 1 ELSE 1 END,
+                    last_attempt = excluded.last_attempt,
+                    expires_at = excluded.expires_at
+            ''', (user_id, now, expires_at))
+            cursor.execute("SELECT attempts FROM admin_login_attempts WHERE user_id = ?", (user_id,))
+            attempts = cursor.fetchone()[0]
+            cursor.execute("COMMIT")
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.rollback()
+            logger.error(f"❌ Ошибка учета попытки входа пользователя {user_id}: {e}")
+            return MAX_ATTEMPTS
+        finally:
+            conn.close()
+        self.cache_put(("attempts", user_id), (now, attempts), expires_at)
+        self.purge_expired()
+        return attempts
+
+    # Удаление истекших сессий и счетчиков (не чаще раза в ADMIN_AUTH_PURGE_INTERVAL секунд)
+    def purge_expired(self):
+        now = time.time()
+        with self.lock:
+            if now - self.last_purge < ADMIN_AUTH_PURGE_INTERVAL:
+                return
+            self.last_purge = now
+        conn = get_connection()
+        if not conn:
+            return
+        try:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM admin_sessions WHERE expires_at <= ?", (now,))
+            purged = cursor.rowcount
+            cursor.execute("DELETE FROM admin_login_attempts WHERE expires_at <= ?", (now,))
+            purged += cursor.rowcount
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"❌ Ошибка очистки истекших сессий администраторов: {e}")
+            return
+        finally:
+            conn.close()
+        with self.lock:
+            self.stats["purged"] += purged
+
+admin_auth_store = AdminAuthStore()
+
+# === МАРШРУТИЗАЦИЯ CALLBACK-КНОПОК ===
+# Действие кнопки: часть callback_data до первого разделителя полей
+def get_callback_action(data):
+    """Возвращает (действие, разделитель или None)"""
+    action, separator = data, None
+    for candidate in CALLBACK_FIELD_SEPARATORS:
+        head, found, _ = action.partition(candidate)
+        if found:
+            action, separator = head, candidate
+    return action, separator
+
+# Поле "yes"/"no" в callback_data
+def parse_yes_no(value):
+    if value not in ("yes", "no"):
+        raise ValueError(f"ожидалось yes или no, получено {value!r}")
+    return value == "yes"
+
+CallbackRoute = namedtuple("CallbackRoute", ["action", "handler", "fields", "converters", "payload_type"])
+CallbackMatch = namedtuple("CallbackMatch", ["router", "route", "payload"])
+
+class CallbackActionFilter:
+    """Фильтр для CallbackQueryHandler(pattern=...): пропускает кнопки, действие которых входит в набор"""
+    def __init__(self, actions):
+        self.actions = frozenset(actions)
+
+    def __call__(self, data):
+        return isinstance(data, str) and get_callback_action(data)[0] in self.actions
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(sorted(self.actions))})"
+
+class CallbackRouteFilter(CallbackActionFilter):
+    """Фильтр по таблице маршрутов: результат разбора попадает в context.matches, и dispatch не разбирает кнопку повторно"""
+    def __init__(self, router, actions):
+        super().__init__(actions)
+        self.router = router
+
+    def __call__(self, data):
+        if not isinstance(data, str):
+            return False
+        route, payload = self.router.parse(data)
+        return CallbackMatch(self.router, route, payload) if route and route.action in self.actions else False
+
+# Фильтр кнопок по действиям (для обработчиков без таблицы маршрутов)
+def callback_actions(*actions):
+    return CallbackActionFilter(actions)
+
+class CallbackRouter:
+    """
+    Таблица маршрутов кнопок: действие -> обработчик и поля callback_data. Маршрут находится одним
+    обращением к словарю; поля после действия разбираются в именованный кортеж и приводятся к типу,
+    кнопки с неизвестным действием или некорректными полями не доходят до обработчика.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.routes = {}  # Действие -> CallbackRoute
+        self.exposed = set()  # Действия, кнопки которых принимает хотя бы одно состояние диалога
+
+    def add(self, action, handler, *fields):
+        """Поле - имя или (имя, преобразование, выбрасывающее ValueError); обработчик получает (update, context, payload)"""
+        if action in self.routes:
+            raise ValueError(f"Маршрут {action} уже есть в таблице {self.name}")
+        fields = tuple((field, None) if isinstance(field, str) else field for field in fields)
+        payload_type = namedtuple("CallbackPayload", [name for name, _ in fields])
+        # Строковые поля не преобразуются, поэтому маршрут без преобразований разбирается простым срезом
+        converters = tuple(convert for _, convert in fields) if any(convert for _, convert in fields) else None
+        self.routes[action] = CallbackRoute(action, handler, fields, converters, payload_type)
+
+    def parse(self, data):
+        """Возвращает (маршрут, поля); поля None, если их не хватает или они некорректны; маршрут None для неизвестного действия"""
+        action, separator = get_callback_action(data)
+        route = self.routes.get(action)
+        if not route:
+            return None, None
+        count = len(route.fields)
+        if not count:
+            return route, route.payload_type()
+        # Лишние поля отбрасываются
+        values = data.split(separator)[1:count + 1] if separator else []
+        if len(values) < count:
+            return route, None
+        if route.converters:
+            try:
+                values = [convert(value) if convert else value for convert, value in zip(route.converters, values)]
+            except ValueError:
+                return route, None
+        return route, route.payload_type._make(values)
+
+    def accepts(self, *actions):
+        """Фильтр кнопок для состояния диалога; без аргументов - все маршруты таблицы"""
+        unknown = [action for action in actions if action not in self.routes]
+        if unknown:
+            raise ValueError(f"Нет маршрутов {', '.join(unknown)} в таблице {self.name}")
+        actions = actions or tuple(self.routes)
+        self.exposed.update(actions)
+        return CallbackRouteFilter(self, actions)
+
+    def unreachable_routes(self):
+        """Маршруты, кнопки которых не принимает ни одно состояние диалога"""
+        return [action for action in self.routes if action not in self.exposed]
+
+    async def dispatch(self, update, context, default):
+        data = update.callback_query.data
+        match = context.matches[0] if context.matches else None
+        if isinstance(match, CallbackMatch) and match.router is self:
+            route, payload = match.route, match.payload
         else:
-            cursor.execute('''
-                SELECT id, full_name, position, event_date, event_time, user_id, family_member, family_account_holder_id
-                FROM registrations
-                WHERE status IN ('создана', 'перенесена')
-                ORDER BY event_date, event_time, full_name
-            ''')
+            route, payload = self.parse(data)
+        if route is None or payload is None:
+            logger.warning(f"⚠️ {'Неизвестная' if route is None else 'Некорректная'} кнопка ({self.name}): {data!r}")
+            return default
+        return await route.handler(update, context, payload)
+
+# Проверка маршрутов кнопок при запуске
+def check_callback_routes(conversation_handlers, routers):
+    """
+    Ищет обработчики кнопок, до которых не доходит очередь (раньше в том же состоянии стоит обработчик
+    без фильтра или фильтр, покрывающий все их действия), и маршруты, кнопки которых не принимает
+    ни одно состояние. Возвращает список найденных проблем.
+    """
+    problems = []
+    for conversation in conversation_handlers:
+        groups = [("точки входа", conversation.entry_points), ("fallbacks", conversation.fallbacks)]
+        groups += [(f"состояние {state}", handlers) for state, handlers in conversation.states.items()]
+        for group, handlers in groups:
+            covered = set()
+            catch_all = False
+            for handler in handlers:
+                if not isinstance(handler, CallbackQueryHandler):
+                    continue
+                pattern = handler.pattern
+                if catch_all or (isinstance(pattern, CallbackActionFilter) and pattern.actions <= covered):
+                    problems.append(f"{conversation.name}, {group}: обработчик {handler.callback.__name__} недостижим")
+                if pattern is None:
+                    catch_all = True
+                elif isinstance(pattern, CallbackActionFilter):
+                    covered |= pattern.actions
+    for router in routers:
+        for action in router.unreachable_routes():
+            problems.append(f"маршрут {action} таблицы {router.name} не принимает ни одно состояние")
+    for problem in problems:
+        logger.warning(f"⚠️ Маршрутизация кнопок: {problem}")
+    return problems
 
-        registrations = cursor.fetchall()
+# === ФУНКЦИИ АДМИН-ПАНЕЛИ ===
+async def show_participants_list(query, context, master_filter=None, title="👥 Список участников"):
+    """Показывает список участников с возможностью фильтрации по мастер-классу"""
+    try:
+        registrations = await run_db(get_active_participants, master_filter)
+        if registrations is None:
+            back_button_text = "🔙 Вернуться к редактированию" if master_filter else "🔙 Вернуться в админ-панель"
+            back_callback = f"admin_edit_master|{master_filter}" if master_filter else "back_to_admin_menu"
+
+            await query.edit_message_text(
+                "❌ Ошибка подключения к базе данных",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton(back_button_text, callback_data=back_callback)]
+                ])
+            )
+            return
 
         if not registrations:
             no_participants_msg = "📝 Нет активных регистраций"
@@ -4672,8 +7003,6 @@ async def show_participants_list(query, context, master_filter=None, title="👥
                 [InlineKeyboardButton(back_button_text, callback_data=back_callback)]
             ])
         )
-    finally:
-        conn.close()
 
 # Начало работы с админ-панелью
 async def admin_start_from_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -4722,14 +7051,15 @@ async def admin_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if current_state is not None and 0 <= current_state <= 5:  # States for user conversation
         context.user_data.clear()  # Clear user conversation data
 
-    if user_id in authorized_admins:
+    if await run_db(admin_auth_store.has_session, user_id):
         await admin_menu(update, context)
         return ADMIN_MENU
 
     # Проверяем, не в кулдауне ли пользователь
     current_time = time.time()
-    if user_id in login_attempts:
-        last_attempt_time, attempts = login_attempts[user_id]
+    login_info = await run_db(admin_auth_store.get_login_attempts, user_id)
+    if login_info:
+        last_attempt_time, attempts = login_info
         if attempts >= MAX_ATTEMPTS and current_time - last_attempt_time < LOGIN_COOLDOWN:
             await update.callback_query.answer(
                 f"❌ Слишком много неудачных попыток входа. Попробуйте через {LOGIN_COOLDOWN//60} минут.",
@@ -4749,14 +7079,14 @@ async def admin_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Проверка пароля администратора
 async def check_admin_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global login_attempts
     password = update.message.text.strip()
     user_id = update.effective_user.id
     current_time = time.time()
     
     # Проверяем, не в кулдауне ли пользователь
-    if user_id in login_attempts:
-        last_attempt_time, attempts = login_attempts[user_id]
+    login_info = await run_db(admin_auth_store.get_login_attempts, user_id)
+    if login_info:
+        last_attempt_time, attempts = login_info
         if attempts >= MAX_ATTEMPTS and current_time - last_attempt_time < LOGIN_COOLDOWN:
             remaining_time = int((last_attempt_time + LOGIN_COOLDOWN - current_time) // 60)
             await update.message.reply_text(
@@ -4766,10 +7096,8 @@ async def check_admin_password(update: Update, context: ContextTypes.DEFAULT_TYP
     
     # Хешируем введенный пароль для сравнения
     if password == ADMIN_PASSWORD_VALUE:
-        authorized_admins.add(user_id)
-        # Удаляем из лога попыток при успешном входе
-        if user_id in login_attempts:
-            del login_attempts[user_id]
+        # Открываем сессию и сбрасываем счетчик неудачных попыток
+        await run_db(admin_auth_store.start_session, user_id)
         logger.info(f"✅ Пользователь {user_id} авторизован как администратор")
         audit_logger.info(f"✅ Администратор {user_id} успешно авторизован")
 
@@ -4783,19 +7111,14 @@ async def check_admin_password(update: Update, context: ContextTypes.DEFAULT_TYP
             [InlineKeyboardButton("🏠 Вернуться в главное меню", callback_data="back_to_menu")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("✅ Пароль верный! Добро пожаловать в админ-панель!\n\n🔐 Админ-панель\nВыберите действие:", reply_markup=reply_markup)
+        await update.message.reply_text(f"✅ Пароль верный! Добро пожаловать в админ-панель!\n\n🔐 Админ-панель\n{await run_db(get_google_sheets_status_text)}\nВыберите действие:", reply_markup=reply_markup)
 
         return ADMIN_MENU
     else:
-        # Обновляем лог попыток входа
-        if user_id in login_attempts:
-            last_time, attempts = login_attempts[user_id]
-            login_attempts[user_id] = (current_time, attempts + 1)
-        else:
-            login_attempts[user_id] = (current_time, 1)
-        
+        # Обновляем счетчик попыток входа
+        attempts = await run_db(admin_auth_store.record_failed_login, user_id)
+
         # Проверяем, не превышено ли максимальное количество попыток
-        _, attempts = login_attempts[user_id]
         if attempts >= MAX_ATTEMPTS:
             logger.warning(f"❌ Пользователь {user_id} превысил лимит попыток входа в админ-панель")
             audit_logger.warning(f"❌ Попытка брутфорса админ-панели от пользователя {user_id}")
@@ -4836,7 +7159,7 @@ async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # )
 
     if update.message:
-        await update.message.reply_text("🔐 Админ-панель\nВыберите действие:", reply_markup=reply_markup)
+        await update.message.reply_text(f"🔐 Админ-панель\n{await run_db(get_google_sheets_status_text)}\nВыберите действие:", reply_markup=reply_markup)
         # Отправляем клавиатуру отдельно для постоянного доступа
         # await update.message.reply_text(
         #     "💡 Для быстрого доступа к меню используйте кнопку ниже:",
@@ -4845,839 +7168,843 @@ async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         query = update.callback_query
         await query.answer()
-        await query.edit_message_text("🔐 Админ-панель\nВыберите действие:", reply_markup=reply_markup)
+        await safe_edit_message(query, f"🔐 Админ-панель\n{await run_db(get_google_sheets_status_text)}\nВыберите действие:", reply_markup=reply_markup)
         # Отправляем клавиатуру отдельно для постоянного доступа
         # await query.message.reply_text(
         #     "💡 Для быстрого доступа к меню используйте кнопку ниже:",
         #     reply_markup=persistent_keyboard
         # )
 
-# Обработчик действий админ-панели
-async def admin_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Выход из админ-панели в главное меню
+async def admin_route_back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
     query = update.callback_query
-    await query.answer()
-    data = query.data
-    
-    if data == "back_to_menu":
-        await query.edit_message_text("🏠 Вы вернулись в главное меню")
-        await start(update, context)
-        return ConversationHandler.END
-    
-    if data == "admin_reload_data":
-        # Принудительное обновление данных из Google Sheets
-        success = load_masters_data()
-        if success:
-            # После загрузки данных проверяем изменения
-            changes = check_for_master_class_changes()
-            await query.edit_message_text(
-                "✅ Данные о мастер-классах успешно обновлены из Google Sheets!",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Вернуться в админ-панель", callback_data="back_to_admin_menu")]
-                ])
-            )
-        else:
-            await query.edit_message_text(
-                "❌ Ошибка при обновлении данных из Google Sheets",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Вернуться в админ-панель", callback_data="back_to_admin_menu")]
-                ])
-            )
-        return ADMIN_MENU
-
-    elif data == "admin_manage_users":
-        # Отображение списка всех участников
-        await show_participants_list(query, context, master_filter=None)
-        return ADMIN_MENU
+    await query.edit_message_text("🏠 Вы вернулись в главное меню")
+    await start(update, context)
+    return ConversationHandler.END
 
-    elif data.startswith("admin_manage_master_users|"):
-        # Отображение участников конкретного мастер-класса
-        master_id = data.split("|")[1]
-        master_name = masters_data.get(master_id, {}).get("name", master_id)
-        context.user_data['managing_master_id'] = master_id
+# Принудительное обновление данных: ручные правки листа переносятся в базу сразу,
+# а если Google Sheets недоступен - кэш перечитывается из базы, лист сверяется в фоне
+async def admin_route_reload_data(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    sheets_synced = False
+    if google_sheets_enabled and sheets_gateway.is_available():
+        sheets_synced = await run_sheets(sync_master_classes_with_sheets)
+    if not sheets_synced:
+        masters_mirror_requested.set()
+    success = await run_db(load_masters_data)
+    if success:
+        # После загрузки данных проверяем изменения
+        changes = check_for_master_class_changes()
+        await query.edit_message_text(
+            "✅ Данные о мастер-классах успешно обновлены из Google Sheets!" if sheets_synced else
+            "✅ Данные о мастер-классах обновлены из базы данных, лист Google Sheets будет сверен в фоне",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Вернуться в админ-панель", callback_data="back_to_admin_menu")]
+            ])
+        )
+    else:
+        await query.edit_message_text(
+            "❌ Ошибка при обновлении данных из Google Sheets",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Вернуться в админ-панель", callback_data="back_to_admin_menu")]
+            ])
+        )
+    return ADMIN_MENU
 
-        # Обновляем информацию о местах перед показом участников
-        refresh_master_class_slots()
+# Отображение списка всех участников
+async def admin_route_manage_users(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    await show_participants_list(query, context, master_filter=None)
+    return ADMIN_MENU
 
-        await show_participants_list(query, context, master_filter=master_id, title=f"👥 Участники мастер-класса: {master_name}")
-        return ADMIN_MENU
+# Отображение участников конкретного мастер-класса
+async def admin_route_manage_master_users(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    master_id = payload.master_id
+    master_name = masters_data.get(master_id, {}).get("name", master_id)
+    context.user_data['managing_master_id'] = master_id
 
-    elif data.startswith("admin_manage_specific_slots|"):
-        # Управление конкретными временными слотами
-        master_id = data.split("|")[1]
-        context.user_data['editing_master_id'] = master_id
-        await admin_show_specific_slots(query, context, master_id)
-        return ADMIN_SPECIFIC_TIME_SLOTS
+    # Обновляем информацию о местах перед показом участников
+    await run_db(refresh_master_class_slots)
 
-    elif data.startswith("admin_add_specific_slot|"):
-        # Начало добавления конкретного временного слота
-        master_id = data.split("|")[1]
-        context.user_data['editing_master_id'] = master_id
-        context.user_data['adding_slot'] = True
-        
-        await safe_edit_message_text(
-            query,
-            "📅 Введите дату для нового временного слота в формате YYYY-MM-DD\n"
-            "Например: 2025-12-07",
-                reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Отмена", callback_data=f"admin_manage_specific_slots|{master_id}")]
-                ])
-            )
-        return ADMIN_ADD_SPECIFIC_TIME_DATE
+    await show_participants_list(query, context, master_filter=master_id, title=f"👥 Участники мастер-класса: {master_name}")
+    return ADMIN_MENU
 
-    elif data.startswith("admin_delete_specific_slot|"):
-        # Удаление конкретного временного слота
-        await admin_delete_specific_slot_handler(query, context)
-        return ADMIN_SPECIFIC_TIME_SLOTS
+# Управление конкретными временными слотами
+async def admin_route_manage_specific_slots(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    master_id = payload.master_id
+    context.user_data['editing_master_id'] = master_id
+    await admin_show_specific_slots(query, context, master_id)
+    return ADMIN_SPECIFIC_TIME_SLOTS
 
-    elif data.startswith("admin_remove_user|"):
-        # Запрос подтверждения удаления участника
-        parts = data.split("|")
-        if len(parts) < 2:
-            return ADMIN_MENU
+# Начало добавления конкретного временного слота
+async def admin_route_add_specific_slot(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    master_id = payload.master_id
+    context.user_data['editing_master_id'] = master_id
+    context.user_data['adding_slot'] = True
+
+    await safe_edit_message_text(
+        query,
+        "📅 Введите дату для нового временного слота в формате YYYY-MM-DD\n"
+        "Например: 2025-12-07",
+            reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Отмена", callback_data=f"admin_manage_specific_slots|{master_id}")]
+            ])
+        )
+    return ADMIN_ADD_SPECIFIC_TIME_DATE
+
+# Удаление конкретного временного слота
+async def admin_route_delete_specific_slot(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    await admin_delete_specific_slot_handler(query, context)
+    return ADMIN_SPECIFIC_TIME_SLOTS
 
-        reg_id = parts[1]
+# Запрос подтверждения удаления участника
+async def admin_route_remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    reg_id = payload.reg_id
 
-        # Получаем информацию об участнике
-        conn = get_connection()
-        if not conn:
+    # Получаем информацию об участнике
+    try:
+        reg_data = await run_db(get_registration_by_id, reg_id)
+
+        if not reg_data:
             await query.edit_message_text(
-                "❌ Ошибка подключения к базе данных",
+                "❌ Участник не найден",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_manage_users")]
                 ])
             )
             return ADMIN_MENU
 
-        try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT full_name, position, event_date, event_time
-                FROM registrations WHERE id = ?
-            ''', (reg_id,))
-            reg_data = cursor.fetchone()
+        _, full_name, position_id, event_date, event_time, _, _ = reg_data
+        master_name = masters_data.get(position_id, {}).get("name", position_id)
 
-            if not reg_data:
-                await query.edit_message_text(
-                    "❌ Участник не найден",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_manage_users")]
-                    ])
-                )
-                return ADMIN_MENU
-
-            full_name, position_id, event_date, event_time = reg_data
-            master_name = masters_data.get(position_id, {}).get("name", position_id)
-
-            await query.edit_message_text(
-                f"⚠️ Вы уверены, что хотите удалить участника?\n\n"
-                f"👤 ФИО: {full_name}\n"
-                f"🎯 Мастер-класс: {master_name}\n"
-                f"📅 Дата и время: {event_date} {event_time}\n\n"
-                f"Это действие нельзя отменить!",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ Да, удалить", callback_data=f"confirm_remove_user|{reg_id}")],
-                    [InlineKeyboardButton("❌ Отмена", callback_data="admin_manage_users")]
-                ])
-            )
+        await query.edit_message_text(
+            f"⚠️ Вы уверены, что хотите удалить участника?\n\n"
+            f"👤 ФИО: {full_name}\n"
+            f"🎯 Мастер-класс: {master_name}\n"
+            f"📅 Дата и время: {event_date} {event_time}\n\n"
+            f"Это действие нельзя отменить!",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("✅ Да, удалить", callback_data=f"confirm_remove_user|{reg_id}")],
+                [InlineKeyboardButton("❌ Отмена", callback_data="admin_manage_users")]
+            ])
+        )
 
-        except Exception as e:
-            logger.error(f"❌ Ошибка при получении данных участника: {e}")
-            await query.edit_message_text(
-                "❌ Ошибка при загрузке данных участника",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_manage_users")]
-                ])
-            )
-        finally:
-            conn.close()
+    except Exception as e:
+        logger.error(f"❌ Ошибка при получении данных участника: {e}")
+        await query.edit_message_text(
+            "❌ Ошибка при загрузке данных участника",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_manage_users")]
+            ])
+        )
 
-        return ADMIN_MENU
+    return ADMIN_MENU
 
-    elif data.startswith("confirm_remove_user|"):
-        # Подтвержденное удаление участника
-        parts = data.split("|")
-        if len(parts) < 2:
-            return ADMIN_MENU
+# Подтвержденное удаление участника
+async def admin_route_confirm_remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    reg_id = payload.reg_id
 
-        reg_id = parts[1]
+    # Получаем информацию перед удалением для аудита
+    try:
+        reg_data = await run_db(get_registration_by_id, reg_id)
 
-        # Получаем информацию перед удалением для аудита
-        conn = get_connection()
-        if not conn:
-            await query.edit_message_text(
-                "❌ Ошибка подключения к базе данных",
+        if not reg_data:
+            await safe_edit_message(
+                query,
+                "❌ Участник не найден (возможно, уже был удален)",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_manage_users")]
                 ])
             )
             return ADMIN_MENU
 
-        try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT full_name, position, event_date, event_time, user_id
-                FROM registrations WHERE id = ?
-            ''', (reg_id,))
-            reg_data = cursor.fetchone()
-
-            if not reg_data:
-                await safe_edit_message(
-                    query,
-                    "❌ Участник не найден (возможно, уже был удален)",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_manage_users")]
-                    ])
-                )
-                return ADMIN_MENU
-
-            full_name, position_id, event_date, event_time, user_id = reg_data
-            master_name = masters_data.get(position_id, {}).get("name", position_id)
-
-            # Выполняем удаление
-            success = delete_registration(reg_id)
+        _, full_name, position_id, event_date, event_time, _, user_id = reg_data
+        master_name = masters_data.get(position_id, {}).get("name", position_id)
 
-            if success:
-                # Аудит действия администратора
-                user_id_admin = update.effective_user.id
-                logger.info(f"👮 Администратор {user_id_admin} удалил участника: {full_name} (ID: {reg_id})")
+        # Выполняем удаление
+        success = await run_db(delete_registration, reg_id)
 
-                await query.edit_message_text(
-                    f"✅ Участник успешно удален!\n\n"
-                    f"👤 ФИО: {full_name}\n"
-                    f"🎯 Мастер-класс: {master_name}\n"
-                    f"📅 Дата и время: {event_date} {event_time}",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_manage_users")]
-                    ])
-                )
-            else:
-                await query.edit_message_text(
-                    "❌ Ошибка при удалении участника",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_manage_users")]
-                    ])
-                )
+        if success:
+            # Аудит действия администратора
+            user_id_admin = update.effective_user.id
+            logger.info(f"👮 Администратор {user_id_admin} удалил участника: {full_name} (ID: {reg_id})")
 
-        except Exception as e:
-            logger.error(f"❌ Ошибка при удалении участника: {e}")
             await query.edit_message_text(
-                "❌ Ошибка при удалении участника",
+                f"✅ Участник успешно удален!\n\n"
+                f"👤 ФИО: {full_name}\n"
+                f"🎯 Мастер-класс: {master_name}\n"
+                f"📅 Дата и время: {event_date} {event_time}",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_manage_users")]
                 ])
             )
-        finally:
-            conn.close()
-
-        return ADMIN_MENU
-
-    elif data.startswith("admin_reminder_confirm_delete|"):
-        reminder_id = int(data.split("|")[1])
-        reminder = get_admin_reminder_by_id(reminder_id)
-
-        if reminder:
-            title = reminder[2]  # reminder_title
-            if delete_admin_reminder_permanently(reminder_id):
-                await query.edit_message_text(
-                    f"✅ Напоминание успешно удалено!\n\n"
-                    f"📝 Заголовок: {title}\n\n"
-                    f"Напоминание и все связанные логи удалены из базы данных.",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_view_reminders")]
-                    ])
-                )
-            else:
-                await query.edit_message_text(
-                    f"❌ Ошибка при удалении напоминания\n\n"
-                    f"📝 Заголовок: {title}",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_view_reminders")]
-                    ])
-                )
         else:
             await query.edit_message_text(
-                "❌ Напоминание не найдено",
+                "❌ Ошибка при удалении участника",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_view_reminders")]
+                    [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_manage_users")]
                 ])
             )
-        return ADMIN_MENU
 
-    elif data.startswith("admin_reminder_toggle|"):
-        reminder_id = int(data.split("|")[1])
-        reminder = get_admin_reminder_by_id(reminder_id)
+    except Exception as e:
+        logger.error(f"❌ Ошибка при удалении участника: {e}")
+        await query.edit_message_text(
+            "❌ Ошибка при удалении участника",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_manage_users")]
+            ])
+        )
+
+    return ADMIN_MENU
 
-        if reminder:
-            current_status = reminder[10]  # is_active
-            new_status = 0 if current_status else 1
-            update_admin_reminder(reminder_id, is_active=new_status)
+# Подтвержденное удаление напоминания
+async def admin_route_reminder_confirm_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    reminder_id = payload.reminder_id
+    reminder = await run_db(get_admin_reminder_by_id, reminder_id)
 
-            action = "деактивировано" if new_status == 0 else "активировано"
+    if reminder:
+        title = reminder[2]  # reminder_title
+        if await run_db(delete_admin_reminder_permanently, reminder_id):
             await query.edit_message_text(
-                f"✅ Напоминание {action}!",
+                f"✅ Напоминание успешно удалено!\n\n"
+                f"📝 Заголовок: {title}\n\n"
+                f"Напоминание и все связанные логи удалены из базы данных.",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_view_reminders")]
                 ])
             )
         else:
             await query.edit_message_text(
-                "❌ Напоминание не найдено",
+                f"❌ Ошибка при удалении напоминания\n\n"
+                f"📝 Заголовок: {title}",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_view_reminders")]
                 ])
             )
-        return ADMIN_MENU
+    else:
+        await query.edit_message_text(
+            "❌ Напоминание не найдено",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_view_reminders")]
+            ])
+        )
+    return ADMIN_MENU
 
-    elif data.startswith("admin_reminder_delete|"):
-        reminder_id = int(data.split("|")[1])
-        reminder = get_admin_reminder_by_id(reminder_id)
+# Включение и выключение напоминания
+async def admin_route_reminder_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    reminder_id = payload.reminder_id
+    reminder = await run_db(get_admin_reminder_by_id, reminder_id)
 
-        if reminder:
-            title = reminder[2]  # reminder_title
-            # Показываем подтверждение удаления
-            await query.edit_message_text(
-                f"⚠️ Подтверждение удаления\n\n"
-                f"Вы действительно хотите НАВСЕГДА удалить напоминание?\n\n"
-                f"📝 Заголовок: {title}\n\n"
-                f"Это действие нельзя отменить!",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("❌ Отмена", callback_data=f"admin_reminder_details|{reminder_id}")],
-                    [InlineKeyboardButton("🗑️ Удалить навсегда", callback_data=f"admin_reminder_confirm_delete|{reminder_id}")]
-                ])
-            )
-        else:
-            await query.edit_message_text(
-                "❌ Напоминание не найдено",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_view_reminders")]
-                ])
-            )
+    if reminder:
+        current_status = reminder[10]  # is_active
+        new_status = 0 if current_status else 1
+        await run_db(update_admin_reminder, reminder_id, is_active=new_status)
+
+        action = "деактивировано" if new_status == 0 else "активировано"
+        await query.edit_message_text(
+            f"✅ Напоминание {action}!",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_view_reminders")]
+            ])
+        )
+    else:
+        await query.edit_message_text(
+            "❌ Напоминание не найдено",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_view_reminders")]
+            ])
+        )
+    return ADMIN_MENU
+
+# Запрос подтверждения удаления напоминания
+async def admin_route_reminder_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    reminder_id = payload.reminder_id
+    reminder = await run_db(get_admin_reminder_by_id, reminder_id)
+
+    if reminder:
+        title = reminder[2]  # reminder_title
+        # Показываем подтверждение удаления
+        await query.edit_message_text(
+            f"⚠️ Подтверждение удаления\n\n"
+            f"Вы действительно хотите НАВСЕГДА удалить напоминание?\n\n"
+            f"📝 Заголовок: {title}\n\n"
+            f"Это действие нельзя отменить!",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("❌ Отмена", callback_data=f"admin_reminder_details|{reminder_id}")],
+                [InlineKeyboardButton("🗑️ Удалить навсегда", callback_data=f"admin_reminder_confirm_delete|{reminder_id}")]
+            ])
+        )
+    else:
+        await query.edit_message_text(
+            "❌ Напоминание не найдено",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_view_reminders")]
+            ])
+        )
+    return ADMIN_MENU
+
+# Подробности напоминания
+async def admin_route_reminder_details(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    reminder_id = payload.reminder_id
+    reminder = await run_db(get_admin_reminder_by_id, reminder_id)
+
+    if not reminder:
+        await query.edit_message_text(
+            "❌ Напоминание не найдено",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_view_reminders")]
+            ])
+        )
         return ADMIN_MENU
 
-    elif data.startswith("admin_reminder_details|"):
-        reminder_id = int(data.split("|")[1])
-        reminder = get_admin_reminder_by_id(reminder_id)
+    reminder_id, master_class_id, title, message, reminder_type, schedule_type, day_of_week, reminder_date, reminder_time, time_offset, is_active, created_by, created_at, last_sent = reminder
 
-        if not reminder:
-            await query.edit_message_text(
-                "❌ Напоминание не найдено",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_view_reminders")]
-                ])
-            )
-            return ADMIN_MENU
+    if master_class_id == 'all':
+        master_name = "Все мастер-классы"
+    else:
+        master_name = masters_data.get(master_class_id, {}).get("name", master_class_id)
 
-        reminder_id, master_class_id, title, message, reminder_type, schedule_type, day_of_week, reminder_date, reminder_time, time_offset, is_active, created_by, created_at, last_sent = reminder
+    if reminder_type == 'relative_to_class':
+        # Для относительных напоминаний показываем смещение
+        offset_desc = time_offset or "Не указано"
+        schedule_desc = f"Относительно занятия: {offset_desc}"
+    else:
+        schedule_desc = {
+            'once': f'Одноразово {reminder_date}',
+            'daily': 'Ежедневно',
+            'weekly': f'Еженедельно ({["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"][day_of_week] if day_of_week is not None else "?"})'
+        }.get(schedule_type, schedule_type)
 
-        if master_class_id == 'all':
-            master_name = "Все мастер-классы"
-        else:
-            master_name = masters_data.get(master_class_id, {}).get("name", master_class_id)
+    status = "✅ Активно" if is_active else "⏸️ Отключено"
+    last_sent_text = f"Последняя отправка: {last_sent[:16] if last_sent else 'Никогда'}" if last_sent else "Последняя отправка: Никогда"
 
-        if reminder_type == 'relative_to_class':
-            # Для относительных напоминаний показываем смещение
-            offset_desc = time_offset or "Не указано"
-            schedule_desc = f"Относительно занятия: {offset_desc}"
-        else:
-            schedule_desc = {
-                'once': f'Одноразово {reminder_date}',
-                'daily': 'Ежедневно',
-                'weekly': f'Еженедельно ({["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"][day_of_week] if day_of_week is not None else "?"})'
-            }.get(schedule_type, schedule_type)
+    keyboard = []
+    if is_active:
+        # Для активных напоминаний: деактивировать или удалить
+        keyboard.append([InlineKeyboardButton("⏸️ Деактивировать", callback_data=f"admin_reminder_toggle|{reminder_id}")])
+        keyboard.append([InlineKeyboardButton("🗑️ Удалить навсегда", callback_data=f"admin_reminder_delete|{reminder_id}")])
+    else:
+        # Для неактивных напоминаний: восстановить или удалить
+        keyboard.append([InlineKeyboardButton("✅ Восстановить", callback_data=f"admin_reminder_toggle|{reminder_id}")])
+        keyboard.append([InlineKeyboardButton("🗑️ Удалить навсегда", callback_data=f"admin_reminder_delete|{reminder_id}")])
 
-        status = "✅ Активно" if is_active else "⏸️ Отключено"
-        last_sent_text = f"Последняя отправка: {last_sent[:16] if last_sent else 'Никогда'}" if last_sent else "Последняя отправка: Никогда"
+    keyboard.append([InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_view_reminders")])
 
-        keyboard = []
-        if is_active:
-            # Для активных напоминаний: деактивировать или удалить
-            keyboard.append([InlineKeyboardButton("⏸️ Деактивировать", callback_data=f"admin_reminder_toggle|{reminder_id}")])
-            keyboard.append([InlineKeyboardButton("🗑️ Удалить навсегда", callback_data=f"admin_reminder_delete|{reminder_id}")])
-        else:
-            # Для неактивных напоминаний: восстановить или удалить
-            keyboard.append([InlineKeyboardButton("✅ Восстановить", callback_data=f"admin_reminder_toggle|{reminder_id}")])
-            keyboard.append([InlineKeyboardButton("🗑️ Удалить навсегда", callback_data=f"admin_reminder_delete|{reminder_id}")])
+    await query.edit_message_text(
+        f"🔔 Детали напоминания\n\n"
+        f"📌 ID: {reminder_id}\n"
+        f"📝 Заголовок: {title}\n"
+        f"🎯 Мастер-класс: {master_name}\n"
+        f"📅 Расписание: {schedule_desc}\n"
+        f"🕒 Время: {reminder_time}\n"
+        f"📊 Статус: {status}\n"
+        f"👤 Создано: {created_at[:16]}\n"
+        f"{last_sent_text}\n\n"
+        f"💬 Сообщение:\n{message}",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    return ADMIN_MENU
 
-        keyboard.append([InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_view_reminders")])
+# Отображение меню управления напоминаниями
+async def admin_route_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    keyboard = [
+        [InlineKeyboardButton("📋 Просмотреть напоминания", callback_data="admin_view_reminders")],
+        [InlineKeyboardButton("➕ Создать напоминание", callback_data="admin_create_reminder")],
+        [InlineKeyboardButton("🔙 Вернуться в админ-панель", callback_data="back_to_admin_menu")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(
+        "🔔 Управление напоминаниями\nВыберите действие:",
+        reply_markup=reply_markup
+    )
+    return ADMIN_MENU
 
+# Список активных напоминаний
+async def admin_route_view_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    # Получаем список активных напоминаний
+    reminders = await run_db(get_admin_reminders)
+    if not reminders:
+        keyboard = [[InlineKeyboardButton("🔙 Вернуться к напоминаниям", callback_data="admin_reminders")]]
         await query.edit_message_text(
-            f"🔔 Детали напоминания\n\n"
-            f"📌 ID: {reminder_id}\n"
-            f"📝 Заголовок: {title}\n"
-            f"🎯 Мастер-класс: {master_name}\n"
-            f"📅 Расписание: {schedule_desc}\n"
-            f"🕒 Время: {reminder_time}\n"
-            f"📊 Статус: {status}\n"
-            f"👤 Создано: {created_at[:16]}\n"
-            f"{last_sent_text}\n\n"
-            f"💬 Сообщение:\n{message}",
+            "📋 Активных напоминания нет",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
-        return ADMIN_MENU
+        return ADMIN_REMINDER_SELECT
+    else:
+        keyboard = []
+        for reminder in reminders:
+            reminder_id, master_class_id, title, message, reminder_type, schedule_type, day_of_week, reminder_date, reminder_time, time_offset, is_active, created_by, created_at, last_sent = reminder
 
-    elif data == "admin_reminders":
-        # Отображение меню управления напоминаниями
-        keyboard = [
-            [InlineKeyboardButton("📋 Просмотреть напоминания", callback_data="admin_view_reminders")],
-            [InlineKeyboardButton("➕ Создать напоминание", callback_data="admin_create_reminder")],
-            [InlineKeyboardButton("🔙 Вернуться в админ-панель", callback_data="back_to_admin_menu")]
-        ]
+            # Формируем описание напоминания
+            if master_class_id == 'all':
+                master_name = "Все мастер-классы"
+            else:
+                master_name = masters_data.get(master_class_id, {}).get("name", master_class_id)
+
+            schedule_desc = {
+                'once': f'Одноразово {reminder_date}',
+                'daily': 'Ежедневно',
+                'weekly': f'Еженедельно ({["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"][day_of_week] if day_of_week is not None else "?"})'
+            }.get(schedule_type, schedule_type)
+
+            status = "✅ Активно" if is_active else "⏸️ Отключено"
+            button_text = f"{title} - {master_name} ({schedule_desc}) {status}"
+
+            keyboard.append([InlineKeyboardButton(
+                button_text[:50] + "..." if len(button_text) > 50 else button_text,
+                callback_data=f"admin_reminder_details|{reminder_id}"
+            )])
+
+        keyboard.append([InlineKeyboardButton("🔙 Вернуться к напоминаниям", callback_data="admin_reminders")])
         reply_markup = InlineKeyboardMarkup(keyboard)
+
         await query.edit_message_text(
-            "🔔 Управление напоминаниями\nВыберите действие:",
+            f"📋 Активные напоминания ({len(reminders)}):\n\nВыберите напоминание для управления:",
             reply_markup=reply_markup
         )
-        return ADMIN_MENU
+    return ADMIN_REMINDER_SELECT
 
-    elif data == "admin_view_reminders":
-        # Получаем список активных напоминаний
-        reminders = get_admin_reminders()
-        if not reminders:
-            keyboard = [[InlineKeyboardButton("🔙 Вернуться к напоминаниям", callback_data="admin_reminders")]]
-            await query.edit_message_text(
-                "📋 Активных напоминания нет",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-            return ADMIN_REMINDER_SELECT
-        else:
-            keyboard = []
-            for reminder in reminders:
-                reminder_id, master_class_id, title, message, reminder_type, schedule_type, day_of_week, reminder_date, reminder_time, time_offset, is_active, created_by, created_at, last_sent = reminder
+# Начало создания напоминания
+async def admin_route_create_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    # Начинаем создание нового напоминания
+    context.user_data['creating_reminder'] = {}
+    keyboard = [
+        [InlineKeyboardButton("📝 Ввести заголовок", callback_data="admin_reminder_set_title")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(
+        "🔔 Создание нового напоминания\n\nШаг 1: Введите заголовок напоминания",
+        reply_markup=reply_markup
+    )
+    return ADMIN_REMINDER_TITLE
 
-                # Формируем описание напоминания
-                if master_class_id == 'all':
-                    master_name = "Все мастер-классы"
-                else:
-                    master_name = masters_data.get(master_class_id, {}).get("name", master_class_id)
+# Отображение списка мастер-классов для редактирования
+async def admin_route_edit_masters(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    await run_db(load_masters_data)
+    # Автоматически обновляем количество свободных мест на основе текущих регистраций
+    await run_db(refresh_master_class_slots)
+    keyboard = []
+    for master_id, master_info in masters_data.items():
+        keyboard.append([InlineKeyboardButton(
+            f"{master_info['name']} ({master_info['free_spots']}/{master_info['total_spots']})",
+            callback_data=f"admin_edit_master|{master_id}"
+        )])
+    keyboard.append([InlineKeyboardButton("🔙 Вернуться в админ-панель", callback_data="back_to_admin_menu")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(
+        "✏️ Выберите мастер-класс для редактирования:",
+        reply_markup=reply_markup
+    )
+    return ADMIN_EDIT_MASTER_SELECT
 
-                schedule_desc = {
-                    'once': f'Одноразово {reminder_date}',
-                    'daily': 'Ежедневно',
-                    'weekly': f'Еженедельно ({["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"][day_of_week] if day_of_week is not None else "?"})'
-                }.get(schedule_type, schedule_type)
+# Возврат в меню админ-панели
+async def admin_route_back_to_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    await admin_menu(update, context)
+    return ADMIN_MENU
 
-                status = "✅ Активно" if is_active else "⏸️ Отключено"
-                button_text = f"{title} - {master_name} ({schedule_desc}) {status}"
+# Меню редактирования мастер-класса
+async def admin_route_edit_master(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    master_id = payload.master_id
+    context.user_data['editing_master_id'] = master_id
+    # Обновляем информацию о местах перед отображением
+    await run_db(refresh_master_class_slots)
+    master_info = masters_data.get(master_id, {})
 
-                keyboard.append([InlineKeyboardButton(
-                    button_text[:50] + "..." if len(button_text) > 50 else button_text,
-                    callback_data=f"admin_reminder_details|{reminder_id}"
-                )])
+    keyboard = [
+        [InlineKeyboardButton("✏️ Изменить название", callback_data=f"admin_edit_field|name|{master_id}")],
+        [InlineKeyboardButton("📝 Изменить описание", callback_data=f"admin_edit_field|description|{master_id}")],
+        [InlineKeyboardButton("📅 Изменить даты проведения", callback_data=f"admin_edit_field|dates|{master_id}")],
+        [InlineKeyboardButton("⏰ Изменить время проведения", callback_data=f"admin_edit_field|times|{master_id}")],
+        [InlineKeyboardButton("🕐 Управление временными слотами", callback_data=f"admin_manage_specific_slots|{master_id}")],
+        [InlineKeyboardButton("🔢 Изменить количество мест", callback_data=f"admin_edit_field|spots|{master_id}")],
+        [InlineKeyboardButton("✅ Изменить доступность", callback_data=f"admin_edit_field|available|{master_id}")],
+        [InlineKeyboardButton("🚫 Исключить выходные", callback_data=f"admin_edit_field|exclude_weekends|{master_id}")],
+        [InlineKeyboardButton("👥 Управление участниками", callback_data=f"admin_manage_master_users|{master_id}")],
+        [InlineKeyboardButton("🗑️ Удалить мастер-класс", callback_data=f"admin_delete_master|{master_id}")],
+        [InlineKeyboardButton("🔙 Назад к списку", callback_data="admin_edit_masters")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
 
-            keyboard.append([InlineKeyboardButton("🔙 Вернуться к напоминаниям", callback_data="admin_reminders")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
+    # Форматируем отображение даты для удобства чтения
+    date_start = master_info.get("date_start", "2025-12-01")
+    date_end = master_info.get("date_end", "2026-01-31")
 
-            await query.edit_message_text(
-                f"📋 Активные напоминания ({len(reminders)}):\n\nВыберите напоминание для управления:",
-                reply_markup=reply_markup
-            )
-        return ADMIN_REMINDER_SELECT
+    await query.edit_message_text(
+        f"🔧 Редактирование: {master_info.get('name', master_id)}\n"
+        f"Свободных мест: {master_info.get('free_spots', 0)}/{master_info.get('total_spots', 0)}\n"
+        f"Период: {date_start} - {date_end}\n"
+        f"Время: {master_info.get('time_start', '10:00')} - {master_info.get('time_end', '12:00')}\n"
+        f"Доступен для записи: {'✅ Да' if master_info.get('available', True) else '❌ Нет'}\n"
+        f"Описание: {master_info.get('description', 'отсутствует')}",
+        reply_markup=reply_markup
+    )
+    return ADMIN_MENU
 
-    elif data == "admin_create_reminder":
-        # Начинаем создание нового напоминания
-        context.user_data['creating_reminder'] = {}
-        keyboard = [
-            [InlineKeyboardButton("📝 Ввести заголовок", callback_data="admin_reminder_set_title")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+# Выбор поля мастер-класса для редактирования
+async def admin_route_edit_field(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    field_type, master_id = payload.field_type, payload.master_id
+    context.user_data['editing_master_id'] = master_id
+    context.user_data['editing_field'] = field_type
+
+    master_info = masters_data.get(master_id, {})
+
+    if field_type == "name":
         await query.edit_message_text(
-            "🔔 Создание нового напоминания\n\nШаг 1: Введите заголовок напоминания",
-            reply_markup=reply_markup
+            f"✏️ Текущее название: {master_info.get('name', '')}\n"
+            "Введите новое название мастер-класса (можно использовать эмодзи):",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Отмена", callback_data=f"admin_edit_master|{master_id}")]
+            ])
         )
-        return ADMIN_REMINDER_TITLE
+        return ADMIN_EDIT_MASTER_NAME
 
-    elif data == "admin_edit_masters":
-        # Отображение списка мастер-классов для редактирования
-        load_masters_data()
-        # Автоматически обновляем количество свободных мест на основе текущих регистраций
-        refresh_master_class_slots()
-        keyboard = []
-        for master_id, master_info in masters_data.items():
-            keyboard.append([InlineKeyboardButton(
-                f"{master_info['name']} ({master_info['free_spots']}/{master_info['total_spots']})",
-                callback_data=f"admin_edit_master|{master_id}"
-            )])
-        keyboard.append([InlineKeyboardButton("🔙 Вернуться в админ-панель", callback_data="back_to_admin_menu")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    elif field_type == "description":
         await query.edit_message_text(
-            "✏️ Выберите мастер-класс для редактирования:",
-            reply_markup=reply_markup
+            f"📝 Текущее описание: {master_info.get('description', 'отсутствует')}\n"
+            "Введите новое описание для мастер-класса (можно использовать эмодзи):",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Отмена", callback_data=f"admin_edit_master|{master_id}")]
+            ])
+        )
+        return ADMIN_EDIT_MASTER_DESCRIPTION
+
+    elif field_type == "dates":
+        await query.edit_message_text(
+            f"📅 Текущие даты проведения:\n"
+            f"Начало: {master_info.get('date_start', '2025-12-01')}\n"
+            f"Окончание: {master_info.get('date_end', '2026-01-31')}\n"
+            "Введите новую дату начала в формате ГГГГ-ММ-ДД:",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Отмена", callback_data=f"admin_edit_master|{master_id}")]
+            ])
+        )
+        return ADMIN_EDIT_MASTER_DATE_START
+
+    elif field_type == "times":
+        await query.edit_message_text(
+            f"⏰ Текущее время проведения:\n"
+            f"Начало: {master_info.get('time_start', '10:00')}\n"
+            f"Окончание: {master_info.get('time_end', '12:00')}\n"
+            "Введите новое время начала в формате ЧЧ:ММ:",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Отмена", callback_data=f"admin_edit_master|{master_id}")]
+            ])
+        )
+        return ADMIN_EDIT_MASTER_TIME_START
+
+    elif field_type == "spots":
+        await query.edit_message_text(
+            f"🔢 Текущее количество мест:\n"
+            f"Всего: {master_info.get('total_spots', 0)}\n"
+            f"Свободно: {master_info.get('free_spots', 0)}\n"
+            "Введите новое общее количество мест (целое число):",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Отмена", callback_data=f"admin_edit_master|{master_id}")]
+            ])
+        )
+        return ADMIN_EDIT_MASTER_SPOTS
+
+    elif field_type == "available":
+        current_status = "✅ Доступен для записи" if master_info.get("available", True) else "❌ Закрыт для записи"
+        await query.edit_message_text(
+            f"✅ Текущий статус: {current_status}\n"
+            "Изменить статус доступности для записи:",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("✅ Сделать доступным", callback_data=f"admin_set_available|{master_id}|yes")],
+                [InlineKeyboardButton("❌ Сделать недоступным", callback_data=f"admin_set_available|{master_id}|no")],
+                [InlineKeyboardButton("🔙 Отмена", callback_data=f"admin_edit_master|{master_id}")]
+            ])
         )
-        return ADMIN_EDIT_MASTER_SELECT
-    
-    elif data == "back_to_admin_menu":
-        await admin_menu(update, context)
         return ADMIN_MENU
-    
-    elif data.startswith("admin_edit_master|"):
-        master_id = data.split("|")[1]
-        context.user_data['editing_master_id'] = master_id
-        # Обновляем информацию о местах перед отображением
-        refresh_master_class_slots()
-        master_info = masters_data.get(master_id, {})
-        
-        keyboard = [
-            [InlineKeyboardButton("✏️ Изменить название", callback_data=f"admin_edit_field|name|{master_id}")],
-            [InlineKeyboardButton("📝 Изменить описание", callback_data=f"admin_edit_field|description|{master_id}")],
-            [InlineKeyboardButton("📅 Изменить даты проведения", callback_data=f"admin_edit_field|dates|{master_id}")],
-            [InlineKeyboardButton("⏰ Изменить время проведения", callback_data=f"admin_edit_field|times|{master_id}")],
-            [InlineKeyboardButton("🕐 Управление временными слотами", callback_data=f"admin_manage_specific_slots|{master_id}")],
-            [InlineKeyboardButton("🔢 Изменить количество мест", callback_data=f"admin_edit_field|spots|{master_id}")],
-            [InlineKeyboardButton("✅ Изменить доступность", callback_data=f"admin_edit_field|available|{master_id}")],
-            [InlineKeyboardButton("🚫 Исключить выходные", callback_data=f"admin_edit_field|exclude_weekends|{master_id}")],
-            [InlineKeyboardButton("👥 Управление участниками", callback_data=f"admin_manage_master_users|{master_id}")],
-            [InlineKeyboardButton("🗑️ Удалить мастер-класс", callback_data=f"admin_delete_master|{master_id}")],
-            [InlineKeyboardButton("🔙 Назад к списку", callback_data="admin_edit_masters")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        # Форматируем отображение даты для удобства чтения
-        date_start = master_info.get("date_start", "2025-12-01")
-        date_end = master_info.get("date_end", "2026-01-31")
-        
+
+    elif field_type == "exclude_weekends":
+        current_status = "🚫 Выходные исключены" if master_info.get("exclude_weekends", False) else "✅ Выходные включены"
         await query.edit_message_text(
-            f"🔧 Редактирование: {master_info.get('name', master_id)}\n"
-            f"Свободных мест: {master_info.get('free_spots', 0)}/{master_info.get('total_spots', 0)}\n"
-            f"Период: {date_start} - {date_end}\n"
-            f"Время: {master_info.get('time_start', '10:00')} - {master_info.get('time_end', '12:00')}\n"
-            f"Доступен для записи: {'✅ Да' if master_info.get('available', True) else '❌ Нет'}\n"
-            f"Описание: {master_info.get('description', 'отсутствует')}",
-            reply_markup=reply_markup
+            f"🚫 Текущий статус: {current_status}\n"
+            "Изменить политику выходных дней:",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("✅ Включить выходные", callback_data=f"admin_set_exclude_weekends|{master_id}|no")],
+                [InlineKeyboardButton("🚫 Исключить выходные", callback_data=f"admin_set_exclude_weekends|{master_id}|yes")],
+                [InlineKeyboardButton("🔙 Отмена", callback_data=f"admin_edit_master|{master_id}")]
+            ])
         )
         return ADMIN_MENU
-    
-    elif data.startswith("admin_edit_field|"):
-        parts = data.split("|")
-        if len(parts) < 3:
-            return ADMIN_MENU
-        
-        field_type, master_id = parts[1], parts[2]
-        context.user_data['editing_master_id'] = master_id
-        context.user_data['editing_field'] = field_type
-        
-        master_info = masters_data.get(master_id, {})
-        
-        if field_type == "name":
-            await query.edit_message_text(
-                f"✏️ Текущее название: {master_info.get('name', '')}\n"
-                "Введите новое название мастер-класса (можно использовать эмодзи):",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Отмена", callback_data=f"admin_edit_master|{master_id}")]
-                ])
-            )
-            return ADMIN_EDIT_MASTER_NAME
-        
-        elif field_type == "description":
-            await query.edit_message_text(
-                f"📝 Текущее описание: {master_info.get('description', 'отсутствует')}\n"
-                "Введите новое описание для мастер-класса (можно использовать эмодзи):",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Отмена", callback_data=f"admin_edit_master|{master_id}")]
-                ])
-            )
-            return ADMIN_EDIT_MASTER_DESCRIPTION
-        
-        elif field_type == "dates":
-            await query.edit_message_text(
-                f"📅 Текущие даты проведения:\n"
-                f"Начало: {master_info.get('date_start', '2025-12-01')}\n"
-                f"Окончание: {master_info.get('date_end', '2026-01-31')}\n"
-                "Введите новую дату начала в формате ГГГГ-ММ-ДД:",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Отмена", callback_data=f"admin_edit_master|{master_id}")]
-                ])
-            )
-            return ADMIN_EDIT_MASTER_DATE_START
-        
-        elif field_type == "times":
-            await query.edit_message_text(
-                f"⏰ Текущее время проведения:\n"
-                f"Начало: {master_info.get('time_start', '10:00')}\n"
-                f"Окончание: {master_info.get('time_end', '12:00')}\n"
-                "Введите новое время начала в формате ЧЧ:ММ:",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Отмена", callback_data=f"admin_edit_master|{master_id}")]
-                ])
-            )
-            return ADMIN_EDIT_MASTER_TIME_START
-        
-        elif field_type == "spots":
-            await query.edit_message_text(
-                f"🔢 Текущее количество мест:\n"
-                f"Всего: {master_info.get('total_spots', 0)}\n"
-                f"Свободно: {master_info.get('free_spots', 0)}\n"
-                "Введите новое общее количество мест (целое число):",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Отмена", callback_data=f"admin_edit_master|{master_id}")]
-                ])
-            )
-            return ADMIN_EDIT_MASTER_SPOTS
-        
-        elif field_type == "available":
-            current_status = "✅ Доступен для записи" if master_info.get("available", True) else "❌ Закрыт для записи"
-            await query.edit_message_text(
-                f"✅ Текущий статус: {current_status}\n"
-                "Изменить статус доступности для записи:",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ Сделать доступным", callback_data=f"admin_set_available|{master_id}|yes")],
-                    [InlineKeyboardButton("❌ Сделать недоступным", callback_data=f"admin_set_available|{master_id}|no")],
-                    [InlineKeyboardButton("🔙 Отмена", callback_data=f"admin_edit_master|{master_id}")]
-                ])
-            )
-            return ADMIN_MENU
+    return ADMIN_MENU
 
-        elif field_type == "exclude_weekends":
-            current_status = "🚫 Выходные исключены" if master_info.get("exclude_weekends", False) else "✅ Выходные включены"
+# Изменение доступности мастер-класса для записи
+async def admin_route_set_available(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    master_id, new_status = payload.master_id, payload.new_status
+
+    try:
+        # Обновляем данные в кэше
+        if master_id in masters_data:
+            masters_data[master_id]["enabled"] = new_status
+            masters_data[master_id]["available"] = new_status and masters_data[master_id].get("free_spots", 0) > 0
+            invalidate_masters_schedule()
+
+        # Сохраняем в базе данных (лист обновится в фоне)
+        await run_db(save_master_class, master_id)
+
+        # Аудит действий администратора
+        user_id = update.effective_user.id
+        audit_logger.info(f"✅ Администратор {user_id} изменил доступность мастер-класса {master_id} на {'доступен' if new_status else 'недоступен'}")
+
+        status_text = "✅ Доступен для записи" if new_status else "❌ Закрыт для записи"
+        logger.info(f"✅ Статус доступности для мастер-класса {master_id} изменен на: {status_text}")
+
+        # Если это новый мастер-класс, переходим к настройке выходных
+        if context.user_data.get('is_new_master', False):
             await query.edit_message_text(
-                f"🚫 Текущий статус: {current_status}\n"
-                "Изменить политику выходных дней:",
+                f"✅ Статус доступности установлен: {status_text}\n"
+                "🚫 Шаг 9: Настройте политику выходных дней:",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("✅ Включить выходные", callback_data=f"admin_set_exclude_weekends|{master_id}|no")],
                     [InlineKeyboardButton("🚫 Исключить выходные", callback_data=f"admin_set_exclude_weekends|{master_id}|yes")],
-                    [InlineKeyboardButton("🔙 Отмена", callback_data=f"admin_edit_master|{master_id}")]
+                    [InlineKeyboardButton("🔙 Отмена", callback_data="admin_edit_masters")]
                 ])
             )
-            return ADMIN_MENU
-    
-    elif data.startswith("admin_set_available|"):
-        parts = data.split("|")
-        if len(parts) < 3:
-            return ADMIN_MENU
-        
-        master_id = parts[1]
-        new_status = parts[2] == "yes"
-        
-        try:
-            # Обновляем данные в кэше
-            if master_id in masters_data:
-                masters_data[master_id]["available"] = new_status
-            
-            # Обновляем в Google Sheets
-            if masters_sheet:
-                cell = masters_sheet.find(master_id)
-                if cell:
-                    masters_sheet.update_cell(cell.row, 10, "да" if new_status else "нет")
-            
-            # Аудит действий администратора
-            user_id = update.effective_user.id
-            audit_logger.info(f"✅ Администратор {user_id} изменил доступность мастер-класса {master_id} на {'доступен' if new_status else 'недоступен'}")
-            
-            status_text = "✅ Доступен для записи" if new_status else "❌ Закрыт для записи"
-            logger.info(f"✅ Статус доступности для мастер-класса {master_id} изменен на: {status_text}")
-            
-            # Если это новый мастер-класс, переходим к настройке выходных
-            if context.user_data.get('is_new_master', False):
-                await query.edit_message_text(
-                    f"✅ Статус доступности установлен: {status_text}\n"
-                    "🚫 Шаг 9: Настройте политику выходных дней:",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("✅ Включить выходные", callback_data=f"admin_set_exclude_weekends|{master_id}|no")],
-                        [InlineKeyboardButton("🚫 Исключить выходные", callback_data=f"admin_set_exclude_weekends|{master_id}|yes")],
-                        [InlineKeyboardButton("🔙 Отмена", callback_data="admin_edit_masters")]
-                    ])
-                )
-            else:
-                await query.edit_message_text(
-                    f"✅ Статус доступности успешно изменен!\n"
-                    f"Мастер-класс теперь: {status_text}",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 Вернуться к редактированию", callback_data=f"admin_edit_master|{master_id}")],
-                        [InlineKeyboardButton("🏠 Вернуться в админ-панель", callback_data="back_to_admin_menu")]
+        else:
+            await query.edit_message_text(
+                f"✅ Статус доступности успешно изменен!\n"
+                f"Мастер-класс теперь: {status_text}",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("🔙 Вернуться к редактированию", callback_data=f"admin_edit_master|{master_id}")],
+                    [InlineKeyboardButton("🏠 Вернуться в админ-панель", callback_data="back_to_admin_menu")]
+            ])
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка при изменении доступности мастер-класса {master_id}: {e}")
+        audit_logger.error(f"❌ Ошибка при изменении доступности мастер-класса {master_id} администратором {update.effective_user.id}: {e}")
+        await query.edit_message_text(
+            f"❌ Ошибка при изменении доступности: {e}",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Вернуться к редактированию", callback_data=f"admin_edit_master|{master_id}")],
+                [InlineKeyboardButton("🏠 Вернуться в админ-панель", callback_data="back_to_admin_menu")]
+            ])
+        )
+    return ADMIN_MENU
+
+# Запрос подтверждения удаления мастер-класса
+async def admin_route_delete_master(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    master_id = payload.master_id
+    context.user_data['deleting_master_id'] = master_id
+    master_name = masters_data.get(master_id, {}).get("name", master_id)
+
+    await query.edit_message_text(
+        f"⚠️ Вы уверены, что хотите удалить мастер-класс '{master_name}'?\n"
+        "Это действие нельзя отменить!\n\n"
+        "⚠️ ВНИМАНИЕ: Все записи на этот мастер-класс будут автоматически удалены!",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ Да, удалить", callback_data=f"confirm_delete_master|{master_id}")],
+            [InlineKeyboardButton("❌ Нет, отмена", callback_data=f"admin_edit_master|{master_id}")]
+        ])
+    )
+    return ADMIN_MENU
+
+# Изменение политики выходных мастер-класса
+async def admin_route_set_exclude_weekends(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    master_id, new_status = payload.master_id, payload.new_status
+
+    try:
+        # Обновляем данные в кэше
+        if master_id in masters_data:
+            masters_data[master_id]["exclude_weekends"] = new_status
+
+        # Сохраняем в базе данных (лист обновится в фоне)
+        await run_db(save_master_class, master_id)
+
+        # Аудит действий администратора
+        user_id = update.effective_user.id
+        audit_logger.info(f"🚫 Администратор {user_id} изменил политику выходных для мастер-класса {master_id} на {'исключены' if new_status else 'включены'}")
+
+        status_text = "🚫 Выходные исключены" if new_status else "✅ Выходные включены"
+        logger.info(f"🚫 Политика выходных для мастер-класса {master_id} изменена на: {status_text}")
+
+        # Если это новый мастер-класс, завершаем создание
+        if context.user_data.get('is_new_master', False):
+            # Очищаем флаги создания
+            context.user_data.pop('is_new_master', None)
+            context.user_data.pop('editing_master_id', None)
+
+            await query.edit_message_text(
+                f"✅ Мастер-класс успешно создан!\n\n"
+                f"🆔 ID: {master_id}\n"
+                f"📝 Название: {masters_data[master_id].get('name', '')}\n"
+                f"📅 Даты: {masters_data[master_id].get('date_start', '')} - {masters_data[master_id].get('date_end', '')}\n"
+                f"⏰ Время: {masters_data[master_id].get('time_start', '')} - {masters_data[master_id].get('time_end', '')}\n"
+                f"🪑 Мест: {masters_data[master_id].get('total_spots', 0)}\n"
+                f"✅ Доступен: {'Да' if masters_data[master_id].get('available', True) else 'Нет'}\n"
+                f"🚫 Выходные: {status_text}",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("✏️ Редактировать", callback_data=f"admin_edit_master|{master_id}")],
+                    [InlineKeyboardButton("➕ Создать ещё один", callback_data="admin_add_master")],
+                    [InlineKeyboardButton("🏠 В админ-панель", callback_data="back_to_admin_menu")]
                 ])
             )
-        except Exception as e:
-            logger.error(f"❌ Ошибка при изменении доступности мастер-класса {master_id}: {e}")
-            audit_logger.error(f"❌ Ошибка при изменении доступности мастер-класса {master_id} администратором {update.effective_user.id}: {e}")
+        else:
             await query.edit_message_text(
-                f"❌ Ошибка при изменении доступности: {e}",
+                f"✅ Политика выходных успешно изменена!\n"
+                f"Мастер-класс теперь: {status_text}",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("🔙 Вернуться к редактированию", callback_data=f"admin_edit_master|{master_id}")],
                     [InlineKeyboardButton("🏠 Вернуться в админ-панель", callback_data="back_to_admin_menu")]
                 ])
             )
-        return ADMIN_MENU
-    
-    elif data.startswith("admin_delete_master|"):
-        master_id = data.split("|")[1]
-        context.user_data['deleting_master_id'] = master_id
-        master_name = masters_data.get(master_id, {}).get("name", master_id)
-        
+    except Exception as e:
+        logger.error(f"❌ Ошибка при изменении политики выходных мастер-класса {master_id}: {e}")
+        audit_logger.error(f"❌ Ошибка при изменении политики выходных мастер-класса {master_id} администратором {user_id}: {e}")
+
         await query.edit_message_text(
-            f"⚠️ Вы уверены, что хотите удалить мастер-класс '{master_name}'?\n"
-            "Это действие нельзя отменить!\n\n"
-            "⚠️ ВНИМАНИЕ: Все записи на этот мастер-класс будут автоматически удалены!",
+            "❌ Произошла ошибка при изменении политики выходных",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("✅ Да, удалить", callback_data=f"confirm_delete_master|{master_id}")],
-                [InlineKeyboardButton("❌ Нет, отмена", callback_data=f"admin_edit_master|{master_id}")]
+                [InlineKeyboardButton("🔙 Вернуться к редактированию", callback_data=f"admin_edit_master|{master_id}")],
+                [InlineKeyboardButton("🏠 Вернуться в админ-панель", callback_data="back_to_admin_menu")]
             ])
         )
-        return ADMIN_MENU
+    return ADMIN_MENU
 
-    elif data.startswith("admin_set_exclude_weekends|"):
-        parts = data.split("|")
-        if len(parts) < 3:
-            return ADMIN_MENU
+# Подтвержденное удаление мастер-класса
+async def admin_route_confirm_delete_master(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    master_id = payload.master_id
+    master_name = masters_data.get(master_id, {}).get("name", master_id)
 
-        master_id = parts[1]
-        new_status = parts[2] == "yes"
+    # Аудит действий администратора
+    user_id = update.effective_user.id
+    audit_logger.info(f"🗑️ Администратор {user_id} начал процесс удаления мастер-класса {master_id} ({master_name})")
 
-        try:
-            # Обновляем данные в кэше
-            if master_id in masters_data:
-                masters_data[master_id]["exclude_weekends"] = new_status
+    try:
+        # 1. Удаляем всех пользователей, записанных на этот мастер-класс (одним запросом)
+        records_to_delete = await run_db(cancel_master_class_registrations, master_id)
+        if records_to_delete is None:
+            raise sqlite3.Error("Не удалось подключиться к базе данных")
 
-            # Обновляем в Google Sheets
-            if masters_sheet:
-                cell = masters_sheet.find(master_id)
-                if cell:
-                    masters_sheet.update_cell(cell.row, 11, "да" if new_status else "нет")
+        # 2. Удаляем мастер-класс из базы данных (строка убирается с листа в фоне)
+        await run_db(delete_master_class, master_id)
 
-            # Аудит действий администратора
-            user_id = update.effective_user.id
-            audit_logger.info(f"🚫 Администратор {user_id} изменил политику выходных для мастер-класса {master_id} на {'исключены' if new_status else 'включены'}")
+        # 3. Удаляем из кэша
+        with masters_data_lock:
+            masters_data.pop(master_id, None)
+        invalidate_masters_schedule()
 
-            status_text = "🚫 Выходные исключены" if new_status else "✅ Выходные включены"
-            logger.info(f"🚫 Политика выходных для мастер-класса {master_id} изменена на: {status_text}")
+        # 4. Перенумеровываем оставшиеся мастер-классы
+        await run_db(renumber_master_classes)
 
-            # Если это новый мастер-класс, завершаем создание
-            if context.user_data.get('is_new_master', False):
-                # Очищаем флаги создания
-                context.user_data.pop('is_new_master', None)
-                context.user_data.pop('editing_master_id', None)
+        logger.info(f"✅ Мастер-класс {master_id} успешно удален администратором. Удалено записей: {len(records_to_delete)}")
+        audit_logger.info(f"✅ Мастер-класс {master_id} ({master_name}) успешно удален администратором {user_id}. Удалено записей: {len(records_to_delete)}")
 
-                await query.edit_message_text(
-                    f"✅ Мастер-класс успешно создан!\n\n"
-                    f"🆔 ID: {master_id}\n"
-                    f"📝 Название: {masters_data[master_id].get('name', '')}\n"
-                    f"📅 Даты: {masters_data[master_id].get('date_start', '')} - {masters_data[master_id].get('date_end', '')}\n"
-                    f"⏰ Время: {masters_data[master_id].get('time_start', '')} - {masters_data[master_id].get('time_end', '')}\n"
-                    f"🪑 Мест: {masters_data[master_id].get('total_spots', 0)}\n"
-                    f"✅ Доступен: {'Да' if masters_data[master_id].get('available', True) else 'Нет'}\n"
-                    f"🚫 Выходные: {status_text}",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("✏️ Редактировать", callback_data=f"admin_edit_master|{master_id}")],
-                        [InlineKeyboardButton("➕ Создать ещё один", callback_data="admin_add_master")],
-                        [InlineKeyboardButton("🏠 В админ-панель", callback_data="back_to_admin_menu")]
-                    ])
-                )
-            else:
-                await query.edit_message_text(
-                    f"✅ Политика выходных успешно изменена!\n"
-                    f"Мастер-класс теперь: {status_text}",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 Вернуться к редактированию", callback_data=f"admin_edit_master|{master_id}")],
-                        [InlineKeyboardButton("🏠 Вернуться в админ-панель", callback_data="back_to_admin_menu")]
-                    ])
-                )
-        except Exception as e:
-            logger.error(f"❌ Ошибка при изменении политики выходных мастер-класса {master_id}: {e}")
-            audit_logger.error(f"❌ Ошибка при изменении политики выходных мастер-класса {master_id} администратором {user_id}: {e}")
+        # Уведомляем пользователей до ответа администратору: в режиме webhook цикл событий запроса
+        # завершается после ответа, и фоновая задача не успела бы отправить сообщения
+        if records_to_delete:
+            await notify_master_class_cancelled(context.application, master_name, records_to_delete)
 
-            await query.edit_message_text(
-                "❌ Произошла ошибка при изменении политики выходных",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Вернуться к редактированию", callback_data=f"admin_edit_master|{master_id}")],
-                    [InlineKeyboardButton("🏠 Вернуться в админ-панель", callback_data="back_to_admin_menu")]
-                ])
-            )
-        return ADMIN_MENU
-    
-    elif data.startswith("confirm_delete_master|"):
-        master_id = data.split("|")[1]
-        master_name = masters_data.get(master_id, {}).get("name", master_id)
-        
-        # Аудит действий администратора
-        user_id = update.effective_user.id
-        audit_logger.info(f"🗑️ Администратор {user_id} начал процесс удаления мастер-класса {master_id} ({master_name})")
-        
-        try:
-            # 1. Удаляем всех пользователей, записанных на этот мастер-класс
-            conn = get_connection()
-            if not conn:
-                raise sqlite3.Error("Не удалось подключиться к базе данных")
-            
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id FROM registrations 
-                WHERE position = ? AND status IN ('создана', 'перенесена')
-            ''', (master_id,))
-            records_to_delete = cursor.fetchall()
-            
-            for record in records_to_delete:
-                reg_id = record[0]
-                delete_registration(reg_id)
-            
-            conn.close()
-            
-            # 2. Удаляем мастер-класс из Google Sheets
-            if masters_sheet:
-                cell = masters_sheet.find(master_id)
-                if cell:
-                    masters_sheet.delete_rows(cell.row)
-            
-            # 3. Удаляем из кэша
-            if master_id in masters_data:
-                del masters_data[master_id]
-            
-            # 4. Перенумеровываем оставшиеся мастер-классы
-            renumber_master_classes()
-            
-            logger.info(f"✅ Мастер-класс {master_id} успешно удален администратором. Удалено записей: {len(records_to_delete)}")
-            audit_logger.info(f"✅ Мастер-класс {master_id} ({master_name}) успешно удален администратором {user_id}. Удалено записей: {len(records_to_delete)}")
-            
-            await query.edit_message_text(
-                f"✅ Мастер-класс '{master_name}' успешно удален!\n"
-                f"🗑️ Удалено записей пользователей: {len(records_to_delete)}\n"
-                f"🔄 Все оставшиеся мастер-классы были перенумерованы.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_edit_masters")]
-                ])
-            )
-        except Exception as e:
-            logger.error(f"❌ Ошибка при удалении мастер-класса {master_id}: {e}")
-            audit_logger.error(f"❌ Ошибка при удалении мастер-класса {master_id} ({master_name}) администратором {user_id}: {e}")
-            await query.edit_message_text(
-                f"❌ Ошибка при удалении мастер-класса '{master_name}': {e}",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_edit_masters")]
-                ])
-            )
-        return ADMIN_MENU
-    
-    elif data == "admin_add_master":
-        # Генерируем новый ID для мастер-класса
-        new_id = get_next_master_id()
-        context.user_data['editing_master_id'] = new_id
-        context.user_data['is_new_master'] = True
-        
-        # Инициализируем временные данные для нового мастер-класса
-        with masters_data_lock:
-            masters_data[new_id] = {
-                "id": new_id,
-                "name": "Новый мастер-класс",
-                "description": "Описание нового мастер-класса",
-                "free_spots": 20,
-                "total_spots": 20,
-                "booked": 0,
-                "date_start": "2025-12-01",
-                "date_end": "2026-01-31",
-                "time_start": "10:00",
-                "time_end": "12:00",
-                "available": True,
-                "exclude_weekends": False
-            }
-        
         await query.edit_message_text(
-            f"➕ Создание нового мастер-класса (ID: {new_id})\n"
-            "✏️ Шаг 1: Введите название мастер-класса (можно использовать эмодзи):",
+            f"✅ Мастер-класс '{master_name}' успешно удален!\n"
+            f"🗑️ Удалено записей пользователей: {len(records_to_delete)}\n"
+            f"🔄 Все оставшиеся мастер-классы были перенумерованы.",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Отмена", callback_data="admin_edit_masters")]
+                [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_edit_masters")]
+            ])
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка при удалении мастер-класса {master_id}: {e}")
+        audit_logger.error(f"❌ Ошибка при удалении мастер-класса {master_id} ({master_name}) администратором {user_id}: {e}")
+        await query.edit_message_text(
+            f"❌ Ошибка при удалении мастер-класса '{master_name}': {e}",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Вернуться к списку", callback_data="admin_edit_masters")]
             ])
         )
-        return ADMIN_EDIT_MASTER_NAME
-    
     return ADMIN_MENU
 
+# Начало создания мастер-класса
+async def admin_route_add_master(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    # Генерируем новый ID для мастер-класса
+    new_id = await run_db(get_next_master_id)
+    context.user_data['editing_master_id'] = new_id
+    context.user_data['is_new_master'] = True
+
+    # Инициализируем временные данные для нового мастер-класса
+    with masters_data_lock:
+        masters_data[new_id] = {
+            "id": new_id,
+            "name": "Новый мастер-класс",
+            "description": "Описание нового мастер-класса",
+            "free_spots": 20,
+            "total_spots": 20,
+            "booked": 0,
+            "date_start": "2025-12-01",
+            "date_end": "2026-01-31",
+            "time_start": "10:00",
+            "time_end": "12:00",
+            "available": True,
+            "exclude_weekends": False
+        }
+    invalidate_masters_schedule()
+
+    await query.edit_message_text(
+        f"➕ Создание нового мастер-класса (ID: {new_id})\n"
+        "✏️ Шаг 1: Введите название мастер-класса (можно использовать эмодзи):",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Отмена", callback_data="admin_edit_masters")]
+        ])
+    )
+    return ADMIN_EDIT_MASTER_NAME
+
+# Маршруты кнопок админ-панели: действие -> обработчик и поля callback_data
+admin_router = CallbackRouter("admin")
+admin_router.add("back_to_menu", admin_route_back_to_menu)
+admin_router.add("admin_reload_data", admin_route_reload_data)
+admin_router.add("admin_manage_users", admin_route_manage_users)
+admin_router.add("admin_manage_master_users", admin_route_manage_master_users, "master_id")
+admin_router.add("admin_manage_specific_slots", admin_route_manage_specific_slots, "master_id")
+admin_router.add("admin_add_specific_slot", admin_route_add_specific_slot, "master_id")
+admin_router.add("admin_delete_specific_slot", admin_route_delete_specific_slot)
+admin_router.add("admin_remove_user", admin_route_remove_user, "reg_id")
+admin_router.add("confirm_remove_user", admin_route_confirm_remove_user, "reg_id")
+admin_router.add("admin_reminder_confirm_delete", admin_route_reminder_confirm_delete, ("reminder_id", int))
+admin_router.add("admin_reminder_toggle", admin_route_reminder_toggle, ("reminder_id", int))
+admin_router.add("admin_reminder_delete", admin_route_reminder_delete, ("reminder_id", int))
+admin_router.add("admin_reminder_details", admin_route_reminder_details, ("reminder_id", int))
+admin_router.add("admin_reminders", admin_route_reminders)
+admin_router.add("admin_view_reminders", admin_route_view_reminders)
+admin_router.add("admin_create_reminder", admin_route_create_reminder)
+admin_router.add("admin_edit_masters", admin_route_edit_masters)
+admin_router.add("back_to_admin_menu", admin_route_back_to_admin_menu)
+admin_router.add("admin_edit_master", admin_route_edit_master, "master_id")
+admin_router.add("admin_edit_field", admin_route_edit_field, "field_type", "master_id")
+admin_router.add("admin_set_available", admin_route_set_available, "master_id", ("new_status", parse_yes_no))
+admin_router.add("admin_delete_master", admin_route_delete_master, "master_id")
+admin_router.add("admin_set_exclude_weekends", admin_route_set_exclude_weekends, "master_id", ("new_status", parse_yes_no))
+admin_router.add("confirm_delete_master", admin_route_confirm_delete_master, "master_id")
+admin_router.add("admin_add_master", admin_route_add_master)
+
+# Обработка кнопок админ-панели
+async def admin_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    return await admin_router.dispatch(update, context, default=ADMIN_MENU)
+
 # Обработчики редактирования полей мастер-класса
 async def edit_master_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     new_name = update.message.text.strip()
@@ -5697,11 +8024,9 @@ async def edit_master_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if master_id in masters_data:
             masters_data[master_id]["name"] = new_name
         
-        # Обновляем в Google Sheets, если это не новый мастер-класс
-        if not is_new and masters_sheet:
-            cell = masters_sheet.find(master_id)
-            if cell:
-                masters_sheet.update_cell(cell.row, 2, new_name)  # Название во 2-м столбце
+        # Сохраняем в базе данных, если это не новый мастер-класс (новый сохраняется после ввода мест)
+        if not is_new:
+            await run_db(save_master_class, master_id)
         
         # Аудит действий администратора
         user_id = update.effective_user.id
@@ -5769,11 +8094,9 @@ async def edit_master_description(update: Update, context: ContextTypes.DEFAULT_
         if master_id in masters_data:
             masters_data[master_id]["description"] = new_description
         
-        # Обновляем в Google Sheets, если это не новый мастер-класс
-        if not is_new and masters_sheet:
-            cell = masters_sheet.find(master_id)
-            if cell:
-                masters_sheet.update_cell(cell.row, 11, new_description)  # Описание в 11-м столбце
+        # Сохраняем в базе данных, если это не новый мастер-класс (новый сохраняется после ввода мест)
+        if not is_new:
+            await run_db(save_master_class, master_id)
         
         # Аудит действий администратора
         user_id = update.effective_user.id
@@ -5841,6 +8164,7 @@ async def edit_master_date_start(update: Update, context: ContextTypes.DEFAULT_T
         # Обновляем данные в кэше
         if master_id in masters_data:
             masters_data[master_id]["date_start"] = date_start_str
+            invalidate_masters_schedule()
         
         # Если это новый мастер-класс, сохраняем и запрашиваем дату окончания
         if is_new:
@@ -5853,11 +8177,8 @@ async def edit_master_date_start(update: Update, context: ContextTypes.DEFAULT_T
             )
             return ADMIN_EDIT_MASTER_DATE_END
         else:
-            # Обновляем в Google Sheets
-            if masters_sheet:
-                cell = masters_sheet.find(master_id)
-                if cell:
-                    masters_sheet.update_cell(cell.row, 6, date_start_str)  # Дата начала в 6-м столбце
+            # Сохраняем в базе данных (лист обновится в фоне)
+            await run_db(save_master_class, master_id)
             
             # Аудит действий администратора
             user_id = update.effective_user.id
@@ -5912,6 +8233,7 @@ async def edit_master_date_end(update: Update, context: ContextTypes.DEFAULT_TYP
         # Обновляем данные в кэше
         if master_id in masters_data:
             masters_data[master_id]["date_end"] = date_end_str
+            invalidate_masters_schedule()
         
         # Если это новый мастер-класс, сохраняем и запрашиваем время начала
         if is_new:
@@ -5924,11 +8246,8 @@ async def edit_master_date_end(update: Update, context: ContextTypes.DEFAULT_TYP
             )
             return ADMIN_EDIT_MASTER_TIME_START
         else:
-            # Обновляем в Google Sheets
-            if masters_sheet:
-                cell = masters_sheet.find(master_id)
-                if cell:
-                    masters_sheet.update_cell(cell.row, 7, date_end_str)  # Дата окончания в 7-м столбце
+            # Сохраняем в базе данных (лист обновится в фоне)
+            await run_db(save_master_class, master_id)
             
             # Аудит действий администратора
             user_id = update.effective_user.id
@@ -5989,6 +8308,7 @@ async def edit_master_time_start(update: Update, context: ContextTypes.DEFAULT_T
         # Обновляем данные в кэше
         if master_id in masters_data:
             masters_data[master_id]["time_start"] = time_start_str
+            invalidate_masters_schedule()
         
         # Если это новый мастер-класс, сохраняем и запрашиваем время окончания
         if is_new:
@@ -6001,11 +8321,8 @@ async def edit_master_time_start(update: Update, context: ContextTypes.DEFAULT_T
             )
             return ADMIN_EDIT_MASTER_TIME_END
         else:
-            # Обновляем в Google Sheets
-            if masters_sheet:
-                cell = masters_sheet.find(master_id)
-                if cell:
-                    masters_sheet.update_cell(cell.row, 8, time_start_str)  # Время начала в 8-м столбце
+            # Сохраняем в базе данных (лист обновится в фоне)
+            await run_db(save_master_class, master_id)
             
             # Аудит действий администратора
             user_id = update.effective_user.id
@@ -6079,11 +8396,8 @@ async def edit_master_time_end(update: Update, context: ContextTypes.DEFAULT_TYP
             )
             return ADMIN_EDIT_MASTER_SPOTS
         else:
-            # Обновляем в Google Sheets
-            if masters_sheet:
-                cell = masters_sheet.find(master_id)
-                if cell:
-                    masters_sheet.update_cell(cell.row, 9, time_end_str)  # Время окончания в 9-м столбце
+            # Сохраняем в базе данных (лист обновится в фоне)
+            await run_db(save_master_class, master_id)
             
             logger.info(f"⏰ Время окончания мастер-класса {master_id} изменено на: {time_end_str}")
             await update.message.reply_text(
@@ -6135,29 +8449,9 @@ async def edit_master_spots(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 masters_data[master_id]["total_spots"] = total_spots
                 masters_data[master_id]["free_spots"] = total_spots
 
-            # Сохраняем новый мастер-класс в Google Sheets
-            if masters_sheet and master_id in masters_data:
-                master_info = masters_data[master_id]
-                try:
-                    # Добавляем новую строку в таблицу мастер-классов
-                    new_row = [
-                        master_id,
-                        master_info.get("name", ""),
-                        str(master_info.get("free_spots", total_spots)),
-                        str(total_spots),
-                        str(master_info.get("booked", 0)),
-                        master_info.get("date_start", "2025-12-01"),
-                        master_info.get("date_end", "2026-01-31"),
-                        master_info.get("time_start", "10:00"),
-                        master_info.get("time_end", "12:00"),
-                        "да" if master_info.get("available", True) else "нет",
-                        "да" if master_info.get("exclude_weekends", False) else "нет",
-                        master_info.get("description", "")
-                    ]
-                    masters_sheet.append_row(new_row)
-                    logger.info(f"✅ Новый мастер-класс {master_id} сохранен в Google Sheets")
-                except Exception as e:
-                    logger.error(f"❌ Ошибка сохранения нового мастер-класса {master_id} в Google Sheets: {e}")
+            # Сохраняем новый мастер-класс в базе данных (строка на листе добавится в фоне)
+            if master_id in masters_data:
+                await run_db(save_master_class, master_id)
 
             # Переходим к установке доступности
             await update.message.reply_text(
@@ -6186,12 +8480,8 @@ async def edit_master_spots(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 masters_data[master_id]["total_spots"] = total_spots
                 masters_data[master_id]["free_spots"] = new_free
             
-            # Обновляем в Google Sheets
-            if masters_sheet:
-                cell = masters_sheet.find(master_id)
-                if cell:
-                    masters_sheet.update_cell(cell.row, 3, str(new_free))    # Свободных мест
-                    masters_sheet.update_cell(cell.row, 4, str(total_spots)) # Всего мест
+            # Сохраняем в базе данных (лист обновится в фоне)
+            await run_db(save_master_class, master_id)
             
             logger.info(f"✏️ Количество мест для мастер-класса {master_id} изменено: {old_total} → {total_spots}")
             
@@ -6389,20 +8679,21 @@ async def admin_add_specific_slot_time_end(update, context):
     
     # Сохраняем временной слот
     with masters_data_lock:
-        if master_id not in masters_data:
-            await update.message.reply_text("❌ Ошибка: мастер-класс не найден")
-            return ADMIN_MENU
-        
-        if "specific_slots" not in masters_data[master_id]:
-            masters_data[master_id]["specific_slots"] = {}
-        
-        masters_data[master_id]["specific_slots"][slot_date] = {
-            "start": slot_time_start,
-            "end": time_str
-        }
+        master_found = master_id in masters_data
+        if master_found:
+            if "specific_slots" not in masters_data[master_id]:
+                masters_data[master_id]["specific_slots"] = {}
+            
+            masters_data[master_id]["specific_slots"][slot_date] = {
+                "start": slot_time_start,
+                "end": time_str
+            }
+    if not master_found:
+        await update.message.reply_text("❌ Ошибка: мастер-класс не найден")
+        return ADMIN_MENU
     
-    # Обновляем в Google Sheets (если нужно, можно добавить отдельную колонку)
-    # Пока сохраняем только в памяти
+    # Слоты хранятся только в базе данных (на листе для них нет колонки)
+    await run_db(save_master_class, master_id)
     
     logger.info(f"✅ Добавлен временной слот для {master_id}: {slot_date} {slot_time_start}-{time_str}")
     
@@ -6439,17 +8730,20 @@ async def admin_delete_specific_slot_handler(query, context):
         master_id = parts[1]
         date_str = parts[2]
         
+        # Под блокировкой только проверка и удаление: ожидание внутри нее остановило бы event loop
         with masters_data_lock:
-            if master_id in masters_data and "specific_slots" in masters_data[master_id]:
-                if date_str in masters_data[master_id]["specific_slots"]:
-                    del masters_data[master_id]["specific_slots"][date_str]
-                    logger.info(f"✅ Удален временной слот для {master_id}: {date_str}")
-                else:
-                    await safe_edit_message_text(query, f"❌ Временной слот для даты {date_str} не найден")
-                    return ADMIN_SPECIFIC_TIME_SLOTS
-            else:
-                await safe_edit_message_text(query, "❌ Ошибка: мастер-класс не найден")
-                return ADMIN_SPECIFIC_TIME_SLOTS
+            master_found = master_id in masters_data and "specific_slots" in masters_data[master_id]
+            slot_found = master_found and date_str in masters_data[master_id]["specific_slots"]
+            if slot_found:
+                del masters_data[master_id]["specific_slots"][date_str]
+        if not master_found:
+            await safe_edit_message_text(query, "❌ Ошибка: мастер-класс не найден")
+            return ADMIN_SPECIFIC_TIME_SLOTS
+        if not slot_found:
+            await safe_edit_message_text(query, f"❌ Временной слот для даты {date_str} не найден")
+            return ADMIN_SPECIFIC_TIME_SLOTS
+        logger.info(f"✅ Удален временной слот для {master_id}: {date_str}")
+        await run_db(save_master_class, master_id)
         
         await admin_show_specific_slots(query, context, master_id)
         return ADMIN_SPECIFIC_TIME_SLOTS
@@ -6466,7 +8760,7 @@ async def admin_reminder_details(update: Update, context: ContextTypes.DEFAULT_T
 
     if data.startswith("admin_reminder_details|"):
         reminder_id = int(data.split("|")[1])
-        reminder = get_admin_reminder_by_id(reminder_id)
+        reminder = await run_db(get_admin_reminder_by_id, reminder_id)
 
         if not reminder:
             await query.edit_message_text(
@@ -6957,7 +9251,7 @@ async def admin_reminder_confirm_create(update: Update, context: ContextTypes.DE
         return ADMIN_MENU
 
     # Создаем напоминание
-    success, result = create_admin_reminder(
+    success, result = await run_db(create_admin_reminder, 
         master_class_id=reminder_data['master_class_id'],
         title=reminder_data['title'],
         message=reminder_data['message'],
@@ -6998,18 +9292,635 @@ async def admin_reminder_confirm_create(update: Update, context: ContextTypes.DE
 
     return ADMIN_MENU
 
+# === ХРАНЕНИЕ СОСТОЯНИЯ ДИАЛОГОВ ===
+class SQLitePersistence(BasePersistence):
+    """
+    Хранит user_data и состояния ConversationHandler в events.db: начатый диалог переживает перезапуск
+    и продолжается в любом процессе. Запись отложенная: изменения копятся в памяти по ключам (данные,
+    совпадающие с уже записанными, пропускаются) и пишутся одной транзакцией. Перед каждым обновлением
+    данные пользователя сверяются с базой и подхватываются, если их изменил другой процесс.
+    """
+    def __init__(self, update_interval=PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.lock = threading.Lock()  # Буферы и снимки
+        self.write_lock = threading.Lock()  # Запись в базу и сверка с ней не пересекаются
+        self.pending_user_data = {}  # user_id -> JSON данных или None (удалить)
+        self.pending_conversations = {}  # (name, ключ в JSON) -> (user_id, JSON состояния или None)
+        self.user_data_snapshots = {}  # user_id -> JSON данных, как они записаны в базе ("{}" не хранится)
+        self.conversation_snapshots = {}  # user_id -> {(name, ключ в JSON): JSON состояния}
+        self.conversation_handlers = {}  # name -> ConversationHandler (ключ диалога заканчивается user_id)
+        self.write_requested = threading.Event()
+        self.writer_thread = None
+        self.read_conn = None  # Постоянное соединение для сверки перед обновлениями (используется под write_lock)
+        self.stats = {"batches": 0, "rows_written": 0, "unchanged": 0, "refreshes": 0, "remote_changes": 0}
+
+    # Диалоги, состояние которых подхватывается из базы перед обновлением
+    def watch_conversations(self, *handlers):
+        for handler in handlers:
+            self.conversation_handlers[handler.name] = handler
+
+    # --- Загрузка при initialize() ---
+    def load_user_data(self):
+        conn = get_connection()
+        if not conn:
+            logger.error("❌ Невозможно загрузить user_data: база данных недоступна")
+            return {}
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT user_id, data FROM persistence_user_data")
+            rows = cursor.fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"❌ Ошибка загрузки user_data: {e}")
+            return {}
+        finally:
+            conn.close()
+        user_data = {}
+        with self.lock:
+            for user_id, data in rows:
+                try:
+                    user_data[user_id] = json.loads(data)
+                except ValueError:
+                    logger.warning(f"⚠️ Поврежденные user_data пользователя {user_id} пропущены")
+                    continue
+                self.user_data_snapshots[user_id] = data
+        return user_data
+
+    def load_conversations(self, name):
+        conn = get_connection()
+        if not conn:
+            logger.error(f"❌ Невозможно загрузить состояния диалога {name}: база данных недоступна")
+            return {}
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT conv_key, user_id, state FROM persistence_conversations WHERE name = ?", (name,))
+            rows = cursor.fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"❌ Ошибка загрузки состояний диалога {name}: {e}")
+            return {}
+        finally:
+            conn.close()
+        conversations = {}
+        with self.lock:
+            for conv_key, user_id, state in rows:
+                conversations[tuple(json.loads(conv_key))] = json.loads(state)
+                self.conversation_snapshots.setdefault(user_id, {})[(name, conv_key)] = state
+        logger.info(f"💾 Восстановлено активных диалогов {name}: {len(conversations)}")
+        return conversations
+
+    async def get_user_data(self):
+        return await run_db(self.load_user_data)
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return await run_db(self.load_conversations, name)
+
+    # --- Изменения от Application.update_persistence: только в буфер ---
+    async def update_user_data(self, user_id, data):
+        text = json.dumps(data, ensure_ascii=False, sort_keys=True)
+        with self.lock:
+            if user_id not in self.pending_user_data and text == self.user_data_snapshots.get(user_id, "{}"):
+                self.stats["unchanged"] += 1
+                return
+            self.pending_user_data[user_id] = text
+        self.request_write()
+
+    async def drop_user_data(self, user_id):
+        with self.lock:
+            self.pending_user_data[user_id] = None
+        self.request_write()
+
+    async def update_conversation(self, name, key, new_state):
+        conv_key = json.dumps(list(key))
+        state = None if new_state is None else json.dumps(new_state)
+        user_id = key[-1]
+        with self.lock:
+            known = self.conversation_snapshots.get(user_id, {}).get((name, conv_key))
+            if (name, conv_key) not in self.pending_conversations and state == known:
+                self.stats["unchanged"] += 1
+                return
+            self.pending_conversations[(name, conv_key)] = (user_id, state)
+        self.request_write()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # --- Пакетная запись ---
+    def request_write(self):
+        """Будит поток записи; в режиме web запись выполняет flush() после каждого обновления"""
+        if bot_run_mode == "web":
+            return
+        if self.writer_thread is None or not self.writer_thread.is_alive():
+            self.writer_thread = threading.Thread(target=self.writer_loop, daemon=True, name="PersistenceWriter")
+            self.writer_thread.start()
+        self.write_requested.set()
+
+    def writer_loop(self):
+        while True:
+            self.write_requested.wait()
+            self.write_requested.clear()
+            self.write_pending()
+
+    def write_pending(self):
+        """Записывает накопленные изменения одной транзакцией; возвращает число записанных строк"""
+        with self.write_lock:
+            with self.lock:
+                user_data, self.pending_user_data = self.pending_user_data, {}
+                conversations, self.pending_conversations = self.pending_conversations, {}
+            if not user_data and not conversations:
+                return 0
+            conn = get_connection()
+            if not conn:
+                logger.error("❌ Невозможно сохранить состояние диалогов: база данных недоступна")
+                self.restore_pending(user_data, conversations)
+                return 0
+            now = time.time()
+            try:
+                conn.isolation_level = None
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                for user_id, text in user_data.items():
+                    if text is None or text == "{}":
+                        cursor.execute("DELETE FROM persistence_user_data WHERE user_id = ?", (user_id,))
+                    else:
+                        cursor.execute('''
+                            INSERT INTO persistence_user_data (user_id, data, updated_at) VALUES (?, ?, ?)
+                            ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+                        ''', (user_id, text, now))
+                for (name, conv_key), (user_id, state) in conversations.items():
+                    if state is None:
+                        cursor.execute("DELETE FROM persistence_conversations WHERE name = ? AND conv_key = ?", (name, conv_key))
+                    else:
+                        cursor.execute('''
+                            INSERT INTO persistence_conversations (name, conv_key, user_id, state, updated_at) VALUES (?, ?, ?, ?, ?)
+                            ON CONFLICT(name, conv_key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at
+                        ''', (name, conv_key, user_id, state, now))
+                cursor.execute("COMMIT")
+            except sqlite3.Error as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                logger.error(f"❌ Ошибка сохранения состояния диалогов: {e}")
+                self.restore_pending(user_data, conversations)
+                return 0
+            finally:
+                conn.close()
+
+            with self.lock:
+                for user_id, text in user_data.items():
+                    if text is None or text == "{}":
+                        self.user_data_snapshots.pop(user_id, None)
+                    else:
+                        self.user_data_snapshots[user_id] = text
+                for (name, conv_key), (user_id, state) in conversations.items():
+                    known = self.conversation_snapshots.setdefault(user_id, {})
+                    if state is None:
+                        known.pop((name, conv_key), None)
+                    else:
+                        known[(name, conv_key)] = state
+                    if not known:
+                        del self.conversation_snapshots[user_id]
+                self.stats["batches"] += 1
+                self.stats["rows_written"] += len(user_data) + len(conversations)
+            return len(user_data) + len(conversations)
+
+    def restore_pending(self, user_data, conversations):
+        """Возвращает в буфер изменения, которые не удалось записать (новые изменения тех же ключей важнее)"""
+        with self.lock:
+            for user_id, text in user_data.items():
+                self.pending_user_data.setdefault(user_id, text)
+            for key, value in conversations.items():
+                self.pending_conversations.setdefault(key, value)
+
+    async def flush(self):
+        """Записывает все накопленные изменения (вызывается при остановке и после обновления в режиме web)"""
+        await run_db(self.write_pending)
+
+    # --- Изменения, сделанные другими процессами ---
+    def read_remote_changes(self, user_id):
+        """
+        Сравнивает записи пользователя в базе с тем, что этот процесс записал или загрузил последним.
+        Возвращает (новый JSON user_data или None, {(name, ключ в JSON): JSON состояния или None}).
+        """
+        with self.write_lock:
+            # Новое соединение на каждое обновление стоило бы ~0.3 мс, запросы по открытому - ~0.02 мс
+            if self.read_conn is None:
+                self.read_conn = get_connection(check_same_thread=False)
+                if not self.read_conn:
+                    return None, {}
+            try:
+                cursor = self.read_conn.cursor()
+                cursor.execute("SELECT data FROM persistence_user_data WHERE user_id = ?", (user_id,))
+                row = cursor.fetchone()
+                cursor.execute("SELECT name, conv_key, state FROM persistence_conversations WHERE user_id = ?", (user_id,))
+                remote_conversations = {(name, conv_key): state for name, conv_key, state in cursor.fetchall()}
+            except sqlite3.Error as e:
+                logger.error(f"❌ Ошибка чтения состояния диалогов пользователя {user_id}: {e}")
+                self.read_conn.close()
+                self.read_conn = None
+                return None, {}
+
+            remote_text = row[0] if row else "{}"
+            with self.lock:
+                self.stats["refreshes"] += 1
+                # Ключи с еще не записанными локальными изменениями не перезаписываются: побеждает последняя запись
+                changed_text = None
+                if remote_text != self.user_data_snapshots.get(user_id, "{}"):
+                    if user_id not in self.pending_user_data:
+                        changed_text = remote_text
+                    if row:
+                        self.user_data_snapshots[user_id] = remote_text
+                    else:
+                        self.user_data_snapshots.pop(user_id, None)
+                known = self.conversation_snapshots.get(user_id, {})
+                changed_conversations = {
+                    key: remote_conversations.get(key)
+                    for key in set(known) | set(remote_conversations)
+                    if known.get(key) != remote_conversations.get(key) and key not in self.pending_conversations
+                }
+                if remote_conversations:
+                    self.conversation_snapshots[user_id] = remote_conversations
+                else:
+                    self.conversation_snapshots.pop(user_id, None)
+                if changed_text is not None or changed_conversations:
+                    self.stats["remote_changes"] += 1
+            return changed_text, changed_conversations
+
+    async def refresh_user_data(self, user_id, user_data):
+        # Вызывается перед обработкой каждого обновления (TypeHandler группы -1 срабатывает на все обновления,
+        # поэтому сверка происходит раньше, чем ConversationHandler проверит состояние диалога)
+        changed_text, changed_conversations = await run_db(self.read_remote_changes, user_id)
+        if changed_text is not None:
+            user_data.clear()
+            user_data.update(json.loads(changed_text))
+        for (name, conv_key), state in changed_conversations.items():
+            handler = self.conversation_handlers.get(name)
+            if not handler:
+                continue
+            key = tuple(json.loads(conv_key))
+            # Изменение не отмечается как локальная запись, иначе оно вернулось бы в базу
+            if state is None:
+                handler._conversations.data.pop(key, None)
+            else:
+                handler._conversations.update_no_track({key: json.loads(state)})
+
+    # --- Выгрузка из памяти процесса ---
+    def forget_users(self, user_ids):
+        """
+        Забывает снимки пользователей, чтобы при их следующем обновлении данные снова загрузились из базы.
+        Возвращает тех, кого можно выгрузить: пользователи с еще не записанными изменениями пропускаются.
+        """
+        with self.write_lock, self.lock:
+            pending = set(self.pending_user_data) | {user_id for user_id, _ in self.pending_conversations.values()}
+            forgotten = set(user_ids) - pending
+            for user_id in forgotten:
+                self.user_data_snapshots.pop(user_id, None)
+                self.conversation_snapshots.pop(user_id, None)
+        return forgotten
+
+# === ОГРАНИЧЕНИЕ ПАМЯТИ СОСТОЯНИЯ ДИАЛОГОВ ===
+# Примерный объем памяти объекта вместе с вложенными словарями, списками и строками (байты)
+def get_approximate_size(obj):
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+    return size
+
+# Оценка объема словаря по выборке записей (полный обход большого словаря надолго занял бы event loop)
+def estimate_mapping_size(mapping, sample_size=STATE_GAUGE_SAMPLE_SIZE):
+    count = len(mapping)
+    sample = list(itertools.islice(mapping.items(), sample_size))
+    if not sample:
+        return sys.getsizeof(mapping)
+    sample_bytes = sum(get_approximate_size(key) + get_approximate_size(value) for key, value in sample)
+    return sys.getsizeof(mapping) + sample_bytes * count // len(sample)
+
+class ConversationStateReaper:
+    """
+    Не дает состоянию диалогов расти без предела. Диалог, в котором пользователь молчит дольше таймаута,
+    завершается при его следующем обновлении вместе с черновиками в user_data. Периодическая очистка удаляет
+    из базы брошенные диалоги и старые user_data, а из памяти процесса выгружает данные пользователей,
+    которые давно ему не писали (при следующем обновлении они снова загружаются из базы).
+    """
+    def __init__(self):
+        self.handlers = {}  # name -> (ConversationHandler, таймаут в секундах)
+        self.user_last_seen = {}  # user_id -> время последнего обновления в этом процессе
+        self.chat_last_seen = {}  # chat_id -> время последнего обновления в этом процессе
+        self.started = time.time()  # Для данных, загруженных при запуске
+        self.last_sweep = self.started
+        self.gauge = None  # Последний замер: живые диалоги и примерный объем памяти
+        self.stats = {"timed_out": 0, "purged_rows": 0, "evicted_users": 0, "evicted_chats": 0}
+
+    def watch(self, handler, timeout):
+        self.handlers[handler.name] = (handler, timeout)
+
+    def check_ptb_internals(self, application):
+        """
+        Очистка и хранилище в базе работают с внутренними атрибутами python-telegram-bot 20.x.
+        Если после обновления библиотеки их нет, бот не запускается, а не ломается молча.
+        """
+        missing = [
+            f"Application.{name}" for name in ("_user_data", "_chat_data", "_chat_ids_to_be_updated_in_persistence")
+            if not hasattr(application, name)
+        ]
+        for handler, _ in self.handlers.values():
+            missing += [f"ConversationHandler.{name}" for name in ("_get_key", "_conversations") if not hasattr(handler, name)]
+        # При загрузке из хранилища PTB заменяет _conversations на TrackingDict
+        try:
+            from telegram.ext._utils.trackingdict import TrackingDict
+            if not issubclass(TrackingDict, UserDict) or not hasattr(TrackingDict, "update_no_track"):
+                missing.append("TrackingDict.data/update_no_track")
+        except ImportError:
+            missing.append("telegram.ext._utils.trackingdict.TrackingDict")
+        if missing:
+            raise RuntimeError(
+                f"python-telegram-bot {TG_VER} не поддерживается: нет {', '.join(sorted(set(missing)))}. "
+                f"Очистка состояния диалогов проверена на версии 20.7"
+            )
+
+    # Вызывается для каждого обновления раньше ConversationHandler
+    async def on_update(self, update, context):
+        now = time.time()
+        user = update.effective_user
+        chat = update.effective_chat
+        if chat:
+            self.chat_last_seen[chat.id] = now
+        if user:
+            previous = self.user_last_seen.get(user.id)
+            self.user_last_seen[user.id] = now
+            if chat:
+                await self.expire_conversations(update, context, previous, now)
+        if now - self.last_sweep >= STATE_SWEEP_INTERVAL:
+            self.last_sweep = now
+            if bot_run_mode == "web":
+                # В режиме webhook цикл событий живет только до ответа на запрос: фоновую задачу он
+                # мог бы отменить на середине, поэтому очистка шагами выполняется внутри обновления
+                await self.sweep(context.application, now)
+            else:
+                # При опросе очистка идет отдельной задачей и не задерживает обработку этого обновления
+                context.application.create_task(self.sweep(context.application, now))
+
+    async def expire_conversations(self, update, context, previous, now):
+        """Завершает диалоги пользователя, в которых он молчал дольше таймаута"""
+        candidates = []
+        for name, (handler, timeout) in self.handlers.items():
+            key = handler._get_key(update)
+            if key in handler._conversations and (previous is None or now - previous > timeout):
+                candidates.append((name, handler, key, timeout))
+        if not candidates:
+            return
+        # Пользователь мог писать другому процессу: сверяемся с last_active, делая поправку на его отставание
+        last_active = await run_db(get_bot_user_last_active, update.effective_user.id)
+        last_seen = max(previous or 0, last_active + BOT_USER_TOUCH_INTERVAL if last_active else 0)
+        if not last_seen:
+            return
+        expired = []
+        for name, handler, key, timeout in candidates:
+            if now - last_seen > timeout:
+                # Удаление отмечается как изменение и попадает в базу
+                handler._conversations.pop(key, None)
+                expired.append(name)
+        if not expired:
+            return
+        self.stats["timed_out"] += len(expired)
+        if not any(handler._get_key(update) in handler._conversations for handler, _ in self.handlers.values()):
+            context.user_data.clear()
+        logger.info(f"⌛ Диалог {', '.join(expired)} пользователя {update.effective_user.id} завершен по таймауту (бездействие {(now - last_seen) / 60:.0f} мин)")
+
+    async def sweep(self, application, now):
+        purged = await run_db(self.purge_expired_rows, now)
+        evicted_users, evicted_chats = await self.evict_idle(application, now)
+        self.stats["purged_rows"] += purged
+        self.stats["evicted_users"] += evicted_users
+        self.stats["evicted_chats"] += evicted_chats
+        self.gauge = self.measure(application)
+        logger.info(
+            f"🧠 {self.format_gauge()}; удалено из базы брошенных диалогов и user_data: {purged}, "
+            f"выгружено из памяти пользователей: {evicted_users}, чатов: {evicted_chats}"
+        )
+
+    def purge_expired_rows(self, now):
+        """Удаляет из базы диалоги, простоявшие дольше таймаута, и user_data давно неактивных пользователей без диалогов"""
+        conn = get_connection()
+        if not conn:
+            logger.error("❌ Невозможно очистить брошенные диалоги: база данных недоступна")
+            return 0
+        purged = 0
+        try:
+            cursor = conn.cursor()
+            for name, (handler, timeout) in self.handlers.items():
+                cutoff = now - timeout - BOT_USER_TOUCH_INTERVAL
+                cursor.execute('''
+                    DELETE FROM persistence_conversations
+                    WHERE name = ? AND updated_at < ? AND NOT EXISTS (
+                        SELECT 1 FROM bot_users WHERE bot_users.user_id = persistence_conversations.user_id
+                        AND last_active >= datetime(?, 'unixepoch')
+                    )
+                ''', (name, cutoff, cutoff))
+                purged += cursor.rowcount
+            cutoff = now - USER_DATA_IDLE_TTL
+            cursor.execute('''
+                DELETE FROM persistence_user_data
+                WHERE updated_at < ? AND NOT EXISTS (
+                    SELECT 1 FROM persistence_conversations WHERE persistence_conversations.user_id = persistence_user_data.user_id
+                ) AND NOT EXISTS (
+                    SELECT 1 FROM bot_users WHERE bot_users.user_id = persistence_user_data.user_id
+                    AND last_active >= datetime(?, 'unixepoch')
+                )
+            ''', (cutoff, cutoff))
+            purged += cursor.rowcount
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"❌ Ошибка очистки брошенных диалогов: {e}")
+            return 0
+        finally:
+            conn.close()
+        return purged
+
+    async def evict_idle(self, application, now):
+        """
+        Выгружает из памяти данные пользователей и чатов, не писавших процессу дольше STATE_MEMORY_IDLE_TTL.
+        Проверка идет шагами по STATE_SWEEP_BATCH_SIZE записей, между шагами event loop обрабатывает обновления.
+        """
+        cutoff = now - STATE_MEMORY_IDLE_TTL
+        handlers = [handler for handler, _ in self.handlers.values()]
+        user_ids = set(application.user_data)
+        user_ids.update(self.user_last_seen)
+        for handler in handlers:
+            user_ids.update(key[-1] for key in handler._conversations)
+        user_ids = list(user_ids)
+        evicted_users = set()
+        for start in range(0, len(user_ids), STATE_SWEEP_BATCH_SIZE):
+            await asyncio.sleep(0)
+            idle_users = self.select_idle(application, self.user_last_seen, user_ids[start:start + STATE_SWEEP_BATCH_SIZE], cutoff)
+            # Без хранилища в базе выгрузка потеряла бы данные
+            if not idle_users or not bot_persistence:
+                continue
+            idle_users = await run_db(bot_persistence.forget_users, idle_users)
+            # Пока снимки забывались, пользователь мог написать снова: его данные остаются в памяти
+            # и при следующем обновлении просто перечитываются из базы
+            idle_users = self.select_idle(application, self.user_last_seen, idle_users, cutoff)
+            for user_id in idle_users:
+                application._user_data.pop(user_id, None)
+                bot_users_last_touch.pop(user_id, None)
+            evicted_users |= idle_users
+        if evicted_users:
+            for handler in handlers:
+                keys = list(handler._conversations.data)
+                for start in range(0, len(keys), STATE_SWEEP_BATCH_SIZE):
+                    await asyncio.sleep(0)
+                    batch = [key for key in keys[start:start + STATE_SWEEP_BATCH_SIZE] if key[-1] in evicted_users]
+                    idle_keys = self.select_idle(application, self.user_last_seen, {key[-1] for key in batch}, cutoff)
+                    for key in batch:
+                        if key[-1] in idle_keys:
+                            # Без отметки об изменении: в базе диалог остается
+                            handler._conversations.data.pop(key, None)
+        # Словарь не уменьшается при удалении ключей, поэтому собственные отметки пересоздаются
+        if evicted_users:
+            self.user_last_seen = {user_id: seen for user_id, seen in self.user_last_seen.items() if user_id not in evicted_users}
+
+        chat_ids = list(set(application.chat_data) | set(self.chat_last_seen))
+        evicted_chats = set()
+        for start in range(0, len(chat_ids), STATE_SWEEP_BATCH_SIZE):
+            await asyncio.sleep(0)
+            idle_chats = self.select_idle(application, self.chat_last_seen, chat_ids[start:start + STATE_SWEEP_BATCH_SIZE], cutoff)
+            for chat_id in idle_chats:
+                application._chat_data.pop(chat_id, None)
+            evicted_chats |= idle_chats
+        if evicted_chats:
+            self.chat_last_seen = {chat_id: seen for chat_id, seen in self.chat_last_seen.items() if chat_id not in evicted_chats}
+        # chat_data не сохраняется, поэтому PTB сам никогда не очищает набор чатов "для сохранения"
+        if bot_persistence and not bot_persistence.store_data.chat_data:
+            application._chat_ids_to_be_updated_in_persistence.clear()
+        return len(evicted_users), len(evicted_chats)
+
+    def select_idle(self, application, last_seen, ids, cutoff):
+        """Отбирает из ids тех, кто не писал процессу с cutoff"""
+        # Чаты, обновления которых сейчас обрабатываются, не трогаем: их данные уже сверены с базой
+        busy = ()
+        if isinstance(application.update_processor, PerChatUpdateProcessor):
+            busy = application.update_processor.chat_locks
+        return {item_id for item_id in ids if last_seen.get(item_id, self.started) < cutoff and item_id not in busy}
+
+    def measure(self, application):
+        """Количество живых диалогов и примерный объем памяти, занятой состоянием пользователей"""
+        conversations = {name: len(handler._conversations) for name, (handler, _) in self.handlers.items()}
+        held = [application._user_data, application._chat_data, self.user_last_seen, self.chat_last_seen, bot_users_last_touch]
+        held += [handler._conversations.data for handler, _ in self.handlers.values()]
+        size = sum(estimate_mapping_size(mapping) for mapping in held)
+        if bot_persistence:
+            with bot_persistence.lock:
+                size += estimate_mapping_size(bot_persistence.user_data_snapshots)
+                size += estimate_mapping_size(bot_persistence.conversation_snapshots)
+        return {
+            "conversations": conversations,
+            "user_data": len(application.user_data),
+            "chat_data": len(application.chat_data),
+            "bytes": size
+        }
+
+    def format_gauge(self):
+        gauge = self.gauge
+        details = ", ".join(f"{name} {count}" for name, count in gauge["conversations"].items())
+        return (
+            f"Состояние в памяти: активных диалогов {sum(gauge['conversations'].values())} ({details}), "
+            f"user_data {gauge['user_data']}, chat_data {gauge['chat_data']}, ~{gauge['bytes'] / 1024:.0f} КБ"
+        )
+
+conversation_reaper = ConversationStateReaper()
+
+# === ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА ОБНОВЛЕНИЙ ===
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает до max_concurrent_updates обновлений одновременно, но обновления одного чата -
+    строго по очереди и в порядке поступления: переходы ConversationHandler пользователя не перемешиваются,
+    а долгая запись одного пользователя не задерживает остальных.
+    """
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self.chat_locks = {}  # chat_id -> [asyncio.Lock, сколько обновлений чата ждут или обрабатываются]
+        self.work_slots = asyncio.BoundedSemaphore(max_concurrent_updates)  # Обновления, которые обрабатываются сейчас
+        self.stats = {"processed": 0, "waited": 0}
+
+    async def process_update(self, update, coroutine):
+        """
+        Сначала ждет своей очереди в чате и только потом занимает одно из max_concurrent_updates мест:
+        обновления, ожидающие предыдущего обновления того же чата, мест не занимают и не задерживают другие чаты.
+        """
+        chat_key = None
+        if isinstance(update, Update):
+            if update.effective_chat:
+                chat_key = update.effective_chat.id
+            elif update.effective_user:
+                chat_key = update.effective_user.id
+        if chat_key is None:
+            async with self.work_slots:
+                await self.do_process_update(update, coroutine)
+            return
+
+        entry = self.chat_locks.get(chat_key)
+        if entry is None:
+            entry = self.chat_locks[chat_key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            if entry[0].locked():
+                self.stats["waited"] += 1
+            async with entry[0]:
+                async with self.work_slots:
+                    await self.do_process_update(update, coroutine)
+                self.stats["processed"] += 1
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.chat_locks[chat_key]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
 # === НАСТРОЙКА И ЗАПУСК БОТА ===
-def setup_bot():
-    """Инициализирует и настраивает бота, но не запускает polling"""
-    global google_sheets_enabled
-    
-    # Инициализация базы данных
-    init_db()
-    # Восстановление состояния очередей после перезапуска
-    restore_queue_state()
-    # Инициализация Google Sheets
-    google_sheets_enabled = init_google_sheets()
-    
+# Запуск фоновых потоков: Google Sheets, выбор ведущего процесса и напоминания
+def start_background_workers(application):
     # Запускаем фоновый поток для работы с Google Sheets
     sheets_thread_container = [threading.Thread(target=sheets_worker, daemon=True, name="GoogleSheetsWorker")]
     sheets_thread_container[0].start()
@@ -7032,6 +9943,45 @@ def setup_bot():
     # Запускаем поток мониторинга
     monitor_thread = threading.Thread(target=monitor_sheets_thread, daemon=True, name="SheetsMonitor")
     monitor_thread.start()
+
+    # Выбор ведущего процесса: пропущенные напоминания проверяет процесс, ставший ведущим
+    leader_thread = threading.Thread(target=leader_election_worker, daemon=True, name="LeaderElection")
+    leader_thread.start()
+
+    # Запускаем фоновый поток для напоминаний ПОСЛЕ запуска приложения
+    reminder_thread = threading.Thread(target=reminder_worker, args=(application,), daemon=True, name="ReminderWorker")
+    reminder_thread.start()
+    logger.info("✅ Поток напоминаний запущен")
+
+def setup_bot(mode=None):
+    """
+    Инициализирует и настраивает бота, но не запускает polling.
+    mode (по умолчанию BOT_RUN_MODE): "all" - обработчики и фоновые потоки, "web" - только обработчики
+    обновлений (без потоков и подключения к Google Sheets), "worker" - только фоновые задачи.
+    """
+    global google_sheets_enabled, bot_run_mode, bot_persistence
+
+    bot_run_mode = mode or BOT_RUN_MODE
+    if bot_run_mode not in BOT_RUN_MODES:
+        logger.warning(f"⚠️ Неизвестный режим запуска '{bot_run_mode}', используется 'all'")
+        bot_run_mode = "all"
+    run_background = bot_run_mode != "web"
+
+    # Инициализация базы данных
+    init_db()
+    # Чаты, заблокировавшие бота, загружаются один раз; дальше набор обновляется при отметках
+    load_unreachable_chats()
+    if run_background:
+        # Перенос отметок относительных напоминаний из старого файла и загрузка кэша
+        import_legacy_relative_reminder_sends()
+        load_relative_reminder_sends_cache()
+        # Восстановление состояния очередей после перезапуска
+        restore_queue_state()
+        # Инициализация Google Sheets
+        google_sheets_enabled = init_google_sheets()
+    # Мастер-классы хранятся в базе данных и доступны и без Google Sheets
+    if not masters_last_update:
+        load_masters_data()
     
     # 🔑 Получаем токен
     TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -7042,9 +9992,13 @@ def setup_bot():
     # Очищаем токен от пробелов
     TOKEN = clean_token(TOKEN)
     
-    # Создаем приложение
+    # Создаем приложение (user_data и состояния диалогов хранятся в базе данных)
+    bot_persistence = SQLitePersistence()
     try:
-        application = Application.builder().token(TOKEN).build()
+        builder = Application.builder().token(TOKEN).persistence(bot_persistence)
+        if MAX_CONCURRENT_UPDATES > 1:
+            builder = builder.concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        application = builder.build()
     except Exception as e:
         logger.error(f"❌ Ошибка при создании приложения: {e}")
         print("❌ КРИТИЧЕСКАЯ ОШИБКА: Неверный формат токена!")
@@ -7053,93 +10007,94 @@ def setup_bot():
     # Создаем ConversationHandler для обычных пользователей
     user_conversation_handler = ConversationHandler(
         entry_points=[
-            CallbackQueryHandler(register_start, pattern="^register$"),
-            CallbackQueryHandler(check_record_start, pattern="^check_record$")
+            CallbackQueryHandler(register_start, pattern=callback_actions("register")),
+            CallbackQueryHandler(check_record_start, pattern=callback_actions("check_record"))
         ],
         states={
             FULL_NAME: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, get_full_name),
-                CallbackQueryHandler(back_to_main_menu, pattern="^back_to_menu$")
+                CallbackQueryHandler(back_to_main_menu, pattern=callback_actions("back_to_menu"))
             ],
             POSITION_SELECTION: [
-                CallbackQueryHandler(handle_registration_type, pattern="^(register_self|register_family)$"),
-                CallbackQueryHandler(select_position, pattern="^(master\\|.*|back_to_masters\\|.*|no_masters_available|back_to_menu)$")
+                CallbackQueryHandler(handle_registration_type, pattern=callback_actions("register_self", "register_family")),
+                CallbackQueryHandler(select_position, pattern=callback_actions("master", "back_to_masters", "no_masters_available", "back_to_menu"))
             ],
             DATE_SELECTION: [CallbackQueryHandler(select_date)],
             TIME_SELECTION: [CallbackQueryHandler(select_time)],
             CHECK_RECORD: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, find_record),
-                CallbackQueryHandler(back_to_main_menu, pattern="^back_to_menu$")
+                CallbackQueryHandler(back_to_main_menu, pattern=callback_actions("back_to_menu"))
             ],
             MANAGE_RECORD: [
-                CallbackQueryHandler(manage_record),
-                CallbackQueryHandler(back_to_main_menu, pattern="^back_to_menu$")
+                CallbackQueryHandler(manage_record)
             ],
             MANAGE_MULTIPLE_RECORDS: [
-                CallbackQueryHandler(manage_multiple_records, pattern="^(register_new|manage_existing|manage_specific:.*|back_to_menu)$")
+                CallbackQueryHandler(manage_multiple_records, pattern=callback_actions("register_new", "manage_existing", "manage_specific", "back_to_menu"))
             ],
         },
         fallbacks=[
             CommandHandler("start", start),
             MessageHandler(filters.TEXT & ~filters.COMMAND, handle_random_text_fallback, block=False)
         ],
-        allow_reentry=True
+        allow_reentry=True,
+        name="user_conversation",
+        persistent=True
     )
 
     # Создаем ConversationHandler для администраторов
     admin_conversation_handler = ConversationHandler(
         entry_points=[
-            CallbackQueryHandler(admin_start, pattern="^admin_panel$")
+            CallbackQueryHandler(admin_start, pattern=callback_actions("admin_panel"))
         ],
         states={
             ADMIN_PASSWORD: [MessageHandler(filters.TEXT, check_admin_password)],
-            ADMIN_MENU: [CallbackQueryHandler(admin_actions, pattern="^(back_to_menu|admin_reload_data|admin_manage_users|admin_edit_masters|admin_reminders|admin_view_reminders|admin_create_reminder|back_to_admin_menu|admin_edit_master\\|.*|admin_edit_field\\|.*|admin_set_available\\|.*|admin_set_exclude_weekends\\|.*|admin_delete_master\\|.*|confirm_delete_master\\|.*|admin_add_master|admin_manage_master_users\\|.*|admin_reminder_details\\|.*|admin_reminder_toggle\\|.*|admin_reminder_delete\\|.*|admin_reminder_confirm_delete\\|.*|admin_remove_user\\|.*|confirm_remove_user\\|.*|admin_manage_specific_slots\\|.*|admin_add_specific_slot\\|.*|admin_delete_specific_slot\\|.*)$")],
-            ADMIN_EDIT_MASTER_SELECT: [CallbackQueryHandler(admin_actions, pattern="^(back_to_admin_menu|admin_edit_master\\|.*)$")],
+            ADMIN_MENU: [CallbackQueryHandler(admin_actions, pattern=admin_router.accepts())],
+            ADMIN_EDIT_MASTER_SELECT: [CallbackQueryHandler(admin_actions, pattern=admin_router.accepts("back_to_admin_menu", "admin_edit_master"))],
             ADMIN_EDIT_MASTER_NAME: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, edit_master_name),
-                CallbackQueryHandler(admin_actions, pattern="^(admin_edit_master\\|.*|back_to_admin_menu|admin_edit_masters)$")
+                CallbackQueryHandler(admin_actions, pattern=admin_router.accepts("admin_edit_master", "back_to_admin_menu", "admin_edit_masters"))
             ],
             ADMIN_EDIT_MASTER_DESCRIPTION: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, edit_master_description),
-                CallbackQueryHandler(admin_actions, pattern="^(admin_edit_master\\|.*|back_to_admin_menu|admin_edit_masters)$")
+                CallbackQueryHandler(admin_actions, pattern=admin_router.accepts("admin_edit_master", "back_to_admin_menu", "admin_edit_masters"))
             ],
             ADMIN_EDIT_MASTER_DATE_START: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, edit_master_date_start),
-                CallbackQueryHandler(admin_actions, pattern="^(admin_edit_master\\|.*|back_to_admin_menu|admin_edit_masters)$")
+                CallbackQueryHandler(admin_actions, pattern=admin_router.accepts("admin_edit_master", "back_to_admin_menu", "admin_edit_masters"))
             ],
             ADMIN_EDIT_MASTER_DATE_END: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, edit_master_date_end),
-                CallbackQueryHandler(admin_actions, pattern="^(admin_edit_master\\|.*|back_to_admin_menu|admin_edit_masters)$")
+                CallbackQueryHandler(admin_actions, pattern=admin_router.accepts("admin_edit_master", "back_to_admin_menu", "admin_edit_masters"))
             ],
             ADMIN_EDIT_MASTER_TIME_START: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, edit_master_time_start),
-                CallbackQueryHandler(admin_actions, pattern="^(admin_edit_master\\|.*|back_to_admin_menu|admin_edit_masters)$")
+                CallbackQueryHandler(admin_actions, pattern=admin_router.accepts("admin_edit_master", "back_to_admin_menu", "admin_edit_masters"))
             ],
             ADMIN_EDIT_MASTER_TIME_END: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, edit_master_time_end),
-                CallbackQueryHandler(admin_actions, pattern="^(admin_edit_master\\|.*|back_to_admin_menu|admin_edit_masters)$")
+                CallbackQueryHandler(admin_actions, pattern=admin_router.accepts("admin_edit_master", "back_to_admin_menu", "admin_edit_masters"))
             ],
             ADMIN_EDIT_MASTER_SPOTS: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, edit_master_spots),
-                CallbackQueryHandler(admin_actions, pattern="^(admin_edit_master\\|.*|back_to_admin_menu|admin_edit_masters)$")
+                CallbackQueryHandler(admin_actions, pattern=admin_router.accepts("admin_edit_master", "back_to_admin_menu", "admin_edit_masters"))
             ],
-            ADMIN_EDIT_MASTER_AVAILABLE: [CallbackQueryHandler(admin_actions, pattern="^(admin_set_available\\|.*|back_to_admin_menu)$")],
+            ADMIN_EDIT_MASTER_AVAILABLE: [CallbackQueryHandler(admin_actions, pattern=admin_router.accepts("admin_set_available", "back_to_admin_menu"))],
             ADMIN_SPECIFIC_TIME_SLOTS: [
-                CallbackQueryHandler(admin_actions, pattern="^(admin_manage_specific_slots\\|.*|admin_add_specific_slot\\|.*|admin_delete_specific_slot\\|.*|admin_edit_master\\|.*|back_to_admin_menu)$")
+                CallbackQueryHandler(admin_actions, pattern=admin_router.accepts("admin_manage_specific_slots", "admin_add_specific_slot", "admin_delete_specific_slot", "admin_edit_master", "back_to_admin_menu"))
             ],
             ADMIN_ADD_SPECIFIC_TIME_DATE: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_specific_slot_start),
-                CallbackQueryHandler(admin_actions, pattern="^(admin_manage_specific_slots\\|.*|admin_edit_master\\|.*|back_to_admin_menu)$")
+                CallbackQueryHandler(admin_actions, pattern=admin_router.accepts("admin_manage_specific_slots", "admin_edit_master", "back_to_admin_menu"))
             ],
             ADMIN_ADD_SPECIFIC_TIME_START: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_specific_slot_time_start),
-                CallbackQueryHandler(admin_actions, pattern="^(admin_manage_specific_slots\\|.*|admin_edit_master\\|.*|back_to_admin_menu)$")
+                CallbackQueryHandler(admin_actions, pattern=admin_router.accepts("admin_manage_specific_slots", "admin_edit_master", "back_to_admin_menu"))
             ],
             ADMIN_ADD_SPECIFIC_TIME_END: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_specific_slot_time_end),
-                CallbackQueryHandler(admin_actions, pattern="^(admin_manage_specific_slots\\|.*|admin_edit_master\\|.*|back_to_admin_menu)$")
+                CallbackQueryHandler(admin_actions, pattern=admin_router.accepts("admin_manage_specific_slots", "admin_edit_master", "back_to_admin_menu"))
             ],
-            ADMIN_REMINDER_SELECT: [CallbackQueryHandler(admin_reminder_details, pattern="^(admin_reminder_details\\|.*|admin_reminders)$")],
+            ADMIN_REMINDER_SELECT: [CallbackQueryHandler(admin_reminder_details, pattern=callback_actions("admin_reminder_details", "admin_reminders"))],
             ADMIN_REMINDER_TITLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_reminder_title_input), CallbackQueryHandler(admin_reminder_set_title)],
             ADMIN_REMINDER_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_reminder_message_input), CallbackQueryHandler(admin_reminder_set_message)],
             ADMIN_REMINDER_TYPE: [CallbackQueryHandler(admin_reminder_set_type, pattern="^(admin_reminder_type_.*|admin_reminder_back_to_type)$")],
@@ -7148,17 +10103,29 @@ def setup_bot():
             ADMIN_REMINDER_DAY: [CallbackQueryHandler(admin_reminder_set_day, pattern="^(admin_reminder_day_.*)$")],
             ADMIN_REMINDER_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_reminder_date_input), CallbackQueryHandler(admin_reminder_set_date)],
             ADMIN_REMINDER_MASTER_CLASS: [CallbackQueryHandler(admin_reminder_set_master_class, pattern="^(admin_reminder_master_.*|admin_reminder_back_to_time)$")],
-            ADMIN_REMINDER_CONFIRM: [CallbackQueryHandler(admin_reminder_confirm_create, pattern="^(admin_reminder_confirm_create|admin_reminders)$")],
+            ADMIN_REMINDER_CONFIRM: [CallbackQueryHandler(admin_reminder_confirm_create, pattern=callback_actions("admin_reminder_confirm_create", "admin_reminders"))],
         },
         fallbacks=[
             CommandHandler("start", admin_start_from_session),
-            CallbackQueryHandler(admin_menu, pattern="^back_to_admin_menu$"),
+            CallbackQueryHandler(admin_menu, pattern=callback_actions("back_to_admin_menu")),
             MessageHandler(filters.TEXT & ~filters.COMMAND, handle_random_text_fallback, block=False)
         ],
-        allow_reentry=True
+        allow_reentry=True,
+        name="admin_conversation",
+        persistent=True
     )
+    bot_persistence.watch_conversations(user_conversation_handler, admin_conversation_handler)
+    conversation_reaper.watch(user_conversation_handler, USER_CONVERSATION_TIMEOUT)
+    conversation_reaper.watch(admin_conversation_handler, ADMIN_CONVERSATION_TIMEOUT)
+    conversation_reaper.check_ptb_internals(application)
+    check_callback_routes([user_conversation_handler, admin_conversation_handler], [admin_router])
 
     # Регистрируем обработчики
+    # Повторные нажатия кнопок отбрасываются до всех остальных обработчиков
+    application.add_handler(CallbackQueryHandler(drop_repeated_callback), group=-2)
+    application.add_handler(CallbackQueryHandler(finish_repeated_callback_guard), group=100)
+    # Отмечаем активность пользователя до всех остальных обработчиков
+    application.add_handler(TypeHandler(Update, track_bot_user), group=-1)
     application.add_handler(CommandHandler("start", start))
     # Обработчик для случайных текстовых сообщений - показываем кнопку "Start" (ставим раньше остальных; block=False, чтобы не мешать другим хендлерам)
     # application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_random_text, block=False))
@@ -7172,27 +10139,22 @@ def setup_bot():
     application.add_handler(CallbackQueryHandler(about_event, pattern="^about$"))
     application.add_handler(CallbackQueryHandler(refresh_data, pattern="^refresh_data$"))
     application.add_handler(CallbackQueryHandler(start, pattern="^back_to_menu$"))
-    application.add_handler(CallbackQueryHandler(manage_record, pattern="^change_datetime:.*$"))
-    application.add_handler(CallbackQueryHandler(manage_record, pattern="^change_position:.*$"))
-    application.add_handler(CallbackQueryHandler(manage_record, pattern="^delete_record:.*$"))
-    application.add_handler(CallbackQueryHandler(manage_record, pattern="^keep_record$"))
-    application.add_handler(CallbackQueryHandler(manage_record, pattern="^register_again$"))
+    application.add_handler(CallbackQueryHandler(manage_record, pattern=callback_actions("change_datetime", "change_position", "delete_record", "keep_record", "register_again")))
     application.add_handler(CallbackQueryHandler(show_main_menu_callback, pattern="^show_main_menu$"))
+    # Кнопки, которые не принял ни один обработчик (например, диалог завершен по таймауту)
+    application.add_handler(CallbackQueryHandler(handle_stale_callback))
     application.add_error_handler(error_handler)
 
-    # Проверяем пропущенные напоминания при запуске бота
-    check_missed_reminders(application)
+    if run_background:
+        start_background_workers(application)
 
     # Запускаем бота
-    logger.info("✅ Бот инициализирован!")
-    print("✅ Бот инициализирован!")
-
-    # Запускаем фоновый поток для напоминаний ПОСЛЕ запуска приложения
-    reminder_thread = threading.Thread(target=reminder_worker, args=(application,), daemon=True, name="ReminderWorker")
-    reminder_thread.start()
-    logger.info("✅ Поток напоминаний запущен")
+    logger.info(f"✅ Бот инициализирован (режим {bot_run_mode})!")
+    print(f"✅ Бот инициализирован (режим {bot_run_mode})!")
     print(f"ℹ️  Используется токен: {TOKEN[:5]}...{TOKEN[-5:]}")
-    if google_sheets_enabled:
+    if not run_background:
+        print("ℹ️ Фоновые потоки не запускаются: напоминания и Google Sheets выполняет процесс в режиме worker")
+    elif google_sheets_enabled:
         print("✅ Интеграция с Google Sheets: Активна")
         print("✅ Доступно мастер-классов: " + str(len(masters_data)))
     else:
@@ -7206,7 +10168,30 @@ def setup_bot():
     
     return application
 
+# Точка входа фонового процесса (python Zapis2.py worker)
+def run_worker():
+    """Выполняет только фоновые задачи (напоминания, синхронизация Google Sheets) с общей events.db"""
+    application = setup_bot(mode="worker")
+    if not application:
+        return
+
+    stop_requested = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.set())
+    logger.info("🛠️ Фоновый процесс запущен, обновления Telegram принимает процесс в режиме web")
+    try:
+        while not stop_requested.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Гарантированное завершение работы
+        shutdown()
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "worker":
+        run_worker()
+        return
+
     application = setup_bot()
     if not application:
         return
@@ -0,0 +1,116 @@
+"""
+Нагрузочный тест PerChatUpdateProcessor: 100 пользователей одновременно пишут боту.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_concurrent_updates.py
+
+Сеть и Telegram не нужны: обработчик только ждет IO_DELAY секунд (запись в базу / Google Sheets).
+Первый замер - пропускная способность без параллельности и с разными лимитами.
+Второй - "шумный" пользователь: пока его медленная запись (SLOW_DELAY) занимает чат, он отправляет
+еще NOISY_UPDATES обновлений; остальные пользователи не должны ждать его очереди.
+"""
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123:abc")
+os.chdir(tempfile.mkdtemp())  # Файлы журнала и events.db модуля бота - во временном каталоге
+logging.disable(logging.INFO)
+
+import Zapis2
+from telegram import Chat, Message, Update, User
+from telegram.ext import Application, MessageHandler, filters
+
+USERS = 100  # Сколько пользователей пишут одновременно
+PER_USER = 5  # Сколько сообщений отправляет каждый
+IO_DELAY = 0.05  # Время обработки обычного обновления (секунды)
+SLOW_DELAY = 1.0  # Время медленной записи "шумного" пользователя (секунды)
+NOISY_UPDATES = 16  # Сколько обновлений "шумный" пользователь отправляет во время медленной записи
+LIMITS = (1, 16, 64, 256)  # Значения MAX_CONCURRENT_UPDATES для сравнения
+
+
+def make_update(user_id, text, update_id):
+    user = User(user_id, "u", False)
+    return Update(update_id, message=Message(update_id, datetime.now(), Chat(user_id, "private"), from_user=user, text=text))
+
+
+def build_application(limit, handler):
+    builder = Application.builder().token(os.environ["TELEGRAM_BOT_TOKEN"])
+    if limit > 1:
+        builder = builder.concurrent_updates(Zapis2.PerChatUpdateProcessor(limit))
+    application = builder.build()
+    application.bot._initialized = True
+    application.bot._bot_user = User(1, "bot", True, username="bot")
+    application.add_handler(MessageHandler(filters.TEXT, handler))
+    return application
+
+
+async def feed(application, updates):
+    # Так же, как Application.start() раздает обновления из очереди
+    if application.update_processor.max_concurrent_updates > 1:
+        await asyncio.gather(*(application.update_processor.process_update(u, application.process_update(u)) for u in updates))
+    else:
+        for u in updates:
+            await application.process_update(u)
+
+
+async def bench_throughput(limit):
+    seen = {}
+
+    async def handler(update, context):
+        await asyncio.sleep(IO_DELAY)
+        seen.setdefault(update.effective_chat.id, []).append(int(update.message.text))
+
+    application = build_application(limit, handler)
+    await application.initialize()
+    updates = [make_update(1000 + uid, str(n), n * USERS + uid) for n in range(PER_USER) for uid in range(USERS)]
+    started = time.perf_counter()
+    await feed(application, updates)
+    elapsed = time.perf_counter() - started
+    ordered = all(values == sorted(values) for values in seen.values())
+    print(f"limit={limit}: {len(updates)} обновлений за {elapsed:.2f} с, {len(updates) / elapsed:.0f} обн/с, "
+          f"порядок в чатах сохранен: {ordered}")
+    await application.shutdown()
+
+
+async def bench_noisy_user(limit):
+    noisy_id = 999
+    latencies = []
+    sent_at = {}
+
+    async def handler(update, context):
+        if update.effective_chat.id == noisy_id:
+            await asyncio.sleep(SLOW_DELAY if update.message.text == "slow" else IO_DELAY)
+            return
+        await asyncio.sleep(IO_DELAY)
+        latencies.append(time.perf_counter() - sent_at[update.update_id])
+
+    application = build_application(limit, handler)
+    await application.initialize()
+    noisy = [make_update(noisy_id, "slow", 1)] + [make_update(noisy_id, "tap", 2 + n) for n in range(NOISY_UPDATES)]
+    others = [make_update(1000 + uid, "hi", 100 + uid) for uid in range(USERS)]
+    noisy_task = asyncio.create_task(feed(application, noisy))
+    await asyncio.sleep(0.01)  # Медленная запись уже идет
+    for u in others:
+        sent_at[u.update_id] = time.perf_counter()
+    await feed(application, others)
+    await noisy_task
+    latencies.sort()
+    print(f"limit={limit}: задержка остальных {USERS} пользователей при {NOISY_UPDATES} обновлениях шумного - "
+          f"медиана {latencies[len(latencies) // 2] * 1000:.0f} мс, максимум {latencies[-1] * 1000:.0f} мс")
+    await application.shutdown()
+
+
+if __name__ == "__main__":
+    print("Пропускная способность:")
+    for limit in LIMITS:
+        asyncio.run(bench_throughput(limit))
+    print("Шумный пользователь:")
+    for limit in LIMITS[1:]:
+        asyncio.run(bench_noisy_user(limit))
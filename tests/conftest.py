@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123:abc")
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    """Модуль бота с пустой events.db во временном каталоге"""
+    monkeypatch.chdir(tmp_path)
+    import Zapis2
+    Zapis2.init_db()
+    monkeypatch.setattr(Zapis2, "masters_data", {
+        "MC001": {"name": "Тест", "total_spots": 5, "free_spots": 5, "booked": 0, "available": True, "enabled": True,
+                  "date_start": "2030-01-01", "date_end": "2030-01-31", "time_start": "10:00", "time_end": "12:00"}
+    })
+    return Zapis2
@@ -0,0 +1,20 @@
+def test_web_booking_goes_to_sheets_outbox(bot, monkeypatch):
+    monkeypatch.setattr(bot, "bot_run_mode", "web")
+    monkeypatch.setattr(bot, "google_sheets_enabled", False)
+
+    result = bot.book_slot("Иванов Иван", "MC001", "2030-01-10", "10:00", 42)
+
+    assert result.status == bot.BOOKING_OK
+    assert bot.count_sheets_outbox() == 1
+
+
+def test_booking_skips_sheets_when_local_worker_has_them_disabled(bot, monkeypatch):
+    monkeypatch.setattr(bot, "bot_run_mode", "all")
+    monkeypatch.setattr(bot, "google_sheets_enabled", False)
+    queued = bot.sheets_queue.qsize()
+
+    result = bot.book_slot("Иванов Иван", "MC001", "2030-01-10", "10:00", 42)
+
+    assert result.status == bot.BOOKING_OK
+    assert bot.count_sheets_outbox() == 0
+    assert bot.sheets_queue.qsize() == queued